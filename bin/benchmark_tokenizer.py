@@ -0,0 +1,78 @@
+# coding: utf-8
+
+import sys
+import argparse
+import io
+import json
+import random
+import time
+
+from tmnt.preprocess.tokenizer import BasicTokenizer, FastBasicTokenizer
+
+parser = argparse.ArgumentParser('Check that FastBasicTokenizer produces the same tokens as BasicTokenizer and compare throughput')
+
+parser.add_argument('--input_file', type=str, help='Text file with one document per line (or JSON lines with --json_text_key)')
+parser.add_argument('--json_text_key', type=str, help='Key for the document text when the input is JSON lines', default=None)
+parser.add_argument('--max_docs', type=int, help='Maximum number of documents read from the input file', default=100000)
+parser.add_argument('--num_random', type=int, help='Number of random Unicode strings checked for conformance', default=20000)
+parser.add_argument('--repeats', type=int, help='Number of timed runs per tokenizer', default=3)
+parser.add_argument('--seed', type=int, help='Random seed for generated strings', default=1234)
+parser.add_argument('--str_encoding', type=str, help='String/file encoding', default='utf-8')
+
+args = parser.parse_args()
+
+
+def read_docs():
+    docs = []
+    if args.input_file:
+        with io.open(args.input_file, 'r', encoding=args.str_encoding) as fp:
+            for line in fp:
+                docs.append(json.loads(line)[args.json_text_key] if args.json_text_key else line)
+                if len(docs) >= args.max_docs:
+                    break
+    return docs
+
+
+def random_strings(n):
+    ## mix of word-like ASCII, accented Latin and arbitrary code points (incl. controls, marks and unassigned)
+    rng = random.Random(args.seed)
+    pieces = ['the', 'Tokens', '42', '3.14', ' ', '\t', '\n', '\x0b', 'Éclair', 'naïve', 'İstanbul', 'ǅ', 'ß', '-', ' ']
+    strings = []
+    for i in range(n):
+        max_cp = [0x80, 0x3000, sys.maxunicode + 1][i % 3]
+        strings.append(''.join(chr(rng.randrange(max_cp)) if rng.random() < 0.3 else rng.choice(pieces)
+                               for _ in range(rng.randint(0, 50))))
+    return strings
+
+
+def time_tokenizer(tokenizer, docs):
+    times = []
+    for _ in range(args.repeats):
+        start = time.time()
+        n_toks = sum(len(tokenizer.tokenize(d)) for d in docs)
+        times.append(time.time() - start)
+    return min(times), n_toks
+
+
+if __name__ == '__main__':
+    docs = read_docs()
+    n_mismatch = 0
+    for do_lower_case in [True, False]:
+        for use_stop_words in [True, False]:
+            ref = BasicTokenizer(do_lower_case=do_lower_case, use_stop_words=use_stop_words)
+            fast = FastBasicTokenizer(do_lower_case=do_lower_case, use_stop_words=use_stop_words)
+            for s in docs + random_strings(args.num_random):
+                if ref.tokenize(s) != fast.tokenize(s):
+                    n_mismatch += 1
+                    if n_mismatch <= 10:
+                        print("Mismatch on {!r}: {} != {}".format(s[:200], ref.tokenize(s), fast.tokenize(s)))
+    print("Conformance: {} mismatches over {} documents and {} random strings".format(n_mismatch, len(docs), args.num_random))
+    if docs:
+        n_chars = sum(len(d) for d in docs)
+        t_ref, n_toks = time_tokenizer(BasicTokenizer(), docs)
+        t_fast, _ = time_tokenizer(FastBasicTokenizer(), docs)
+        print("Documents = {}, characters = {}, tokens = {}".format(len(docs), n_chars, n_toks))
+        print("BasicTokenizer    : {:8.4f} seconds ({:.2f} MB/s)".format(t_ref, n_chars / t_ref / 1e6))
+        print("FastBasicTokenizer: {:8.4f} seconds ({:.2f} MB/s)".format(t_fast, n_chars / t_fast / 1e6))
+        print("Speedup = {:.1f}x".format(t_ref / t_fast))
+    sys.exit(0 if n_mismatch == 0 else 1)
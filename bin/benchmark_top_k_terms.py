@@ -0,0 +1,36 @@
+# coding: utf-8
+
+import os, sys
+import argparse
+import time
+import mxnet as mx
+
+from tmnt.bow_vae.bow_doc_loader import collect_sparse_data
+from tmnt.bow_vae.bow_models import BowNTM
+from tmnt.bow_vae.train import get_wd_freqs
+
+parser = argparse.ArgumentParser('Compare Jacobian methods used to derive the top-k terms per topic')
+
+parser.add_argument('--vec_file', type=str, help='Sparse vector file', default='data/test.vec')
+parser.add_argument('--vocab_file', type=str, help='Vocabulary file associated with sparse vector data', default='data/train.vocab')
+parser.add_argument('--n_latent', type=int, help='Number of topics', default=20)
+parser.add_argument('--k', type=int, help='Number of top terms per topic to compare', default=10)
+parser.add_argument('--methods', type=str, help='Comma-separated Jacobian methods to time', default='auto,batched,loop')
+
+args = parser.parse_args()
+
+if __name__ == '__main__':
+    os.environ["MXNET_STORAGE_FALLBACK_LOG_VERBOSE"] = "0"
+    vocab, data_csr, _, _, _ = collect_sparse_data(args.vec_file, args.vocab_file)
+    model = BowNTM(vocab, 100, args.n_latent, 100, latent_distrib='vmf', wd_freqs=get_wd_freqs(data_csr))
+    print("Vocabulary size = {}, topics = {}".format(len(vocab), args.n_latent))
+    reference = None
+    for method in args.methods.split(','):
+        start = time.time()
+        sorted_ids = model.get_top_k_terms(args.k, method=method)
+        top_k = sorted_ids[:args.k].asnumpy()
+        elapsed = time.time() - start
+        if reference is None:
+            reference = top_k
+        same = (top_k == reference).all()
+        print("{:>8}: {:10.4f} seconds [top-{} terms match first method: {}]".format(method, elapsed, args.k, same))
@@ -0,0 +1,55 @@
+# coding: utf-8
+
+import argparse
+import io
+import time
+import numpy as np
+
+from tmnt.bow_vae.bow_doc_loader import load_vocab, file_to_sp_vec
+
+parser = argparse.ArgumentParser('Compare line-by-line and vectorized parsing of sparse vector files')
+
+parser.add_argument('--vec_file', type=str, help='Sparse vector file', default='data/test.vec')
+parser.add_argument('--vocab_file', type=str, help='Vocabulary file associated with sparse vector data', default='data/train.vocab')
+parser.add_argument('--num_workers', type=int, help='Number of worker processes for the vectorized parser', default=1)
+parser.add_argument('--repeats', type=int, help='Number of timed runs per method', default=3)
+
+args = parser.parse_args()
+
+
+def line_by_line_parse(sp_file, encoding='utf-8'):
+    ## reference implementation: the original per-line parser
+    label_strs, indices, values, indptrs = [], [], [], [0]
+    with io.open(sp_file, 'r', encoding=encoding) as fp:
+        for line in fp:
+            els = line.split(' ')
+            label_strs.append(els[0])
+            pairs = sorted([ (int(el[0]), float(el[1])) for el in map(lambda e: e.split(':'), els[1:]) ])
+            inds, vs = zip(*pairs)
+            indices.extend(inds)
+            values.extend(vs)
+            indptrs.append(indptrs[-1] + len(pairs))
+    return label_strs, np.array(indptrs), np.array(indices), np.array(values)
+
+
+def time_method(fn):
+    times = []
+    for _ in range(args.repeats):
+        start = time.time()
+        result = fn()
+        times.append(time.time() - start)
+    return min(times), result
+
+
+if __name__ == '__main__':
+    vocab = load_vocab(args.vocab_file)
+    t_old, (labels_old, indptr_old, ind_old, vs_old) = time_method(lambda: line_by_line_parse(args.vec_file))
+    t_new, (csr, _, labels_new, _) = \
+        time_method(lambda: file_to_sp_vec(args.vec_file, len(vocab), n_workers=args.num_workers))
+    sp_new = csr.asscipy()
+    same = (np.array_equal(indptr_old, sp_new.indptr) and np.array_equal(ind_old, sp_new.indices)
+            and np.allclose(vs_old, sp_new.data) and len(labels_old) == len(labels_new))
+    print("Documents = {}, non-zeros = {}".format(sp_new.shape[0], sp_new.nnz))
+    print("line-by-line parse: {:8.4f} seconds".format(t_old))
+    print("file_to_sp_vec    : {:8.4f} seconds [workers = {}]".format(t_new, args.num_workers))
+    print("Speedup = {:.1f}x; identical CSR = {}".format(t_old / t_new, same))
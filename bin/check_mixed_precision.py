@@ -0,0 +1,54 @@
+# coding: utf-8
+
+import os, sys
+import argparse
+import datetime
+import json
+import time
+
+from tmnt.bow_vae.train import get_worker
+from tmnt.common_params import get_base_argparser
+from tmnt.utils.random import seed_rng
+
+parser = get_base_argparser()
+parser.description = 'Train a configuration in float32 and in a 16-bit data type and compare speed, perplexity and coherence'
+
+parser.add_argument('--config', type=str, help='Configuration file (e.g. generated by select_model.py)')
+parser.add_argument('--eval_freq', type=int, help='Frequency of evaluation against validation data during training', default=1)
+parser.add_argument('--trace_file', type=str, default=None, help='Trace: (epoch, perplexity, NPMI) on validation data into a separate file')
+parser.add_argument('--low_dtype', type=str, choices=['bfloat16', 'float16'], default='bfloat16',
+                    help='16-bit data type to compare against float32')
+parser.add_argument('--max_perplexity_increase', type=float, default=0.05,
+                    help='Largest allowed relative increase in validation perplexity over float32')
+parser.add_argument('--max_npmi_decrease', type=float, default=0.05,
+                    help='Largest allowed absolute decrease in validation NPMI from float32')
+## encoder coherence also runs the embedding layer outside of the model's forward pass
+parser.set_defaults(tr_vec_file='data/test.vec', val_vec_file='data/test.vec', vocab_file='data/train.vocab',
+                    save_dir='_mixed_precision_check', encoder_coherence=True)
+
+args = parser.parse_args()
+
+if __name__ == '__main__':
+    os.environ["MXNET_STORAGE_FALLBACK_LOG_VERBOSE"] = "0"
+    with open(args.config, 'r') as f:
+        config = json.loads(f.read())
+    budget = int(config['training_epochs'])
+    id_str = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+    worker, _ = get_worker(args, budget, id_str, None)
+    results = {}
+    for dtype in ['float32', args.low_dtype]:
+        config['dtype'] = dtype
+        seed_rng(args.seed)
+        start = time.time()
+        _, res = worker._train_model(config, budget, data_sensitive_budget=False)
+        elapsed = time.time() - start
+        results[dtype] = res['info']
+        print("{:>8}: {:8.1f} seconds; perplexity = {:10.3f}; NPMI = {:6.4f}; encoder NPMI = {:6.4f}"
+              .format(dtype, elapsed, res['info']['test_perplexity'], res['info']['test_npmi'], res['info']['test_enc_npmi']))
+    ref, low = results['float32'], results[args.low_dtype]
+    ppl_increase = (low['test_perplexity'] - ref['test_perplexity']) / ref['test_perplexity']
+    npmi_decrease = ref['test_npmi'] - low['test_npmi']
+    passed = ppl_increase <= args.max_perplexity_increase and npmi_decrease <= args.max_npmi_decrease
+    print("Relative perplexity increase = {:.4f}; NPMI decrease = {:.4f} ==> {}"
+          .format(ppl_increase, npmi_decrease, 'PASS' if passed else 'FAIL'))
+    sys.exit(0 if passed else 1)
@@ -0,0 +1,75 @@
+# coding: utf-8
+
+import os, sys
+import argparse
+import http.client
+import json
+from pathlib import Path
+
+from tmnt.bow_vae.runtime import BowNTMInference
+from tmnt.bow_vae.server import InferenceServer
+
+parser = argparse.ArgumentParser('Check the status codes returned by the inference server for valid and invalid requests')
+
+parser.add_argument('--model_dir', type=Path, help='Directory with trained model files')
+parser.add_argument('--top_k', type=int, help='Number of top terms returned per topic by the server', default=10)
+
+args = parser.parse_args()
+
+
+def post(address, path, body):
+    conn = http.client.HTTPConnection(*address, timeout=30.0)
+    try:
+        conn.request('POST', path, body=body, headers={'Content-Type': 'application/json'})
+        resp = conn.getresponse()
+        return resp.status, json.loads(resp.read().decode('utf-8'))
+    finally:
+        conn.close()
+
+
+def check(address, name, path, request, expected_status):
+    body = request if isinstance(request, bytes) else json.dumps(request).encode('utf-8')
+    status, result = post(address, path, body)
+    ok = status == expected_status
+    print("{:<32} status = {} (expected {}) ==> {}{}".format(name, status, expected_status, 'PASS' if ok else 'FAIL',
+                                                              '' if status == 200 else ': ' + str(result.get('error'))))
+    return ok
+
+
+def covar_request(infer, texts):
+    request = {'texts': texts}
+    if infer.covar_model:
+        request['covars'] = [next(iter(infer.model.label_map))] * len(texts)
+    return request
+
+
+if __name__ == '__main__':
+    os.environ["MXNET_STORAGE_FALLBACK_LOG_VERBOSE"] = "0"
+    infer = BowNTMInference(model_dir=args.model_dir)
+    texts = ['the car engine and the wheels', 'religion and belief in god']
+    valid = covar_request(infer, texts)
+    results = []
+    server = InferenceServer(infer, port=0, top_k=args.top_k).start()
+    try:
+        address = server.address
+        results.append(check(address, 'valid request', '/encode', valid, 200))
+        results.append(check(address, 'top_k at the server limit', '/encode', dict(valid, top_k=args.top_k), 200))
+        results.append(check(address, 'non-integer top_k', '/encode', dict(valid, top_k='five'), 400))
+        results.append(check(address, 'fractional top_k', '/encode', dict(valid, top_k=2.5), 400))
+        results.append(check(address, 'top_k above the server limit', '/encode', dict(valid, top_k=args.top_k + 1), 400))
+        results.append(check(address, 'zero top_k', '/encode', dict(valid, top_k=0), 400))
+        results.append(check(address, 'texts not a list', '/encode', dict(valid, texts='text'), 400))
+        results.append(check(address, 'body not a JSON object', '/encode', [texts], 400))
+        results.append(check(address, 'invalid JSON', '/encode', b'{"texts": [', 400))
+        results.append(check(address, 'unknown path', '/decode', valid, 404))
+    finally:
+        server.shutdown()
+    ## requests wait for a batch longer than the request timeout
+    server = InferenceServer(infer, port=0, top_k=args.top_k, max_latency=2.0, request_timeout=0.1).start()
+    try:
+        results.append(check(server.address, 'request timeout', '/encode', valid, 504))
+    finally:
+        server.shutdown()
+    passed = all(results)
+    print("{}/{} checks passed ==> {}".format(sum(results), len(results), 'PASS' if passed else 'FAIL'))
+    sys.exit(0 if passed else 1)
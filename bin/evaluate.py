@@ -7,9 +7,7 @@ import os
 import mxnet as mx
 
 from tmnt.bow_vae.runtime import BowNTMInference
-from tmnt.bow_vae.bow_doc_loader import collect_sparse_data
-from tmnt.coherence.npmi import NPMI, EvaluateNPMI
-from tmnt.utils.ngram_helpers import BigramReader
+from tmnt.coherence.npmi import EvaluateNPMI
 import gluonnlp as nlp
 
 from itertools import combinations
@@ -32,6 +30,7 @@ def setup_parser():
     parser.add_argument('--plot_file', type=str, help='Output plot')
     parser.add_argument('--words_per_topic', type=int, help='Number of terms per topic to output', default=10)
     parser.add_argument('--override_top_k_terms', type=str, help='File of topic terms to use instead of those from model', default=None)
+    parser.add_argument('--num_workers', type=int, help='Number of processes used to count term co-occurrences for NPMI', default=1)
     return parser
 
 def read_vector_file(file):
@@ -73,11 +72,10 @@ if __name__ == "__main__":
 
     if args.override_top_k_terms:
         top_k_words_per_topic = get_top_k_terms_from_file(args.override_top_k_terms)
-        _, tst_csr, _, _, _ = collect_sparse_data(args.test_file, args.vocab_file, args.test_file)
         vocab = load_vocab(args.vocab_file)
         top_k_words_per_topic_ids = [ [ vocab[t] for t in t_set ]  for t_set in top_k_words_per_topic ]
         npmi_eval = EvaluateNPMI(top_k_words_per_topic_ids)
-        test_npmi = npmi_eval.evaluate_csr_mat(tst_csr)
+        test_npmi = npmi_eval.evaluate_sp_vec(args.test_file, n_workers=args.num_workers)
         print("**** Test NPMI = {} *******".format(test_npmi))
         exit(0)
 
@@ -90,8 +88,7 @@ if __name__ == "__main__":
 
     if args.plot_file: # get UMAP embedding visualization
         import matplotlib.pyplot as plt
-        encoded, labels = inference_model.encode_vec_file(args.test_file)
-        encodings = np.array([doc.asnumpy() for doc in encoded])
+        encodings, labels = inference_model.encode_vec_file(args.test_file)
         print("There are {0} labels and {1} encodings".format(len(labels), len(encodings)))
         umap_model = umap.UMAP(n_neighbors=4, min_dist=0.5, metric='euclidean')
         embeddings = umap_model.fit_transform(encodings)
@@ -105,8 +102,7 @@ if __name__ == "__main__":
     top_k_words_per_topic_ids = [ [ inference_model.vocab[t] for t in t_set ]  for t_set in top_k_words_per_topic ]
 
     npmi_eval = EvaluateNPMI(top_k_words_per_topic_ids)
-    _, tst_csr, _, _, _ = collect_sparse_data(args.test_file, args.vocab_file, args.test_file)
-    test_npmi = npmi_eval.evaluate_csr_mat(tst_csr)
+    test_npmi = npmi_eval.evaluate_sp_vec(args.test_file, n_workers=args.num_workers)
     print("**** Test NPMI = {} *******".format(test_npmi))
     exit(0)
 
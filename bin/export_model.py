@@ -17,6 +17,11 @@ parser.add_argument('--json_output_file', type=str, help='JSON output file')
 parser.add_argument('--json_simple', type=str, help='JSON output file')
 parser.add_argument('--html_vis', type=str, help='PyLDAVis HTML file', default=None)
 parser.add_argument('--str_encoding', type=str, help='String/file encoding', default='utf-8')
+parser.add_argument('--stream_output_prefix', type=str, default=None,
+                    help='Stream document-topic probabilities and topic-term sections to files with this prefix')
+parser.add_argument('--stream_format', type=str, choices=['jsonl', 'npy'], default='jsonl',
+                    help='Format of the streamed output files')
+parser.add_argument('--batch_size', type=int, default=None, help='Number of documents encoded per batch')
 
 args = parser.parse_args()
 
@@ -29,6 +34,9 @@ if __name__ == '__main__':
         args.model_dir / "model.params", args.model_dir / "model.config", args.model_dir / "vocab.json"
     infer = BowNTMInference(param_file, config_file, vocab_file)
 
+    if args.stream_output_prefix:
+        infer.export_model_details_streaming(args.vec_file, args.stream_output_prefix, fmt=args.stream_format,
+                                             batch_size=args.batch_size)
     if args.json_output_file:
         full_model_dict = infer.export_full_model_inference_details(args.vec_file, args.json_output_file)
     if args.html_vis:
@@ -39,7 +47,8 @@ if __name__ == '__main__':
         pyLDAvis.save_html(vis_data, args.html_vis)
 
     if args.json_simple:
-        w_pr, _, _, _ = infer.get_model_details(args.vec_file)
+        ## only the topic-term section is needed here, so the documents are not encoded
+        w_pr = infer.get_topic_term_probs().asnumpy()
         k, n = w_pr.shape
         vocab = infer.vocab
         d = {}
@@ -47,7 +56,7 @@ if __name__ == '__main__':
             tn = "topic_"+str(i)
             vl = []
             for j in range(n):
-                vl.append((vocab._idx_to_token[j], float(w_pr[i,j].asscalar())))
+                vl.append((vocab._idx_to_token[j], float(w_pr[i,j])))
             d[tn] = vl
         with io.open(args.json_simple, 'w', encoding=args.str_encoding) as fp:
             json.dump(d, fp, indent=4)
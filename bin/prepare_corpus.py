@@ -27,6 +27,8 @@ parser.add_argument('--min_doc_length', type=int, help='Minimum document length
 parser.add_argument('--custom_stop_words', type=str, help='Custom stop-word file (one word per line)', default=None)
 parser.add_argument('--label_prefix_chars', type=int, help='Use first N characters of label', default=-1)
 parser.add_argument('--str_encoding', type=str, help='String/file encoding to use', default='utf-8')
+parser.add_argument('--binary', action='store_true', help='Write vector files in binary (memory-mappable) CSR format')
+parser.add_argument('--num_workers', type=int, help='Number of worker processes (default: number of CPUs)', default=None)
 parser.add_argument('--log_dir', type=str, help='Logging directory', default='.')
 
 args = parser.parse_args()
@@ -36,19 +38,21 @@ if __name__ == '__main__':
     if args.vocab_file is None:
         raise Exception("Vocabulary output file name/path must be provided")
     vectorizer = \
-        TextVectorizer(min_doc_size=args.min_doc_length, encoding=args.str_encoding, custom_stop_word_file=args.custom_stop_words) \
+        TextVectorizer(min_doc_size=args.min_doc_length, encoding=args.str_encoding, custom_stop_word_file=args.custom_stop_words,
+                       n_workers=args.num_workers) \
         if args.txt_mode \
            else JsonVectorizer(text_key=args.json_text_key, custom_stop_word_file=args.custom_stop_words, label_key=args.json_label_key,
                             min_doc_size=args.min_doc_length, label_prefix=args.label_prefix_chars,
                             json_out_dir=args.json_out_dir,
-                            encoding=args.str_encoding)
+                            encoding=args.str_encoding, n_workers=args.num_workers)
     vocab = vectorizer.get_sparse_vecs(args.tr_vec_file, args.vocab_file, args.tr_input_dir,
-                                   args.vocab_size, full_histogram_file=args.full_vocab_histogram, pat=args.file_pat)
+                                   args.vocab_size, full_histogram_file=args.full_vocab_histogram, pat=args.file_pat,
+                                   binary=args.binary)
 
     if args.val_input_dir and args.val_vec_file:
         _ = vectorizer.get_sparse_vecs(args.val_vec_file, args.vocab_file, args.val_input_dir, i_vocab=vocab,
-                                       pat=args.file_pat)
+                                       pat=args.file_pat, binary=args.binary)
     if args.tst_input_dir and args.tst_vec_file:
         _ = vectorizer.get_sparse_vecs(args.tst_vec_file, args.vocab_file, args.tst_input_dir, i_vocab=vocab,
-                                       pat=args.file_pat)
+                                       pat=args.file_pat, binary=args.binary)
                                        
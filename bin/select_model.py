@@ -2,9 +2,9 @@
 
 import os, sys
 import argparse
+import multiprocessing
 
-from tmnt.bow_vae.train import model_select_bow_vae
-from tmnt.common_params import get_base_argparser
+from tmnt.common_params import get_base_argparser, get_worker_thread_env
 
 parser = get_base_argparser()
 parser.description = 'Automated model selection for TMNT Topic Models'
@@ -13,6 +13,8 @@ parser.add_argument('--budget',type=int, help='Maximum number of training epochs
 parser.add_argument('--iterations',type=int, help='Maximum number of full model training epochs to carry out as part of search', default=4)
 parser.add_argument('--coherence_coefficient', type=float, help='Weight applied to coherence (NPMI) term of objective function', default=1.0)
 parser.add_argument('--ns_port', type=int, help='Force a specific port number for HPBandSter nameserver', default=None)
+parser.add_argument('--num_workers', type=int, help='Number of local worker processes evaluating configurations concurrently', default=1)
+parser.add_argument('--worker_threads', type=int, help='Number of OpenMP/MKL/MXNet threads per worker (default: number of CPUs / num_workers)', default=None)
 
 
 
@@ -21,5 +23,11 @@ args = parser.parse_args()
 
 if __name__ == '__main__':
     os.environ["MXNET_STORAGE_FALLBACK_LOG_VERBOSE"] = "0"
+    if args.worker_threads is None:
+        args.worker_threads = max(1, multiprocessing.cpu_count() // max(1, args.num_workers))
+    if args.num_workers > 1:
+        ## thread caps must be in place before MXNet is loaded
+        os.environ.update(get_worker_thread_env(args.worker_threads))
+    from tmnt.bow_vae.train import model_select_bow_vae
     model_select_bow_vae(args)
 
@@ -0,0 +1,37 @@
+# coding: utf-8
+
+import os
+import argparse
+import logging
+from pathlib import Path
+
+from tmnt.bow_vae.runtime import BowNTMInference
+from tmnt.bow_vae.server import InferenceServer
+
+parser = argparse.ArgumentParser('Serve a trained topic model over HTTP, batching concurrent requests')
+
+parser.add_argument('--model_dir', type=Path, help='Directory with trained model files')
+parser.add_argument('--host', type=str, help='Address to listen on', default='127.0.0.1')
+parser.add_argument('--port', type=int, help='TCP port to listen on', default=8000)
+parser.add_argument('--unix_socket', type=str, help='Listen on this Unix domain socket instead of a TCP port', default=None)
+parser.add_argument('--max_batch_size', type=int, help='Maximum number of documents encoded together', default=64)
+parser.add_argument('--max_latency_ms', type=float, help='Maximum milliseconds a request waits to be batched', default=10.0)
+parser.add_argument('--max_queue_size', type=int, help='Maximum number of queued requests (more are rejected)', default=10000)
+parser.add_argument('--top_k', type=int, help='Number of top terms returned per topic', default=10)
+parser.add_argument('--pool_size', type=int, help='Number of text pre-processing processes', default=1)
+
+args = parser.parse_args()
+
+if __name__ == '__main__':
+    os.environ["MXNET_STORAGE_FALLBACK_LOG_VERBOSE"] = "0"
+    logging.basicConfig(level=logging.INFO)
+    infer = BowNTMInference(model_dir=args.model_dir)
+    server = InferenceServer(infer, host=args.host, port=args.port, unix_socket=args.unix_socket,
+                             max_batch_size=args.max_batch_size, max_latency=args.max_latency_ms / 1000.0,
+                             max_queue_size=args.max_queue_size, top_k=args.top_k, pool_size=args.pool_size)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
@@ -0,0 +1,19 @@
+# coding: utf-8
+
+import os, sys
+import argparse
+
+from tmnt.bow_vae.bow_doc_loader import load_vocab
+from tmnt.utils.csr_file import convert_vec_to_csr_file
+
+parser = argparse.ArgumentParser('Convert a sparse vector file into binary (memory-mappable) CSR format')
+parser.add_argument('--vec_file', type=str, help='Input file in sparse vector format')
+parser.add_argument('--vocab_file', type=str, help='Vocabulary file associated with sparse vector data')
+parser.add_argument('--out_file', type=str, help='Output binary CSR file')
+parser.add_argument('--str_encoding', type=str, help='String/file encoding to use', default='utf-8')
+
+args = parser.parse_args()
+
+if __name__ == '__main__':
+    vocab = load_vocab(args.vocab_file, encoding=args.str_encoding)
+    convert_vec_to_csr_file(args.vec_file, args.out_file, vocab.idx_to_token, encoding=args.str_encoding)
@@ -9,18 +9,28 @@ for efficient neural variational model training.
 
 import io
 import itertools
+import json
 import os
 import logging
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
 
 import gluonnlp as nlp
 import mxnet as mx
+import numpy as np
+import scipy.sparse as sp
 from gluonnlp.data import SimpleDatasetStream, CorpusDataset
 
-from tmnt.preprocess.tokenizer import BasicTokenizer
+from tmnt.preprocess.tokenizer import FastBasicTokenizer
+from tmnt.preprocess.scheduler import get_line_aligned_ranges as _get_line_aligned_ranges
+from tmnt.utils.csr_file import is_csr_file, load_csr_file, vocab_hash, write_csr_file
 
 
-__all__ = ['DataIterLoader', 'collect_sparse_test', 'collect_sparse_data', 'BowDataSet', 'collect_stream_as_sparse_matrix',
-           'get_single_vec', 'load_vocab']
+__all__ = ['DataIterLoader', 'CSRBatchLoader', 'collect_sparse_test', 'collect_sparse_data', 'BowDataSet', 'collect_stream_as_sparse_matrix',
+           'get_single_vec', 'load_vocab', 'ShardedCorpus', 'ShardedDataLoader', 'shard_sp_vec_file',
+           'PrefetchingLoader', 'parse_sp_vec_file', 'iter_sp_vec_blocks', 'map_labels']
 
 def preprocess_dataset_stream(stream, pre_vocab = None, min_freq=3, max_vocab_size=None):
     if pre_vocab:
@@ -118,6 +128,148 @@ class DataIterLoader():
         return self.__next__()
     
 
+class CSRBatchLoader():
+    """
+    Iterates over the rows of a CSR matrix (and optional labels) in batches of `batch_size` without converting
+    the data to dense arrays (`NDArrayIter` returns dense batches when shuffling CSR data).
+
+    Parameters
+    ----------
+    data : CSRNDArray or `scipy.sparse.csr_matrix` (e.g. memory-mapped, see `csr_file_to_sp_vec`)
+    labels : NDArray (default None) labels/covariates with one row per document
+    batch_size : int
+    shuffle : bool (default False) visit the rows in a new random order each epoch
+    last_batch : str (default 'pad') 'pad' keeps the last partial batch, padded with empty rows (and zero labels)
+        to the full batch size; 'discard' drops it
+    densify : bool (default False) return dense data batches
+    """
+    def __init__(self, data, labels, batch_size, shuffle=False, last_batch='pad', densify=False):
+        if last_batch not in ('pad', 'discard'):
+            raise Exception("Invalid last batch handling ==> {}".format(last_batch))
+        self.sp_data = data if sp.issparse(data) else data.asscipy()
+        self.labels = labels.asnumpy() if labels is not None else None
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.last_batch = last_batch
+        self.densify = densify
+
+    def __iter__(self):
+        n_docs = self.sp_data.shape[0]
+        order = np.random.permutation(n_docs) if self.shuffle else None
+        for start in range(0, n_docs, self.batch_size):
+            end = min(start + self.batch_size, n_docs)
+            if end - start < self.batch_size and self.last_batch == 'discard':
+                break
+            rows = order[start:end] if order is not None else slice(start, end)
+            yield self._make_batch(self.sp_data[rows], self.labels[rows] if self.labels is not None else None)
+
+    def _make_batch(self, sp_batch, labels):
+        n_pad = self.batch_size - sp_batch.shape[0]
+        indptr = np.concatenate([sp_batch.indptr, np.full(n_pad, sp_batch.indptr[-1], dtype=sp_batch.indptr.dtype)])
+        data = mx.nd.sparse.csr_matrix((sp_batch.data, sp_batch.indices, indptr),
+                                       shape=(self.batch_size, sp_batch.shape[1]), dtype='float32')
+        if self.densify:
+            data = data.tostype('default')
+        if labels is None:
+            return data, None
+        if n_pad > 0:
+            labels = np.concatenate([labels, np.zeros((n_pad,) + labels.shape[1:], dtype=labels.dtype)])
+        return data, mx.nd.array(labels, dtype=labels.dtype)
+
+
+class PrefetchingLoader():
+    """
+    Wraps a loader yielding (data, label) batches and prepares batches on a background thread: labels are
+    expanded (one-hot for categorical labels, a column vector for scalar labels, zeros when missing),
+    data is optionally densified and both are copied to the training context (through pinned host memory
+    for GPU contexts). At most `prefetch` prepared
+    batches are queued; with `prefetch=0` batches are prepared synchronously. The time the consumer spent
+    waiting for batches during the last pass is available as `stall_time` (as preparation waits on the MXNet
+    engine, this includes time spent behind device work queued by a consumer that does not synchronize).
+
+    Parameters
+    ----------
+    loader : iterable over (data, label) batches
+    prefetch : int (default 2) number of batches prepared ahead of the consumer
+    ctx : `mxnet.Context` (default mx.cpu()) context the batches are copied to
+    n_covars : int (default None) number of label classes for one-hot expansion (None for scalar labels)
+    densify : bool (default False) convert sparse data batches to dense arrays
+    """
+    def __init__(self, loader, prefetch=2, ctx=mx.cpu(), n_covars=None, densify=False):
+        self.loader = loader
+        self.prefetch = prefetch
+        self.ctx = ctx
+        self.n_covars = n_covars
+        self.densify = densify
+        self.stall_time = 0.0
+
+    def _prepare(self, data, label):
+        if label is None or label.size == 0:
+            label = mx.nd.expand_dims(mx.nd.zeros(data.shape[0]), 1)
+        elif label.ndim == 1:
+            label = mx.nd.one_hot(label, self.n_covars) if self.n_covars else mx.nd.expand_dims(label, 1)
+        if self.densify and data.stype != 'default':
+            data = data.tostype('default')
+        if self.ctx.device_type == 'gpu':
+            ## stage host-to-device copies through page-locked memory
+            data = data.as_in_context(mx.cpu_pinned(0))
+            label = label.as_in_context(mx.cpu_pinned(0))
+        data = data.as_in_context(self.ctx)
+        label = label.as_in_context(self.ctx)
+        data.wait_to_read()
+        label.wait_to_read()
+        return data, label
+
+    def _fill(self, batches, batch_queue, stop):
+        try:
+            for batch in batches:
+                item = self._prepare(*batch)
+                while not stop.is_set():
+                    try:
+                        batch_queue.put(item, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                if stop.is_set():
+                    return
+            item = None
+        except Exception as e:
+            item = e
+        while not stop.is_set():
+            try:
+                batch_queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def __iter__(self):
+        self.stall_time = 0.0
+        if self.prefetch < 1:
+            for batch in self.loader:
+                start = time.time()
+                item = self._prepare(*batch)
+                self.stall_time += time.time() - start
+                yield item
+            return
+        batch_queue = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+        worker = threading.Thread(target=self._fill, args=(iter(self.loader), batch_queue, stop), daemon=True)
+        worker.start()
+        try:
+            while True:
+                start = time.time()
+                item = batch_queue.get()
+                self.stall_time += time.time() - start
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            worker.join()
+
+
 class BowDataSet(SimpleDatasetStream):
     def __init__(self, root, pattern, sampler='random'):
         self._root = root
@@ -127,7 +279,7 @@ class BowDataSet(SimpleDatasetStream):
             dataset=CorpusDataset,
             file_pattern = self._file_pattern,
             file_sampler=sampler,
-            tokenizer=BasicTokenizer(),
+            tokenizer=FastBasicTokenizer(),
             sample_splitter=NullSplitter())
         
 
@@ -158,56 +310,214 @@ def load_vocab(vocab_file, encoding='utf-8'):
 
 
 def get_single_vec(els_sp):
-    pairs = sorted( [ (int(el[0]), float(el[1]) ) for el in els_sp ] )
-    inds, vs = zip(*pairs)
-    return len(pairs), inds, vs
-    
+    inds = [int(el[0]) for el in els_sp]
+    vs = [float(el[1]) for el in els_sp]
+    ## only sort when the term ids are out of order
+    if any(i1 > i2 for i1, i2 in zip(inds, inds[1:])):
+        inds, vs = zip(*sorted(zip(inds, vs)))
+    return len(inds), inds, vs
 
-def file_to_sp_vec(sp_file, voc_size, label_map=None, scalar_labels=False, encoding='utf-8'):
-    labels = []
-    indices = []
-    values = []
-    indptrs = [0]
-    cumulative = 0
-    total_num_words = 0
-    ndocs = 0
+
+_ASCII_ZEROS = np.uint64(0x3030303030303030)
+
+def _parse_numbers(data):
+    """
+    Parse all numbers in a byte string where numbers are separated by whitespace or colons.
+    Non-negative integers of up to 8 digits (the usual case for term ids and counts) are converted directly
+    from the digit bytes; anything else falls back to `np.fromstring`.
+    """
+    if data.translate(None, b'0123456789: \t\r\n'):
+        return np.fromstring(data.replace(b':', b' '), dtype='float64', sep=' ')
+    padded = b' ' + data + b' ' * 8
+    chars = np.frombuffer(padded, dtype='uint8')
+    is_digit = (chars - np.uint8(48)) < 10  ## separators wrap around to large unsigned values
+    ## number boundaries alternate between starts and ends
+    edges = np.flatnonzero(is_digit[1:] != is_digit[:-1])
+    edges += 1
+    starts = edges[0::2]
+    n_digits = edges[1::2] - starts
+    if len(starts) == 0:
+        return np.zeros(0)
+    if n_digits.max() > 8:
+        return np.fromstring(data.replace(b':', b' '), dtype='float64', sep=' ')
+    ## load the 8 bytes starting at each number as a little-endian word and shift out the bytes following the
+    ## number, leaving it left-padded with zero digits; pairs of digits, then pairs of pairs, ... are then combined
+    ## within the word (SWAR)
+    words = np.ndarray((len(chars) - 7,), dtype='<u8', buffer=padded, strides=(1,))
+    shift = ((8 - n_digits) * 8).astype('uint64')
+    x = words[starts] << shift
+    x -= _ASCII_ZEROS << shift
+    x = (x * np.uint64(10) + (x >> np.uint64(8))) & np.uint64(0x00FF00FF00FF00FF)
+    x = (x * np.uint64(100) + (x >> np.uint64(16))) & np.uint64(0x0000FFFF0000FFFF)
+    x = (x * np.uint64(10000) + (x >> np.uint64(32))) & np.uint64(0xFFFFFFFF)
+    return x.astype('float64')
+
+
+def _parse_sp_vec_block(block, encoding='utf-8'):
+    """
+    Parse a block of complete lines in sparse vector format (`label idx:count ...`) without iterating over
+    lines in Python: line, label and number boundaries are all located with array operations.
+
+    Returns
+    -------
+    label_strs: list of distinct label strings in order of first occurrence
+    label_ids: array indexing `label_strs` for each document
+    lens: array with the number of entries for each document
+    inds: array of term ids for all documents (concatenated)
+    vs: array of term counts for all documents (concatenated)
+    """
+    buf = np.frombuffer(block + b'\n', dtype='uint8')
+    is_space = (buf == 32) | (buf == 9) | (buf == 10) | (buf == 13)
+    newlines = np.flatnonzero(buf == 10)
+    starts = np.concatenate([[0], newlines[:-1] + 1])
+    ## skip blank lines
+    starts = starts[~is_space[starts]]
+    ## each label runs from the start of its line up to the first whitespace (labels are short, so step
+    ## through them one byte at a time)
+    widths = np.zeros(len(starts), dtype='int64')
+    in_label = np.arange(len(starts))
+    k = 0
+    while len(in_label) > 0:
+        k += 1
+        ended = is_space[starts[in_label] + k]
+        widths[in_label[ended]] = k
+        in_label = in_label[~ended]
+    width = int(widths.max()) if len(starts) > 0 else 1
+    label_bytes = np.zeros((len(starts), width), dtype='uint8')
+    body = buf.copy()
+    for k in range(width):
+        rows = np.flatnonzero(widths > k)
+        label_bytes[rows, k] = buf[starts[rows] + k]
+        body[starts[rows] + k] = 32
+    uniq, first, inverse = np.unique(label_bytes.view('S{}'.format(width)).ravel(), return_index=True,
+                                     return_inverse=True)
+    order = np.argsort(first)
+    rank = np.empty(len(order), dtype='int64')
+    rank[order] = np.arange(len(order))
+    label_strs = [u.decode(encoding) for u in uniq[order]]
+    ## one idx:count pair per colon
+    colons = np.flatnonzero(buf == 58)
+    lens = np.diff(np.append(np.searchsorted(colons, starts), len(colons)))
+    nums = _parse_numbers(body.tobytes())
+    if len(nums) != 2 * lens.sum():
+        raise Exception("Malformed sparse vector data (expected {} idx:count pairs)".format(lens.sum()))
+    return label_strs, rank[inverse], lens, nums[0::2].astype('int64'), nums[1::2]
+
+
+def _parse_sp_vec_range(sp_file, start, end, encoding='utf-8'):
+    with io.open(sp_file, 'rb') as fp:
+        fp.seek(start)
+        block = fp.read(end - start)
+    return _parse_sp_vec_block(block, encoding)
+
+
+def parse_sp_vec_file(sp_file, encoding='utf-8', n_workers=1, block_size=(1 << 24)):
+    """
+    Parse a file in sparse vector format in blocks of roughly `block_size` bytes using vectorized
+    conversion of labels, term ids and counts. With `n_workers` > 1 the blocks are parsed in worker processes.
+    Parsing makes a fixed number of NumPy passes over each block, so it is about 5x faster than splitting lines
+    in Python (less when rows must be re-sorted by term id) but remains bound by memory traffic; binary CSR files
+    (see `tmnt.utils.csr_file`) avoid parsing altogether.
+
+    Returns
+    -------
+    label_strs: list of distinct label strings in order of first occurrence
+    label_ids: array indexing `label_strs` for each document
+    csr: scipy.sparse.csr_matrix with sorted indices (columns up to the largest term id)
+    """
+    n_ranges = max(n_workers, -(-os.path.getsize(sp_file) // block_size))
+    ranges = _get_line_aligned_ranges(sp_file, n_ranges)
+    if n_workers > 1:
+        with ProcessPoolExecutor(n_workers) as executor:
+            parsed = list(executor.map(_parse_sp_vec_range, *zip(*[(sp_file, s, e, encoding) for s, e in ranges])))
+    else:
+        parsed = [_parse_sp_vec_range(sp_file, s, e, encoding) for s, e in ranges]
+    label_idx = {}
+    label_ids = []
+    for p in parsed:
+        block_ids = np.array([label_idx.setdefault(l, len(label_idx)) for l in p[0]], dtype='int64')
+        label_ids.append(block_ids[p[1]])
+    label_ids = np.concatenate([np.zeros(0, dtype='int64')] + label_ids)
+    lens = np.concatenate([np.zeros(0, dtype='int64')] + [p[2] for p in parsed])
+    inds = np.concatenate([np.zeros(0, dtype='int64')] + [p[3] for p in parsed])
+    vs = np.concatenate([np.zeros(0)] + [p[4] for p in parsed])
+    indptrs = np.concatenate([[0], np.cumsum(lens)])
+    n_cols = int(inds.max()) + 1 if len(inds) > 0 else 0
+    csr = sp.csr_matrix((vs, inds, indptrs), shape=(len(lens), n_cols))
+    if not csr.has_sorted_indices:
+        csr.sort_indices()
+    return list(label_idx.keys()), label_ids, csr
+
+
+def map_labels(label_strs, label_ids, label_map=None, scalar_labels=False):
+    """
+    Map label strings to label values as done by `file_to_sp_vec`: floats for scalar labels, or integer ids
+    assigned in order of first occurrence (or looked up in `label_map` with -1 for unknown labels).
+    `label_ids` indexes `label_strs` for each document.
+    """
     lm = label_map if label_map and not scalar_labels else {}
-    with io.open(sp_file, 'r', encoding=encoding) as fp:
-        for line in fp:
-            els = line.split(' ')            
-            lstr = els[0]
-            if scalar_labels:
-                label = float(lstr)
-            else:
-                try:
-                    label = lm[lstr]
-                except KeyError:
-                    if label_map is None:
-                        label = len(lm)
-                        lm[lstr] = label
-                    else:
-                        label = -1
-            ndocs += 1
-            els_sp = list(map(lambda e: e.split(':'), els[1:]))
-            n_pairs, inds, vs = get_single_vec(els_sp)
-            cumulative += n_pairs
-            total_num_words += sum(vs)
-            labels.append(label)
-            indptrs.append(cumulative)
-            values.extend(vs)
-            indices.extend(inds)
-    csr_mat = mx.nd.sparse.csr_matrix((values, indices, indptrs), shape = (ndocs, voc_size))
+    if scalar_labels:
+        label_values = np.array([float(l) for l in label_strs], dtype='float64')
+    elif label_map is None:
+        lm = dict((l, i) for i, l in enumerate(label_strs))
+        label_values = np.arange(len(label_strs), dtype='int64')
+    else:
+        label_values = np.array([lm.get(l, -1) for l in label_strs], dtype='int64')
+    labels = label_values[label_ids] if len(label_strs) > 0 else np.zeros(len(label_ids))
     lm = None if len(lm) < 1 else lm
-    return csr_mat, total_num_words, labels, lm
+    return labels, lm
+
+
+def csr_file_to_sp_vec(sp_file, voc_size, label_map=None, scalar_labels=False, mmap=False):
+    """
+    Load a binary CSR file (see `tmnt.utils.csr_file`) with the same outputs as `file_to_sp_vec`.
+    The arrays are memory-mapped and copied directly into the resulting `CSRNDArray`. With `mmap`, no copy is
+    made: the matrix is returned as a read-only `scipy.sparse.csr_matrix` over the mapped arrays, so processes
+    loading the same file share its pages.
+    """
+    arrays, header = load_csr_file(sp_file)
+    n_docs, n_cols = header['shape']
+    if n_cols != voc_size:
+        raise Exception("Binary CSR file {} has {} columns but vocabulary has {} items".format(sp_file, n_cols, voc_size))
+    labels, lm = map_labels(header['label_strs'], arrays['labels'], label_map, scalar_labels)
+    if mmap:
+        ## assign the arrays directly as the constructor would copy the indices to downcast them
+        csr_mat = sp.csr_matrix((n_docs, voc_size), dtype=arrays['data'].dtype)
+        csr_mat.data, csr_mat.indices, csr_mat.indptr = arrays['data'], arrays['indices'], arrays['indptr']
+    else:
+        csr_mat = mx.nd.sparse.csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']), shape = (n_docs, voc_size))
+    return csr_mat, header['total_words'], labels, lm
+
+
+def check_sp_file_vocab(sp_file, vocab):
+    """
+    Raise an exception if `sp_file` is a binary CSR file that was written against a different vocabulary.
+    """
+    if is_csr_file(sp_file):
+        _, header = load_csr_file(sp_file)
+        if header.get('vocab_hash') and header['vocab_hash'] != vocab_hash(vocab.idx_to_token):
+            raise Exception("Binary CSR file {} was not created with the provided vocabulary".format(sp_file))
+
+
+def file_to_sp_vec(sp_file, voc_size, label_map=None, scalar_labels=False, encoding='utf-8', n_workers=1, mmap=False):
+    if is_csr_file(sp_file):
+        return csr_file_to_sp_vec(sp_file, voc_size, label_map=label_map, scalar_labels=scalar_labels, mmap=mmap)
+    label_strs, label_ids, sp_mat = parse_sp_vec_file(sp_file, encoding=encoding, n_workers=n_workers)
+    labels, lm = map_labels(label_strs, label_ids, label_map, scalar_labels)
+    csr_mat = mx.nd.sparse.csr_matrix((sp_mat.data, sp_mat.indices, sp_mat.indptr), shape = (sp_mat.shape[0], voc_size),
+                                      dtype='float32')
+    return csr_mat, float(sp_mat.data.sum()), labels, lm
 
 
 def normalize_scalar_values(scalars):
     return (scalars - scalars.min()) / (scalars.max() - scalars.min())
 
 
-def collect_sparse_data(sp_vec_file, vocab_file, sp_vec_test_file=None, scalar_labels=False, encoding='utf-8'):
+def collect_sparse_data(sp_vec_file, vocab_file, sp_vec_test_file=None, scalar_labels=False, encoding='utf-8', mmap=False):
     vocab = load_vocab(vocab_file, encoding=encoding)
-    tr_mat, total_tr, tr_labels_li, label_map = file_to_sp_vec(sp_vec_file, len(vocab), scalar_labels=scalar_labels, encoding=encoding)
+    check_sp_file_vocab(sp_vec_file, vocab)
+    tr_mat, total_tr, tr_labels_li, label_map = file_to_sp_vec(sp_vec_file, len(vocab), scalar_labels=scalar_labels, encoding=encoding,
+                                                               mmap=mmap)
     dt = 'float32' if scalar_labels else 'int'
     tr_labels = mx.nd.array(tr_labels_li, dtype=dt)
     if scalar_labels:
@@ -216,13 +526,276 @@ def collect_sparse_data(sp_vec_file, vocab_file, sp_vec_test_file=None, scalar_l
     return vocab, tr_mat, total_tr, tr_labels, label_map
     
 
-def collect_sparse_test(sp_vec_file, vocab, scalar_labels=False, label_map=None, encoding='utf-8'):
+def collect_sparse_test(sp_vec_file, vocab, scalar_labels=False, label_map=None, encoding='utf-8', mmap=False):
     keep_sp_sparse = True
+    check_sp_file_vocab(sp_vec_file, vocab)
     tst_mat_sp, total_tst, tst_labels_li, _ = \
-        file_to_sp_vec(sp_vec_file, len(vocab), label_map=label_map, scalar_labels=scalar_labels, encoding=encoding)
+        file_to_sp_vec(sp_vec_file, len(vocab), label_map=label_map, scalar_labels=scalar_labels, encoding=encoding, mmap=mmap)
     tst_mat = tst_mat_sp if keep_sp_sparse else tst_mat_sp.tostype('default')
     dt = 'float32' if scalar_labels else 'int'    
     tst_labels = mx.nd.array(tst_labels_li, dtype=dt)
     if scalar_labels:
         tst_labels = normalize_scalar_values(tst_labels)
     return tst_mat, total_tst, tst_labels
+
+
+def iter_sp_vec_blocks(sp_file, n_cols, encoding='utf-8', block_size=(1 << 24), block_docs=100000):
+    """
+    Iterate over a sparse vector file (text or binary CSR) in blocks without loading the whole file.
+    Yields tuples of (label_strs, label_ids, csr) where `csr` is a `scipy.sparse.csr_matrix` with sorted indices
+    and `n_cols` columns (with `n_cols` None: the columns of a binary file, or up to the largest term id in each
+    block of a text file).
+    """
+    if is_csr_file(sp_file):
+        arrays, header = load_csr_file(sp_file)
+        n_docs = header['shape'][0]
+        n_cols = header['shape'][1] if n_cols is None else n_cols
+        indptr = arrays['indptr']
+        for s in range(0, n_docs, block_docs):
+            e = min(s + block_docs, n_docs)
+            a, b = int(indptr[s]), int(indptr[e])
+            csr = sp.csr_matrix((np.array(arrays['data'][a:b]), np.array(arrays['indices'][a:b]),
+                                 np.array(indptr[s:e+1]) - a), shape=(e - s, n_cols))
+            yield header['label_strs'], np.array(arrays['labels'][s:e], dtype='int64'), csr
+    else:
+        n_ranges = -(-os.path.getsize(sp_file) // block_size)
+        for s, e in _get_line_aligned_ranges(sp_file, n_ranges):
+            label_strs, label_ids, lens, inds, vs = _parse_sp_vec_range(sp_file, s, e, encoding)
+            block_cols = (int(inds.max()) + 1 if len(inds) > 0 else 0) if n_cols is None else n_cols
+            csr = sp.csr_matrix((vs, inds, np.concatenate([[0], np.cumsum(lens)])), shape=(len(lens), block_cols))
+            if not csr.has_sorted_indices:
+                csr.sort_indices()
+            yield label_strs, label_ids, csr
+
+
+class ShardedCorpus(object):
+    """
+    A training corpus split into binary CSR shard files (see `shard_sp_vec_file`), described by a
+    `manifest.json` file in the shard directory.
+
+    Parameters
+    ----------
+    shard_dir : str directory holding the shards and manifest
+    mmap : bool (default False) memory-map shards (and the term frequencies) read-only rather than reading them
+        into memory, so that processes using the same shards share a single copy through the page cache
+    """
+    def __init__(self, shard_dir, mmap=False):
+        self.shard_dir = shard_dir
+        self.mmap = mmap
+        with io.open(os.path.join(shard_dir, 'manifest.json'), 'r', encoding='utf-8') as fp:
+            self.manifest = json.loads(fp.read())
+        self.shard_files = [os.path.join(shard_dir, f) for f in self.manifest['shards']]
+        self.shape = tuple(self.manifest['shape'])
+        self.total_words = self.manifest['total_words']
+        self.label_strs = self.manifest['label_strs']
+        self.scalar_range = self.manifest['scalar_range']
+        self.wd_freqs = np.load(os.path.join(shard_dir, 'wd_freqs.npy'), mmap_mode=('r' if mmap else None))
+
+    def get_label_map(self):
+        """
+        Label map over the training labels (in order of first occurrence) as returned by `collect_sparse_data`.
+        """
+        return dict((l, i) for i, l in enumerate(self.label_strs)) if self.label_strs else None
+
+    def load_shard(self, i, label_map=None, scalar_labels=False):
+        """
+        Load shard `i` (read into memory, or memory-mapped when `mmap` is set).
+
+        Returns
+        -------
+        arrays: dictionary with `indptr`, `indices` and `data` CSR arrays and `labels` (ids into `label_values`)
+        label_values: array of label values for the shard's distinct labels (normalized to [0, 1] over the whole
+            corpus for scalar labels)
+        """
+        arrays, header = load_csr_file(self.shard_files[i])
+        if not self.mmap:
+            arrays = dict((k, np.array(v)) for (k, v) in arrays.items())
+        label_strs = header['label_strs']
+        label_values, _ = map_labels(label_strs, np.arange(len(label_strs)), label_map, scalar_labels)
+        if scalar_labels and self.scalar_range:
+            lo, hi = self.scalar_range
+            label_values = (label_values - lo) / (hi - lo) if hi > lo else label_values - lo
+        return arrays, label_values
+
+
+def shard_sp_vec_file(sp_file, shard_dir, vocab, shard_size, encoding='utf-8', max_wd_sample_size=1000000, mmap=False):
+    """
+    Split a sparse vector file (text or binary CSR) into binary CSR shards of `shard_size` documents, streaming
+    through the file so that at most roughly one shard is held in memory. Existing shards are reused when
+    the manifest matches the source file, shard size and vocabulary. A lock file ensures only one process
+    writes the shards; other processes wait for it and then use the same shards.
+
+    Parameters
+    ----------
+    sp_file : str sparse vector file
+    shard_dir : str output directory for the shards
+    vocab : `gluonnlp.Vocab` vocabulary the file was created with
+    shard_size : int number of documents per shard
+    encoding : str (default 'utf-8')
+    max_wd_sample_size : int (default 1000000) number of leading documents used for the term frequencies (see `get_wd_freqs`)
+    mmap : bool (default False) memory-map the shards (see `ShardedCorpus`)
+
+    Returns
+    -------
+    `ShardedCorpus`
+    """
+    stat = os.stat(sp_file)
+    source = {'path': os.path.abspath(sp_file), 'size': stat.st_size, 'mtime': stat.st_mtime,
+              'shard_size': shard_size, 'vocab_hash': vocab_hash(vocab.idx_to_token)}
+    corpus = _get_existing_shards(shard_dir, source, mmap)
+    if corpus is not None:
+        logging.info("Reusing {} existing shards in {}".format(len(corpus.shard_files), shard_dir))
+        return corpus
+    if not os.path.exists(shard_dir):
+        os.makedirs(shard_dir, exist_ok=True)
+    lock_file = os.path.join(shard_dir, '.lock')
+    try:
+        lock = os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        logging.info("Waiting for another process to write shards to {} (remove {} if there is none)"
+                     .format(shard_dir, lock_file))
+        while os.path.exists(lock_file):
+            time.sleep(1.0)
+        corpus = _get_existing_shards(shard_dir, source, mmap)
+        if corpus is None:
+            raise Exception("Shards in {} were not completed by the process writing them".format(shard_dir))
+        return corpus
+    try:
+        _write_shards(sp_file, shard_dir, vocab, shard_size, source, encoding, max_wd_sample_size)
+    finally:
+        os.close(lock)
+        os.remove(lock_file)
+    return ShardedCorpus(shard_dir, mmap=mmap)
+
+
+def _get_existing_shards(shard_dir, source, mmap=False):
+    if os.path.exists(os.path.join(shard_dir, 'manifest.json')):
+        corpus = ShardedCorpus(shard_dir, mmap=mmap)
+        if corpus.manifest.get('source') == source:
+            return corpus
+    return None
+
+
+def _write_shards(sp_file, shard_dir, vocab, shard_size, source, encoding, max_wd_sample_size):
+    manifest_file = os.path.join(shard_dir, 'manifest.json')
+    n_cols = len(vocab)
+    v_hash = source['vocab_hash']
+    label_idx = {}
+    shards = []
+    pending = []
+    n_docs = 0
+    total_words = 0.0
+    wd_freqs = np.zeros(n_cols)
+
+    def write_shard(csr, label_ids):
+        name = 'shard_{:05d}.csr'.format(len(shards))
+        write_csr_file(os.path.join(shard_dir, name), csr, list(label_idx.keys()), label_ids, v_hash=v_hash)
+        shards.append(name)
+
+    for label_strs, label_ids, csr in iter_sp_vec_blocks(sp_file, n_cols, encoding=encoding):
+        if csr.shape[0] == 0:
+            continue
+        block_ids = np.array([label_idx.setdefault(l, len(label_idx)) for l in label_strs], dtype='int64')
+        if n_docs < max_wd_sample_size:
+            wd_freqs += np.asarray(csr[:max_wd_sample_size - n_docs].sum(axis=0)).ravel()
+        n_docs += csr.shape[0]
+        total_words += float(csr.data.sum())
+        pending.append((csr, block_ids[label_ids]))
+        while sum(p[0].shape[0] for p in pending) >= shard_size:
+            csr_all = sp.vstack([p[0] for p in pending], format='csr')
+            ids_all = np.concatenate([p[1] for p in pending])
+            write_shard(csr_all[:shard_size], ids_all[:shard_size])
+            pending = [(csr_all[shard_size:], ids_all[shard_size:])]
+    if pending and sum(p[0].shape[0] for p in pending) > 0:
+        write_shard(sp.vstack([p[0] for p in pending], format='csr'), np.concatenate([p[1] for p in pending]))
+    label_strs = list(label_idx.keys())
+    try:
+        scalars = [float(l) for l in label_strs]
+        scalar_range = [min(scalars), max(scalars)] if scalars else None
+    except ValueError:
+        scalar_range = None
+    np.save(os.path.join(shard_dir, 'wd_freqs.npy'), wd_freqs)
+    manifest = {'source': source, 'shards': shards, 'shape': [n_docs, n_cols], 'total_words': total_words,
+                'label_strs': label_strs, 'scalar_range': scalar_range}
+    with io.open(manifest_file + '.tmp', 'w', encoding='utf-8') as fp:
+        fp.write(json.dumps(manifest))
+    os.replace(manifest_file + '.tmp', manifest_file)
+    logging.info("Wrote {} documents to {} shards in {}".format(n_docs, len(shards), shard_dir))
+
+
+class ShardedDataLoader():
+    """
+    Streams shuffled minibatches from a `ShardedCorpus` without holding the whole corpus in memory.
+    Each epoch visits the shards in a new random order; at most `max_resident_shards` shards are loaded at
+    once and their documents (in random order) are interleaved into a shuffle buffer of `shuffle_buffer`
+    documents from which batches are drawn at random. As with `DataIterLoader` over an `NDArrayIter` with
+    `last_batch_handle='discard'`, an incomplete final batch is dropped.
+
+    Parameters
+    ----------
+    corpus : `ShardedCorpus`
+    batch_size : int
+    label_map : dict (default None) map from label strings to label ids
+    scalar_labels : bool (default False) labels are scalar values
+    use_labels : bool (default True) return labels with each batch (otherwise the label is None)
+    shuffle_buffer : int (default 10000) number of documents in the shuffle buffer
+    max_resident_shards : int (default 2) maximum number of shards loaded in memory
+    """
+    def __init__(self, corpus, batch_size, label_map=None, scalar_labels=False, use_labels=True,
+                 shuffle_buffer=10000, max_resident_shards=2):
+        self.corpus = corpus
+        self.batch_size = batch_size
+        self.label_map = label_map
+        self.scalar_labels = scalar_labels
+        self.use_labels = use_labels
+        self.shuffle_buffer = max(shuffle_buffer, batch_size)
+        self.max_resident_shards = max(max_resident_shards, 1)
+
+    def _iter_docs(self):
+        """Yield (indices, counts, label) for each document, interleaving the resident shards."""
+        shard_order = list(np.random.permutation(len(self.corpus.shard_files)))
+        resident = []
+        while shard_order or resident:
+            while shard_order and len(resident) < self.max_resident_shards:
+                arrays, label_values = self.corpus.load_shard(shard_order.pop(0), self.label_map, self.scalar_labels)
+                resident.append([arrays, label_values, np.random.permutation(len(arrays['labels'])), 0])
+            ## draw a run of documents from one of the resident shards
+            j = np.random.randint(len(resident))
+            arrays, label_values, perm, pos = resident[j]
+            indptr, indices, data, labels = arrays['indptr'], arrays['indices'], arrays['data'], arrays['labels']
+            for r in perm[pos:pos + 64]:
+                s, e = indptr[r], indptr[r+1]
+                ## copies, so buffered documents do not keep an exhausted shard in memory
+                yield np.array(indices[s:e]), np.array(data[s:e]), label_values[labels[r]]
+            resident[j][3] = pos + 64
+            if pos + 64 >= len(perm):
+                del resident[j]
+
+    def _make_batch(self, docs):
+        lens = np.array([len(d[0]) for d in docs], dtype='int64')
+        indptr = np.concatenate([[0], np.cumsum(lens)])
+        indices = np.concatenate([d[0] for d in docs])
+        values = np.concatenate([d[1] for d in docs])
+        data = mx.nd.sparse.csr_matrix((values, indices, indptr), shape=(len(docs), self.corpus.shape[1]), dtype='float32')
+        if not self.use_labels:
+            return data, None
+        return data, mx.nd.array([d[2] for d in docs], dtype='float32')
+
+    def __iter__(self):
+        buffer = []
+        batch = []
+        for doc in self._iter_docs():
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(doc)
+                continue
+            i = np.random.randint(len(buffer))
+            batch.append(buffer[i])
+            buffer[i] = doc
+            if len(batch) == self.batch_size:
+                yield self._make_batch(batch)
+                batch = []
+        for i in np.random.permutation(len(buffer)):
+            batch.append(buffer[i])
+            if len(batch) == self.batch_size:
+                yield self._make_batch(batch)
+                batch = []
@@ -4,15 +4,112 @@ Copyright (c) 2019 The MITRE Corporation.
 """
 
 import mxnet as mx
+import numpy as np
 from mxnet import gluon
 from mxnet.gluon import HybridBlock
 from tmnt.distributions import LogisticGaussianLatentDistribution
 from tmnt.distributions import GaussianLatentDistribution
 from tmnt.distributions import HyperSphericalLatentDistribution
 from tmnt.distributions import GaussianUnitVarLatentDistribution
+from tmnt.utils.mixed_precision import get_compute_dtype, is_low_precision
 import logging
 
-__all__ = ['BowNTM', 'MetaDataBowNTM']
+__all__ = ['BowNTM', 'MetaDataBowNTM', 'get_decoder_jacobian']
+
+
+def _get_param_dtype(block):
+    ## data type of the (first) parameter of `block`, e.g. bfloat16 for a decoder cast to low precision
+    params = list(block.collect_params().values())
+    return params[0].dtype if params else 'float32'
+
+
+def _decoder_jacobian_loop(decoder, n_latent, n_outputs, ctx):
+    z = mx.nd.ones(shape=(1, n_latent), ctx=ctx, dtype=_get_param_dtype(decoder))
+    jacobian = mx.nd.zeros(shape=(n_outputs, n_latent), ctx=ctx)
+    z.attach_grad()
+    for i in range(n_outputs):
+        with mx.autograd.record():
+            y = decoder(z)
+            yi = y[0][i]
+        yi.backward()
+        jacobian[i] = z.grad.astype('float32')
+    return jacobian
+
+
+def _decoder_jacobian_batched(decoder, n_latent, n_outputs, ctx, batch_size):
+    ## Row b of the batch is an independent copy of the latent point, so the gradient of
+    ## output (i + b) taken at row b is row (i + b) of the Jacobian
+    jacobian = mx.nd.zeros(shape=(n_outputs, n_latent), ctx=ctx)
+    dtype = _get_param_dtype(decoder)
+    for i in range(0, n_outputs, batch_size):
+        bs = min(batch_size, n_outputs - i)
+        z = mx.nd.ones(shape=(bs, n_latent), ctx=ctx, dtype=dtype)
+        z.attach_grad()
+        out_ids = mx.nd.arange(i, i + bs, ctx=ctx)
+        with mx.autograd.record():
+            y = decoder(z)
+            yi = mx.nd.pick(y, out_ids, axis=1)
+        yi.backward()
+        jacobian[i:i+bs] = z.grad.astype('float32')
+    return jacobian
+
+
+def get_decoder_jacobian(decoder, n_latent, n_outputs, ctx=mx.cpu(), method='auto', batch_size=None):
+    """
+    Jacobian (n_outputs x n_latent) of a decoder evaluated at a latent vector of all ones. The latent vector is
+    given the data type of the decoder's parameters (e.g. bfloat16) and the Jacobian is returned as float32.
+
+    Parameters
+    ----------
+    decoder : Block mapping inputs of shape (N, n_latent) to outputs of shape (N, n_outputs)
+    n_latent : int number of latent dimensions (i.e. number of topics)
+    n_outputs : int number of decoder outputs (i.e. vocabulary size)
+    ctx : context device (default is mx.cpu())
+    method : str (default 'auto') 'auto' reads the weight matrix directly for a linear `Dense` decoder and
+        otherwise uses 'batched'; 'batched' computes `batch_size` Jacobian rows with each backward pass;
+        'loop' runs one backward pass per output and is kept as a reference implementation
+    batch_size : int (default None) Jacobian rows per backward pass for 'batched'; by default chosen so that
+        each forward pass produces roughly 2^24 output values
+    """
+    if method == 'auto':
+        if isinstance(decoder, gluon.nn.Dense) and decoder.act is None:
+            return decoder.weight.data(ctx).astype('float32')
+        method = 'batched'
+    if method == 'batched':
+        if batch_size is None:
+            batch_size = max(1, min(n_outputs, (1 << 24) // max(1, n_outputs)))
+        return _decoder_jacobian_batched(decoder, n_latent, n_outputs, ctx, batch_size)
+    elif method == 'loop':
+        return _decoder_jacobian_loop(decoder, n_latent, n_outputs, ctx)
+    else:
+        raise Exception("Invalid Jacobian method ==> {}".format(method))
+
+
+class SparseInputEmbedding(HybridBlock):
+    """
+    First (embedding) layer for bag-of-words inputs: `activation(dot(data, weight) + bias)`.
+    The weight matrix has shape (in_units, units) so that CSR inputs are multiplied directly with `sparse.dot`
+    (no conversion to dense inputs) and only the rows for terms present in a batch receive gradients
+    (the gradient is stored as `row_sparse`).
+
+    Parameters
+    ----------
+    in_units : int input dimension (i.e. vocabulary size)
+    units : int output dimension (i.e. embedding size)
+    activation : str (default 'tanh')
+    """
+    def __init__(self, in_units, units, activation='tanh'):
+        super(SparseInputEmbedding, self).__init__()
+        self.in_units = in_units
+        self.units = units
+        self.act_type = activation
+        with self.name_scope():
+            self.weight = self.params.get('weight', shape=(in_units, units), grad_stype='row_sparse')
+            self.bias = self.params.get('bias', shape=(units,), init='zeros')
+
+    def hybrid_forward(self, F, data, weight, bias):
+        out = F.broadcast_add(F.sparse.dot(data, weight), F.expand_dims(bias, axis=0))
+        return F.Activation(out, act_type=self.act_type) if self.act_type else out
 
 
 class BowNTM(HybridBlock):
@@ -24,12 +121,23 @@ class BowNTM(HybridBlock):
     n_latent : int number of dimensions of the latent dimension (i.e. number of topics)
     gen_layers : int (default = 3) number of generator layers (after sample); size is the same as n_latent
     batch_size : int (default None) provided only at training time (or when model is Hybridized) - otherwise will be inferred
+    sparse_input : bool (default False) use a `SparseInputEmbedding` first layer that consumes CSR batches directly
+    recon_loss : str (default 'full') reconstruction objective: 'full' computes the softmax over the vocabulary;
+        'logsumexp' computes the same loss with a fused log-softmax (log-sum-exp) over the vocabulary, without the
+        softmax output or an element-wise log; 'sampled' (training only, without hybridization) evaluates the decoder only for the terms
+        of each document plus `n_neg_samples` candidate terms, estimating the normalizer from the candidates
+    n_neg_samples : int (default 1024) number of candidate terms per batch with `recon_loss='sampled'` (half the most
+        frequent terms, half sampled from the rest of the vocabulary)
+    dtype : str (default 'float32') data type ('float32', 'bfloat16' or 'float16') of the vocabulary-sized layers
+        (embedding and decoder); these are stored and computed in `dtype` while the encoder, latent distribution
+        and losses stay in float32. Low-precision models are trained with `MixedPrecisionTrainer`
     ctx : context device (default is mx.cpu())
     """
     def __init__(self, vocabulary, enc_dim, n_latent, embedding_size, fixed_embedding=False, latent_distrib='logistic_gaussian',
                  init_l1=0.0, coherence_reg_penalty=0.0, redundancy_reg_penalty=0.0,
                  kappa=100.0, alpha=1.0, target_sparsity = 0.0, batch_size=None, n_encoding_layers = 1, enc_dr=0.1,
-                 wd_freqs=None, seed_mat=None, n_covars=0, ctx=mx.cpu()):
+                 wd_freqs=None, seed_mat=None, n_covars=0, sparse_input=False, recon_loss='full', n_neg_samples=1024,
+                 dtype='float32', ctx=mx.cpu()):
         super(BowNTM, self).__init__()
         self.batch_size = batch_size
         self._orig_batch_size = batch_size
@@ -42,6 +150,15 @@ class BowNTM(HybridBlock):
         self.target_sparsity = target_sparsity
         self.vocabulary = vocabulary
         self.num_enc_layers = n_encoding_layers
+        self.sparse_input = sparse_input
+        if recon_loss not in ('full', 'logsumexp', 'sampled'):
+            raise Exception("Invalid reconstruction loss ==> {}".format(recon_loss))
+        self.recon_loss = recon_loss
+        self.n_neg_samples = n_neg_samples
+        self.dtype = dtype
+        self.compute_dtype = get_compute_dtype(dtype, ctx)
+        if sparse_input and is_low_precision(dtype):
+            raise Exception("Sparse input layers are only supported with float32 (dtype = {})".format(dtype))
         if vocabulary.embedding:
             assert vocabulary.embedding.idx_to_vec[0].size == embedding_size
         self.encoding_dims = [self.embedding_size + n_covars] + [enc_dim for _ in range(n_encoding_layers)]
@@ -53,14 +170,17 @@ class BowNTM(HybridBlock):
             ## Add in topic seed constraints
             self.seed_matrix = seed_mat
             ## should be tanh here to avoid losing embedding information
-            self.embedding = gluon.nn.Dense(in_units=self.vocab_size, units=self.embedding_size, activation='tanh')
+            if sparse_input:
+                self.embedding = SparseInputEmbedding(self.vocab_size, self.embedding_size, activation='tanh')
+            else:
+                self.embedding = gluon.nn.Dense(in_units=self.vocab_size, units=self.embedding_size, activation='tanh')
             self.encoder = self._get_encoder(self.encoding_dims, dr=enc_dr)
             #self.encoder = gluon.nn.Dense(in_units=(self.embedding_size + n_covars),
             #                              units = enc_dim, activation='softrelu') ## just single FC layer 'encoder'
             if latent_distrib == 'logistic_gaussian':
                 self.latent_dist = LogisticGaussianLatentDistribution(n_latent, ctx, alpha=alpha)
             elif latent_distrib == 'vmf':
-                self.latent_dist = HyperSphericalLatentDistribution(n_latent, kappa=kappa, ctx=self.model_ctx)
+                self.latent_dist = HyperSphericalLatentDistribution(n_latent, kappa=kappa, dtype=dtype, ctx=self.model_ctx)
             elif latent_distrib == 'gaussian':
                 self.latent_dist = GaussianLatentDistribution(n_latent, ctx)
             elif latent_distrib == 'gaussian_unitvar':
@@ -74,7 +194,7 @@ class BowNTM(HybridBlock):
             emb = vocabulary.embedding.idx_to_vec.transpose()
             emb_norm_val = mx.nd.norm(emb, keepdims=True, axis=0) + 1e-10
             emb_norm = emb / emb_norm_val
-            self.embedding.weight.set_data(emb_norm)
+            self.embedding.weight.set_data(emb_norm.transpose() if sparse_input else emb_norm)
             if fixed_embedding:
                 self.embedding.collect_params().setattr('grad_req', 'null')
         ## Initialize and FIX decoder bias terms to corpus frequencies
@@ -86,7 +206,21 @@ class BowNTM(HybridBlock):
             bias_param.set_data(log_freq)
             bias_param.grad_req = 'null'
             self.out_bias = bias_param.data()
+        if is_low_precision(dtype):
+            self.embedding.cast(self.compute_dtype)
+            self.decoder.cast(self.compute_dtype)
+
 
+    def _to_compute_dtype(self, F, x):
+        """Cast the input `x` of a vocabulary-sized layer to the model's compute data type."""
+        if not is_low_precision(self.dtype):
+            return x
+        if F is mx.ndarray and x.stype != 'default':
+            x = x.tostype('default')
+        return F.amp_cast(x, dtype=self.compute_dtype)
+
+    def _to_float32(self, F, x):
+        return F.amp_cast(x, dtype='float32') if is_low_precision(self.dtype) else x
 
     def _get_encoder(self, dims, dr=0.1):
         encoder = gluon.nn.HybridSequential()
@@ -96,21 +230,14 @@ class BowNTM(HybridBlock):
                 encoder.add(gluon.nn.Dropout(dr))
         return encoder
 
-    def get_top_k_terms(self, k):
+    def get_top_k_terms(self, k, method='auto'):
         """
         Returns the top K terms for each topic based on sensitivity analysis. Terms whose 
         probability increases the most for a unit increase in a given topic score/probability
         are those most associated with the topic.
+        See `get_decoder_jacobian` for the available `method` values.
         """
-        z = mx.nd.ones(shape=(1, self.n_latent), ctx=self.model_ctx)
-        jacobian = mx.nd.zeros(shape=(self.vocab_size, self.n_latent), ctx=self.model_ctx)
-        z.attach_grad()        
-        for i in range(self.vocab_size):
-            with mx.autograd.record():
-                y = self.decoder(z)
-                yi = y[0][i]
-            yi.backward()
-            jacobian[i] = z.grad
+        jacobian = get_decoder_jacobian(self.decoder, self.n_latent, self.vocab_size, ctx=self.model_ctx, method=method)
         sorted_j = jacobian.argsort(axis=0, is_ascend=False)
         return sorted_j
 
@@ -118,13 +245,15 @@ class BowNTM(HybridBlock):
         """
         Encode data to the mean of the latent distribution defined by the input `data`
         """
-        return self.latent_dist.mu_encoder(self.encoder(self.embedding(data)))
+        emb_out = self._to_float32(mx.nd, self.embedding(self._to_compute_dtype(mx.nd, data)))
+        return self.latent_dist.mu_encoder(self.encoder(emb_out))
     
     def get_l1_penalty_term(self, F, l1_pen_const, batch_size):
         if F is mx.ndarray:
             dec_weights = self.decoder.params.get('weight').data()
         else:
             dec_weights = self.decoder.params.get('weight').var()
+        dec_weights = self._to_float32(F, dec_weights)
         return l1_pen_const * F.sum(F.abs(dec_weights))
 
     def add_coherence_reg_penalty(self, F, cur_loss):
@@ -135,6 +264,9 @@ class BowNTM(HybridBlock):
             else:
                 w = self.decoder.params.get('weight').var()
                 emb = self.embedding.params.get('weight').var()
+            if self.sparse_input:
+                emb = F.transpose(emb) ## regularizer expects (D x V)
+            w, emb = self._to_float32(F, w), self._to_float32(F, emb)
             c, d = self.coherence_regularization(w, emb)
             return (cur_loss + c + d), c, d
         else:
@@ -149,6 +281,7 @@ class BowNTM(HybridBlock):
                 w = self.decoder.params.get('weight').data()
             else:
                 w = self.decoder.params.get('weight').var()
+            w = self._to_float32(F, w)
             ts = F.take(w, self.seed_matrix)   ## should have shape (G, S, K)
             ts_sums = F.sum(ts, axis=1) # now (G, K)
             ts_probs = F.softmax(ts_sums, axis=1)
@@ -172,10 +305,107 @@ class BowNTM(HybridBlock):
         enc_out = self.encoder(in_data)
         return self.latent_dist(enc_out, batch_size)
 
-    def get_loss_terms(self, F, data, y, KL, l1_pen_const, batch_size):
+    def get_recon_loss(self, F, data, z, cov_dec_out=None):
+        """
+        Reconstruction loss (negative log-likelihood of the document terms) for the latent codes `z`, using
+        the model's `recon_loss` objective. `cov_dec_out` holds additional decoder scores (e.g. from covariates).
+
+        Returns
+        -------
+        recon_loss: per-document reconstruction loss
+        y: softmax over the vocabulary; with 'logsumexp' or 'sampled' it is only computed outside of (imperative)
+            training and is None while training
+        """
+        if self.recon_loss == 'sampled' and F is mx.ndarray and mx.autograd.is_training():
+            return self._get_sampled_recon_loss(data, z, cov_dec_out), None
+        dec_out = self._to_float32(F, self.decoder(self._to_compute_dtype(F, z)))
+        if cov_dec_out is not None:
+            dec_out = dec_out + cov_dec_out
+        if self.recon_loss == 'full':
+            y = F.softmax(dec_out, axis=1)
+            rr = data * F.log(y+1e-12)
+            return -F.sparse.sum( rr, axis=1 ), y
+        ## fused log-softmax: avoids the softmax output and the element-wise log over the vocabulary
+        log_y = F.log_softmax(dec_out, axis=1)
+        y = None if F is mx.ndarray and mx.autograd.is_training() else F.exp(log_y)
+        return -F.sparse.sum(data * log_y, axis=1), y
+
+    def _get_candidate_scores(self, z, cand_ids, cov_dec_out=None):
+        """Decoder scores (documents x candidates) for the terms `cand_ids`."""
+        w = self.decoder.params.get('weight').data()
+        b = self.decoder.params.get('bias').data()
+        scores = mx.nd.FullyConnected(self._to_compute_dtype(mx.nd, z), mx.nd.take(w, cand_ids), mx.nd.take(b, cand_ids),
+                                      num_hidden=cand_ids.shape[0])
+        scores = self._to_float32(mx.nd, scores)
+        if cov_dec_out is not None:
+            scores = scores + mx.nd.take(cov_dec_out, cand_ids, axis=1)
+        return scores
+
+    def _get_absent_mask(self, data, cand_ids):
+        """(documents x candidates) indicator of the (sorted, distinct) candidate terms absent from each document."""
+        n_cands = cand_ids.shape[0]
+        select = mx.nd.sparse.row_sparse_array((mx.nd.eye(n_cands, ctx=cand_ids.context), cand_ids.astype('int64')),
+                                               shape=(self.vocab_size, n_cands), ctx=cand_ids.context)
+        return mx.nd.sparse.dot(data, select) == 0
+
+    def _get_sampled_recon_loss(self, data, z, cov_dec_out=None):
+        """
+        Reconstruction loss with the normalizer over the vocabulary estimated per document. The terms of the document
+        are scored exactly. Of the `n_neg_samples` other candidate terms, half are the terms with the largest decoder
+        bias (i.e. the most frequent terms, which dominate the normalizer) and are also counted exactly; the other
+        half are drawn uniformly (without replacement) from the remaining vocabulary and stand in for the rest of it.
+        All arrays have static shapes and the candidates are drawn on the device, so the loss is computed without
+        synchronizing with the host.
+        """
+        ctx = z.context
+        if data.stype != 'csr':
+            data = data.tostype('csr')
+        n_docs, n_entries = data.shape[0], data.indices.shape[0]
+        n_cands = min(self.n_neg_samples, self.vocab_size)
+        n_head = n_cands if n_cands == self.vocab_size else n_cands // 2
+        n_tail = n_cands - n_head
+        ## (documents x entries) pattern matrix to sum per-entry values by document
+        pattern = mx.nd.sparse.csr_matrix((mx.nd.ones(n_entries, ctx=ctx), mx.nd.arange(n_entries, ctx=ctx, dtype='int64'),
+                                           data.indptr), shape=(n_docs, n_entries), ctx=ctx)
+        def doc_sum(x):
+            return mx.nd.sparse.dot(pattern, x.reshape((-1, 1))).reshape((-1,))
+        doc_ids = mx.nd.sparse.dot(pattern, mx.nd.arange(n_docs, ctx=ctx).reshape((n_docs, 1)), transpose_a=True)
+        doc_ids = doc_ids.tostype('default').reshape((-1,))
+        ## scores of the document terms (one per non-zero entry)
+        w = self.decoder.params.get('weight').data()
+        b = self.decoder.params.get('bias').data()
+        term_scores = mx.nd.sum(mx.nd.take(z, doc_ids) * self._to_float32(mx.nd, mx.nd.take(w, data.indices)), axis=1) + \
+                      self._to_float32(mx.nd, mx.nd.take(b, data.indices))
+        if cov_dec_out is not None:
+            term_scores = term_scores + mx.nd.gather_nd(cov_dec_out, mx.nd.stack(doc_ids, data.indices.astype('float32')))
+        n_terms = doc_sum(mx.nd.ones(n_entries, ctx=ctx))
+        ## candidate terms: the head is fixed for a given bias, the tail is sampled
+        with mx.autograd.pause():
+            head_ids = mx.nd.sort(mx.nd.topk(self._to_float32(mx.nd, b), k=n_head, ret_typ='indices'))
+            if n_tail > 0:
+                in_head = mx.nd.scatter_nd(mx.nd.ones(n_head, ctx=ctx), head_ids.reshape((1, -1)), shape=(self.vocab_size,))
+                keys = mx.nd.random.uniform(shape=(self.vocab_size,), ctx=ctx) - 2 * in_head
+                tail_ids = mx.nd.sort(mx.nd.topk(keys, k=n_tail, ret_typ='indices'))
+        head_scores = self._get_candidate_scores(z, head_ids, cov_dec_out)
+        head_absent = self._get_absent_mask(data, head_ids)
+        ## per-document shift keeping the exponentials in range
+        shift = mx.nd.maximum(mx.nd.max(head_scores, axis=1), doc_sum(term_scores) / mx.nd.maximum(n_terms, 1))
+        shift = mx.nd.stop_gradient(shift)
+        norm = doc_sum(mx.nd.exp(term_scores - mx.nd.take(shift, doc_ids))) + \
+               mx.nd.sum(mx.nd.exp(mx.nd.broadcast_sub(head_scores, shift.expand_dims(1))) * head_absent, axis=1)
+        if n_tail > 0:
+            tail_scores = self._get_candidate_scores(z, tail_ids, cov_dec_out)
+            tail_absent = self._get_absent_mask(data, tail_ids)
+            ## each absent sampled term stands in for an equal share of the absent terms outside the head
+            n_rest = (self.vocab_size - n_head) - (n_terms - (n_head - mx.nd.sum(head_absent, axis=1)))
+            tail_wts = n_rest / mx.nd.maximum(mx.nd.sum(tail_absent, axis=1), 1)
+            norm = norm + tail_wts * mx.nd.sum(mx.nd.exp(mx.nd.broadcast_sub(tail_scores, shift.expand_dims(1))) * tail_absent,
+                                               axis=1)
+        log_norm = shift + mx.nd.log(norm)
+        return doc_sum(data.data) * log_norm - doc_sum(data.data * term_scores)
+
+    def get_loss_terms(self, F, recon_loss, KL, l1_pen_const, batch_size):
         l1_pen = self.get_l1_penalty_term(F, l1_pen_const, batch_size)
-        rr = data * F.log(y+1e-12)
-        recon_loss = -F.sparse.sum( rr, axis=1 )
         i_loss = F.broadcast_plus(recon_loss, F.broadcast_plus(l1_pen, KL))
         ii_loss, coherence_loss, redundancy_loss = self.add_coherence_reg_penalty(F, i_loss)
         iii_loss, entropies = self.add_seed_constraint_loss(F, ii_loss)
@@ -183,12 +413,11 @@ class BowNTM(HybridBlock):
 
     def hybrid_forward(self, F, data, l1_pen_const=None):
         batch_size = data.shape[0] if F is mx.ndarray else self.batch_size
-        emb_out = self.embedding(data)
+        emb_out = self._to_float32(F, self.embedding(self._to_compute_dtype(F, data)))
         z, KL = self.run_encode(F, emb_out, batch_size)
-        dec_out = self.decoder(z)
-        y = F.softmax(dec_out, axis=1)
+        recon_loss, y = self.get_recon_loss(F, data, z)
         iii_loss, recon_loss, l1_pen, entropies, coherence_loss, redundancy_loss = \
-            self.get_loss_terms(F, data, y, KL, l1_pen_const, batch_size)
+            self.get_loss_terms(F, recon_loss, KL, l1_pen_const, batch_size)
         return iii_loss, KL, recon_loss, l1_pen, entropies, coherence_loss, redundancy_loss, y
 
 
@@ -198,11 +427,17 @@ class MetaDataBowNTM(BowNTM):
                  fixed_embedding=False, latent_distrib='logistic_gaussian',
                  init_l1=0.0, coherence_reg_penalty=0.0, redundancy_reg_penalty=0.0, kappa=100.0, alpha=1.0,
                  batch_size=None, n_encoding_layers=1,
-                 enc_dr=0.1, wd_freqs=None, seed_mat=None, covar_net_layers=1, ctx=mx.cpu()):
-        super(MetaDataBowNTM, self).__init__(vocabulary, enc_dim, n_latent, embedding_size, fixed_embedding,
-                                             latent_distrib, init_l1,
-                                             coherence_reg_penalty, kappa, alpha, 0.0, batch_size, n_encoding_layers, enc_dr,
-                                             wd_freqs, seed_mat, n_covars, ctx)
+                 enc_dr=0.1, wd_freqs=None, seed_mat=None, covar_net_layers=1, sparse_input=False, recon_loss='full',
+                 n_neg_samples=1024, dtype='float32', ctx=mx.cpu()):
+        ## arguments are passed by keyword so that they cannot shift against the BowNTM signature
+        super(MetaDataBowNTM, self).__init__(vocabulary, enc_dim, n_latent, embedding_size,
+                                             fixed_embedding=fixed_embedding, latent_distrib=latent_distrib,
+                                             init_l1=init_l1, coherence_reg_penalty=coherence_reg_penalty,
+                                             redundancy_reg_penalty=redundancy_reg_penalty, kappa=kappa, alpha=alpha,
+                                             target_sparsity=0.0, batch_size=batch_size,
+                                             n_encoding_layers=n_encoding_layers, enc_dr=enc_dr, wd_freqs=wd_freqs,
+                                             seed_mat=seed_mat, n_covars=n_covars, sparse_input=sparse_input,
+                                             recon_loss=recon_loss, n_neg_samples=n_neg_samples, dtype=dtype, ctx=ctx)
         self.n_covars = n_covars
         self.label_map = l_map
         self.covar_net_layers = covar_net_layers
@@ -213,13 +448,15 @@ class MetaDataBowNTM(BowNTM):
             else:
                 self.cov_decoder = CovariateModel(self.n_latent, self.n_covars, self.vocab_size,
                                                   batch_size=self.batch_size, interactions=True, ctx=ctx)
+        if is_low_precision(dtype):
+            self.cov_decoder.cast(self.compute_dtype)
 
 
     def encode_data_with_covariates(self, data, covars):
         """
         Encode data to the mean of the latent distribution defined by the input `data`
         """
-        emb_out = self.embedding(data)
+        emb_out = self._to_float32(mx.nd, self.embedding(self._to_compute_dtype(mx.nd, data)))
         enc_out = self.encoder(mx.nd.concat(emb_out, covars))
         return self.latent_dist.mu_encoder(enc_out)
 
@@ -247,14 +484,15 @@ class MetaDataBowNTM(BowNTM):
 
     def hybrid_forward(self, F, data, covars, l1_pen_const=None):
         batch_size = data.shape[0] if F is mx.ndarray else self.batch_size
-        emb_out = self.embedding(data)
+        emb_out = self._to_float32(F, self.embedding(self._to_compute_dtype(F, data)))
         co_emb = F.concat(emb_out, covars)
         z, KL = self.run_encode(F, co_emb, batch_size)
-        dec_out = self.decoder(z)
-        cov_dec_out = self.cov_decoder(z, covars)
-        y = F.softmax(dec_out + cov_dec_out, axis=1)
+        ## with 'sampled', the covariate scores are still computed over the vocabulary and then restricted
+        ## to the candidate terms
+        cov_dec_out = self._to_float32(F, self.cov_decoder(self._to_compute_dtype(F, z), self._to_compute_dtype(F, covars)))
+        recon_loss, y = self.get_recon_loss(F, data, z, cov_dec_out)
         iii_loss, recon_loss, l1_pen, entropies, coherence_loss, redundancy_loss = \
-            self.get_loss_terms(F, data, y, KL, l1_pen_const, batch_size)
+            self.get_loss_terms(F, recon_loss, KL, l1_pen_const, batch_size)
         return iii_loss, KL, recon_loss, l1_pen, entropies, coherence_loss, redundancy_loss, y
 
         
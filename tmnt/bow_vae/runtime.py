@@ -9,16 +9,36 @@ import numpy as np
 import gluonnlp as nlp
 import io
 import os
+import weakref
+import scipy.sparse as sp
 from tmnt.bow_vae.bow_models import BowNTM, MetaDataBowNTM
-from tmnt.bow_vae.bow_doc_loader import collect_stream_as_sparse_matrix, DataIterLoader, BowDataSet, file_to_sp_vec
-from tmnt.preprocess.tokenizer import BasicTokenizer
-from multiprocessing import Pool
+from tmnt.bow_vae.bow_doc_loader import collect_stream_as_sparse_matrix, DataIterLoader, CSRBatchLoader, BowDataSet, file_to_sp_vec
+from tmnt.bow_vae.bow_doc_loader import iter_sp_vec_blocks, map_labels
+from tmnt.utils.csr_file import is_csr_file, load_csr_file
+from tmnt.preprocess.tokenizer import FastBasicTokenizer
+import multiprocessing
+
+
+def _count_sp_vec_docs(sp_file, block_size=(1 << 24)):
+    """
+    Number of documents in a sparse vector file (text or binary CSR).
+    """
+    if is_csr_file(sp_file):
+        return load_csr_file(sp_file)[1]['shape'][0]
+    n_docs = 0
+    last = b'\n'
+    with io.open(sp_file, 'rb') as fp:
+        for block in iter(lambda: fp.read(block_size), b''):
+            n_docs += block.count(b'\n')
+            last = block[-1:]
+    ## the last line may not end with a newline
+    return n_docs + (1 if last != b'\n' else 0)
 
 
 class BowNTMInference(object):
 
     def __init__(self, param_file=None, specs_file=None, vocab_file=None, model_dir=None, ctx=mx.cpu()):
-        self.max_batch_size = 2
+        self.max_batch_size = 1000
         if model_dir is not None:
             param_file = os.path.join(model_dir,'model.params')
             vocab_file = os.path.join(model_dir,'vocab.json')
@@ -37,6 +57,7 @@ class BowNTMInference(object):
         emb_size = specs['embedding_size']
         l1_tgt_sparsty = float(specs.get('target_sparsity', 0.0))
         coherence_reg_penalty = float(specs.get('coherence_regularizer_penalty', 0.0))
+        sparse_input = str(specs.get('sparse_input', False)) == 'True'
         if 'n_covars' in specs:
             self.covar_model = True
             self.n_covars = specs['n_covars']
@@ -46,20 +67,25 @@ class BowNTMInference(object):
             self.model = MetaDataBowNTM(self.label_map, self.n_covars,
                                         self.vocab, enc_dim, self.n_latent, emb_size, latent_distrib=lat_distrib,
                                         n_encoding_layers=n_encoding_layers, enc_dr=enc_dr,                                        
-                                        covar_net_layers = self.covar_net_layers, ctx=ctx)
+                                        covar_net_layers = self.covar_net_layers, sparse_input=sparse_input, ctx=ctx)
         else:
             self.covar_model = False
             self.model = BowNTM(self.vocab, enc_dim, self.n_latent, emb_size, latent_distrib=lat_distrib,
-                                n_encoding_layers=n_encoding_layers, enc_dr=enc_dr,
+                                n_encoding_layers=n_encoding_layers, enc_dr=enc_dr, sparse_input=sparse_input,
                                 ctx=ctx)
         self.model.load_parameters(str(param_file), allow_missing=False)
 
 
+    def _load_vec_file(self, sp_vec_file):
+        ## co-variate values are mapped with the model's label map (or read as scalars)
+        label_map = self.label_map if self.covar_model else None
+        scalar_labels = self.covar_model and not self.label_map
+        return file_to_sp_vec(sp_vec_file, len(self.vocab), label_map=label_map, scalar_labels=scalar_labels)
+
     def get_model_details(self, sp_vec_file):
-        data_csr, _, labels, _ = file_to_sp_vec(sp_vec_file, len(self.vocab))        
+        data_csr, _, labels, _ = self._load_vec_file(sp_vec_file)
         ## 1) K x W matrix of P(term|topic) probabilities
-        w = self.model.decoder.collect_params().get('weight').data().transpose() ## (K x W)
-        w_pr = mx.nd.softmax(w, axis=1)
+        w_pr = self.get_topic_term_probs()
         ## 2) D x K matrix over the test data of topic probabilities
         covars = labels if self.covar_model else None
         dt_matrix = self.encode_csr(data_csr, covars, use_probs=True)
@@ -71,10 +97,18 @@ class BowNTMInference(object):
         return w_pr, dt_matrix, doc_lengths, term_cnts
 
 
+    def get_topic_term_probs(self):
+        """
+        K x W matrix of P(term|topic) probabilities.
+        """
+        w = self.model.decoder.collect_params().get('weight').data().transpose() ## (K x W)
+        return mx.nd.softmax(w, axis=1)
+
+
     def get_pyldavis_details(self, sp_vec_file):
         w_pr, dt_matrix, doc_lengths, term_cnts = self.get_model_details(sp_vec_file)
         d1 = w_pr.asnumpy().tolist()
-        d2 = list(map(lambda x: x.asnumpy().tolist(), dt_matrix))
+        d2 = dt_matrix.tolist()
         d3 = doc_lengths.asnumpy().tolist()
         d5 = term_cnts.asnumpy().tolist()
         d4 = list(map(lambda i: self.vocab.idx_to_token[i], range(len(self.vocab.idx_to_token))))
@@ -88,6 +122,80 @@ class BowNTMInference(object):
             json.dump(d, fp, sort_keys=True, indent=4)        
 
 
+    def export_model_details_streaming(self, sp_vec_file, out_prefix, fmt='jsonl', batch_size=None,
+                                       block_docs=100000):
+        """
+        Export the same details as `export_full_model_inference_details` without holding the document-topic matrix
+        (or the whole corpus) in memory: the vector file is read and encoded in blocks of `block_docs` documents
+        and each block's rows are appended to the output. Each section is written to its own file:
+
+        - with `fmt='jsonl'`: `<out_prefix>.doc_topics.jsonl` (one line per document with its label, length and
+          topic probabilities), `<out_prefix>.topic_terms.jsonl` (one line per topic with P(term|topic) in vocabulary
+          order) and `<out_prefix>.terms.jsonl` (one line per vocabulary term with its corpus frequency)
+        - with `fmt='npy'`: `<out_prefix>.doc_topics.npy` (D x K, written through a memory map),
+          `<out_prefix>.doc_lengths.npy`, `<out_prefix>.topic_terms.npy` (K x W), `<out_prefix>.term_frequency.npy`
+          and `<out_prefix>.vocab.json`
+
+        Returns
+        -------
+        list of the files written
+        """
+        if fmt not in ('jsonl', 'npy'):
+            raise Exception("Invalid export format ==> {}".format(fmt))
+        n_cols = len(self.vocab)
+        label_map = self.label_map if self.covar_model else None
+        scalar_labels = self.covar_model and not self.label_map
+        term_cnts = np.zeros(n_cols, dtype='float64')
+        files = []
+        if fmt == 'npy':
+            n_docs = _count_sp_vec_docs(sp_vec_file)
+            dt_file, len_file = out_prefix + '.doc_topics.npy', out_prefix + '.doc_lengths.npy'
+            dt_matrix = np.lib.format.open_memmap(dt_file, mode='w+', dtype='float32', shape=(n_docs, self.n_latent))
+            doc_lengths = np.lib.format.open_memmap(len_file, mode='w+', dtype='float32', shape=(n_docs,))
+            files.extend([dt_file, len_file])
+        else:
+            dt_file = out_prefix + '.doc_topics.jsonl'
+            fp = io.open(dt_file, 'w', encoding='utf-8')
+            files.append(dt_file)
+        row = 0
+        try:
+            for label_strs, label_ids, csr in iter_sp_vec_blocks(sp_vec_file, n_cols, block_docs=block_docs):
+                labels, _ = map_labels(label_strs, label_ids, label_map, scalar_labels)
+                encs = self.encode_csr(csr, labels, use_probs=True, batch_size=batch_size)
+                lengths = np.asarray(csr.sum(axis=1)).ravel()
+                term_cnts += np.asarray(csr.sum(axis=0)).ravel()
+                if fmt == 'npy':
+                    dt_matrix[row:row + csr.shape[0]] = encs
+                    doc_lengths[row:row + csr.shape[0]] = lengths
+                else:
+                    fp.write(''.join(json.dumps({'label': label_strs[l], 'doc_length': float(n), 'doc_topic_dists': e}) + '\n'
+                                     for l, n, e in zip(label_ids, lengths, encs.tolist())))
+                row += csr.shape[0]
+        finally:
+            if fmt == 'npy':
+                dt_matrix.flush()
+                doc_lengths.flush()
+            else:
+                fp.close()
+        w_pr = self.get_topic_term_probs().asnumpy()
+        vocab = list(self.vocab.idx_to_token)
+        if fmt == 'npy':
+            for name, arr in [('topic_terms', w_pr), ('term_frequency', term_cnts)]:
+                np.save(out_prefix + '.' + name + '.npy', arr)
+                files.append(out_prefix + '.' + name + '.npy')
+            with io.open(out_prefix + '.vocab.json', 'w', encoding='utf-8') as vfp:
+                json.dump(vocab, vfp)
+            files.append(out_prefix + '.vocab.json')
+        else:
+            with io.open(out_prefix + '.topic_terms.jsonl', 'w', encoding='utf-8') as tfp:
+                for k in range(w_pr.shape[0]):
+                    tfp.write(json.dumps({'topic': k, 'topic_term_dists': w_pr[k].tolist()}) + '\n')
+            with io.open(out_prefix + '.terms.jsonl', 'w', encoding='utf-8') as tfp:
+                tfp.write(''.join(json.dumps({'term': t, 'term_frequency': float(c)}) + '\n' for t, c in zip(vocab, term_cnts)))
+            files.extend([out_prefix + '.topic_terms.jsonl', out_prefix + '.terms.jsonl'])
+        return files
+
+
     def encode_texts(self, intexts):
         """
         intexts - should be a list of lists of tokens (each token list being a document)
@@ -97,45 +205,59 @@ class BowNTMInference(object):
         return self.encode_text_stream(strm)
 
     def encode_vec_file(self, sp_vec_file):
-        data_csr, _, labels, _ = file_to_sp_vec(sp_vec_file, len(self.vocab))
+        data_csr, _, labels, _ = self._load_vec_file(sp_vec_file)
         return self.encode_csr(data_csr, labels), labels
 
     def encode_text_stream(self, strm):
         csr, _, _ = collect_stream_as_sparse_matrix(strm, pre_vocab=self.vocab)
         return self.encode_csr(csr,None)
 
-    def encode_csr(self, csr, labels, use_probs=False):
-        batch_size = min(csr.shape[0], self.max_batch_size)
-        last_batch_size = csr.shape[0] % batch_size
-        covars = mx.nd.one_hot(mx.nd.array(labels, dtype='int'), self.n_covars) \
-            if self.covar_model and labels[:-last_batch_size] is not None else None
-        infer_iter = DataIterLoader(mx.io.NDArrayIter(csr[:-last_batch_size], covars,
-                                                      batch_size, last_batch_handle='discard', shuffle=False))
-        encodings = []
-        for _, (data,labels) in enumerate(infer_iter):
-            data = data.as_in_context(self.ctx)
-            if self.covar_model and labels is not None:
-                labels = labels.as_in_context(self.ctx)
-                encs = self.model.encode_data_with_covariates(data, labels)
-            else:
-                encs = self.model.encode_data(data)
-            if use_probs:
-                e1 = encs - mx.nd.min(encs, axis=1).expand_dims(1)
-                encs = mx.nd.softmax(e1 ** 0.5)
-            encodings.extend(encs)
-        ## handle the last batch explicitly as NDArrayIter doesn't do that for us
-        if last_batch_size > 0:
-            data = csr[-last_batch_size:].as_in_context(self.ctx)
-            if self.covar_model and labels is not None:
-                labels = mx.nd.one_hot(mx.nd.array(labels[-last_batch_size:], dtype='int'), self.n_covars).as_in_context(self.ctx)
-                encs = self.model.encode_data_with_covariates(data, labels)
+    def _get_covar_batch(self, covars):
+        covars = mx.nd.array(covars, ctx=self.ctx)
+        return mx.nd.one_hot(covars, self.n_covars) if self.label_map else covars.expand_dims(1)
+
+    def encode_csr(self, csr, labels, use_probs=False, batch_size=None, out_file=None):
+        """
+        Encode the documents (rows) of a document-term matrix `batch_size` documents at a time.
+
+        Parameters
+        ----------
+        csr : `CSRNDArray` or `scipy.sparse.csr_matrix` (N x V) matrix of term counts
+        labels : co-variate values (label ids or scalars) of the documents; only used with co-variate models
+        use_probs : bool (default False) convert topic scores into probabilities
+        batch_size : int (default `max_batch_size`) number of documents encoded at a time
+        out_file : str (default None) write the encodings to this `.npy` file through a memory map rather than
+            holding them in memory (for very large inputs)
+
+        Returns
+        -------
+        (N x K) float32 numpy array (a `numpy.memmap` with `out_file`) with the encoding of each document
+        """
+        if isinstance(csr, mx.nd.NDArray):
+            csr = csr.asscipy() if csr.stype == 'csr' else sp.csr_matrix(csr.asnumpy())
+        batch_size = batch_size or self.max_batch_size
+        n_docs = csr.shape[0]
+        if out_file:
+            encodings = np.lib.format.open_memmap(out_file, mode='w+', dtype='float32', shape=(n_docs, self.n_latent))
+        else:
+            encodings = np.empty((n_docs, self.n_latent), dtype='float32')
+        covars = None
+        if self.covar_model and labels is not None:
+            covars = labels.asnumpy() if isinstance(labels, mx.nd.NDArray) else np.asarray(labels)
+        for i in range(0, n_docs, batch_size):
+            batch = csr[i:i+batch_size]
+            data = mx.nd.sparse.csr_matrix((batch.data, batch.indices, batch.indptr), shape=batch.shape,
+                                           dtype='float32', ctx=self.ctx)
+            if covars is not None:
+                encs = self.model.encode_data_with_covariates(data, self._get_covar_batch(covars[i:i+batch_size]))
             else:
                 encs = self.model.encode_data(data)
             if use_probs:
-                #norm = mx.nd.norm(encs, axis=1, keepdims=True)
                 e1 = encs - mx.nd.min(encs, axis=1).expand_dims(1)
                 encs = mx.nd.softmax(e1 ** 0.5)
-            encodings.extend(encs)
+            encodings[i:i+batch.shape[0]] = encs.asnumpy()
+        if out_file:
+            encodings.flush()
         return encodings
 
     def get_top_k_words_per_topic(self, k):
@@ -184,58 +306,148 @@ class BowNTMInference(object):
         return self.encode_text_stream(dataset_strm)
         
 
+class _TokenIdMapper(object):
+    """
+    Tokenizes a text and maps its in-vocabulary tokens to an array of term ids.
+    """
+    def __init__(self, token_to_idx):
+        self.token_to_idx = token_to_idx
+        self.tokenizer = FastBasicTokenizer(do_lower_case=True, use_stop_words=False)
+
+    def __call__(self, txt):
+        return self._to_ids(self.tokenizer.tokenize(txt))
+
+    def map_batch(self, txts):
+        return [self._to_ids(toks) for toks in self.tokenizer.tokenize_batch(txts)]
+
+    def _to_ids(self, toks):
+        return np.array([self.token_to_idx[t] for t in toks if t in self.token_to_idx], dtype='int64')
+
+
+_worker_mapper = None
+
+def _init_mapper_worker(token_to_idx):
+    global _worker_mapper
+    _worker_mapper = _TokenIdMapper(token_to_idx)
+
+def _map_batch_in_worker(txts):
+    return _worker_mapper.map_batch(txts)
+
+
+def ids_to_csr(id_arrays, vocab_size):
+    """
+    Build a `scipy.sparse.csr_matrix` of term counts (one row per document) from per-document arrays of term ids.
+    """
+    lengths = np.array([len(ids) for ids in id_arrays], dtype='int64')
+    rows = np.repeat(np.arange(len(id_arrays), dtype='int64'), lengths)
+    cols = np.concatenate(id_arrays) if len(id_arrays) > 0 else np.zeros(0, dtype='int64')
+    ## duplicate (row, term) entries are summed into counts when converting to CSR
+    return sp.coo_matrix((np.ones(len(cols), dtype='float32'), (rows, cols)),
+                         shape=(len(id_arrays), vocab_size)).tocsr()
+
+
 class TextEncoder(object):
 
     """
     Takes a batch of text strings/documents and returns a matrix of their encodings (each row in the matrix
     corresponds to the encoding of the corresponding input text).
+    Texts are converted to term ids (in a pool of worker processes when `pool_size > 1`), gathered into a sparse
+    document-term matrix and encoded `batch_size` documents at a time. The worker pool is created on first use and
+    kept until `close` is called (or the encoder is used as a context manager and exits). Worker processes are
+    spawned rather than forked from the (MXNet) calling process; single texts are always processed in the
+    calling process.
 
     Parameters
     ----------
     inference - the inference object using the trained model
     use_probs - boolean that indicates whether raw topic scores should be converted to probabilities or not (default = True)
+    temp - float exponent applied to (shifted) topic scores when converting them to probabilities (default = 0.5)
     pool_size - integer that specifies the number of processes to use for concurrent text pre-processing
+        (default = number of CPUs; 1 processes texts in the calling process)
+    batch_size - integer number of documents encoded at a time (default = 1000)
     """
-    def __init__(self, inference, use_probs=True, temp=0.5):
+    def __init__(self, inference, use_probs=True, temp=0.5, pool_size=None, batch_size=1000):
+        self._pool     = None
         self.temp      = temp
         self.inference = inference
         self.use_probs = use_probs
+        self.pool_size = pool_size or multiprocessing.cpu_count()
+        self.batch_size = batch_size
         self.vocab_len = len(self.inference.vocab.idx_to_token)
-        self.tokenizer = BasicTokenizer(do_lower_case=True, use_stop_words=False)
+        self.mapper = _TokenIdMapper(self.inference.vocab.token_to_idx)
 
-    def _txt_to_vec(self, txt):
-        toks = self.tokenizer.tokenize(txt)
-        ids = [self.inference.vocab[token] for token in toks if token in self.inference.vocab]
-        return ids
+    def _get_pool(self):
+        if self._pool is None:
+            mp_ctx = multiprocessing.get_context('spawn')
+            self._pool = mp_ctx.Pool(self.pool_size, initializer=_init_mapper_worker,
+                                     initargs=(self.inference.vocab.token_to_idx,))
+            ## terminate the pool when the encoder is garbage collected or at interpreter exit
+            self._pool_finalizer = weakref.finalize(self, self._pool.terminate)
+        return self._pool
+
+    def close(self):
+        """
+        Shut down the worker pool (if one was started).
+        """
+        if self._pool is not None:
+            self._pool_finalizer()
+            self._pool.join()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _texts_to_ids(self, txts):
+        if self.pool_size > 1 and len(txts) > 1:
+            chunksize = max(1, -(-len(txts) // (4 * self.pool_size)))
+            chunks = [txts[i:i+chunksize] for i in range(0, len(txts), chunksize)]
+            return [ids for chunk_ids in self._get_pool().map(_map_batch_in_worker, chunks) for ids in chunk_ids]
+        return self.mapper.map_batch(txts)
+
+    def _to_probs(self, encs):
+        e1 = encs - mx.nd.min(encs, axis=1).expand_dims(1)
+        return mx.nd.softmax(e1 ** self.temp)
 
     def encode_single_string(self, txt):
-        data = mx.nd.zeros((1, self.vocab_len))
-        for t in self._txt_to_vec(txt):
-            data[0][t] += 1.0
-        encs = self.inference.model.encode_data(data)
-        if self.use_probs:
-            e1 = encs - mx.nd.min(encs, axis=1).expand_dims(1)
-            encs = mx.nd.softmax(e1 ** 0.5)
-        return encs
-
-    def encode_batch(self, txts, covars=None, pool_size=4):
-        pool = Pool(pool_size)
-        ids  = pool.map(self._txt_to_vec, txts)
-        # Prevent zombie threads from hanging around
-        pool.terminate()
-        pool = None
-        data = mx.nd.zeros((len(txts), self.vocab_len))
-        for i, txt_ids in enumerate(ids):
-            for t in txt_ids:
-                data[i][t] += 1.0
+        return self.encode_batch([txt])
+
+    def encode_batch(self, txts, covars=None, pool_size=None):
+        """
+        Encode a list of texts (with an optional list of covariate values, one per text).
+
+        Parameters
+        ----------
+        txts - list of text strings
+        covars - list of covariate values (for models with covariates)
+        pool_size - integer number of text pre-processing processes used for this and later calls; a size that
+            differs from the encoder's current `pool_size` replaces its worker pool (default = keep the current pool)
+
+        Returns
+        -------
+        `NDArray` of shape (len(txts), n_latent)
+        """
+        if pool_size is not None and pool_size != self.pool_size:
+            self.close()
+            self.pool_size = pool_size
+        if len(txts) == 0:
+            return mx.nd.array(np.zeros((0, self.inference.n_latent), dtype='float32'), ctx=self.inference.ctx)
         model = self.inference.model
+        csr = ids_to_csr(self._texts_to_ids(txts), self.vocab_len)
         if covars:
-            covar_ids = mx.nd.array([model.label_map[v] for v in covars])
-            covars = mx.nd.one_hot(covar_ids, depth=len(model.label_map))
-            encs = model.encode_data_with_covariates(data, covars)
-        else:
-            encs = model.encode_data(data)
-        if self.use_probs:
-            e1 = encs - mx.nd.min(encs, axis=1).expand_dims(1)
-            encs = mx.nd.softmax(e1 ** self.temp)
-        return encs
+            covar_ids = np.array([model.label_map[v] for v in covars])
+        encodings = []
+        for i in range(0, len(txts), self.batch_size):
+            batch = csr[i:i+self.batch_size]
+            data = mx.nd.sparse.csr_matrix((batch.data, batch.indices, batch.indptr), shape=batch.shape,
+                                           ctx=self.inference.ctx)
+            if covars:
+                batch_covars = mx.nd.one_hot(mx.nd.array(covar_ids[i:i+self.batch_size], ctx=self.inference.ctx),
+                                             depth=len(model.label_map))
+                encs = model.encode_data_with_covariates(data, batch_covars)
+            else:
+                encs = model.encode_data(data)
+            encodings.append(self._to_probs(encs) if self.use_probs else encs)
+        return mx.nd.concat(*encodings, dim=0) if len(encodings) > 1 else encodings[0]
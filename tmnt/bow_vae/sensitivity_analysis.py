@@ -13,14 +13,18 @@ from tmnt.bow_vae.bow_doc_loader import DataIterLoader, file_to_sp_vec
 
 __all__ = ['get_encoder_jacobians_at_data_file', 'get_jacobians_at_data_file']
 
+def _embed(model, data):
+    ## the embedding layer runs in the model's compute data type (e.g. bfloat16); its output is float32
+    return model._to_float32(mx.nd, model.embedding(model._to_compute_dtype(mx.nd, data)))
+
 def _get_sampled_topic_embeddings(model, data, covars, batch_size):
-    emb_out = model.embedding(data)
+    emb_out = _embed(model, data)
     co_emb = mx.nd.concat(emb_out, covars)
     z, KL = model.run_encode(mx.nd.ndarray, co_emb, batch_size)
     return z
 
 def _get_encoding(model, data, covars, batch_size):
-    emb_out = model.embedding(data)
+    emb_out = _embed(model, data)
     co_emb = mx.nd.concat(emb_out, covars)
     return model.latent_dist.mu_encoder(model.encoder(co_emb))
 
@@ -42,7 +46,8 @@ def _get_jacobians_at_data(model, dataloader, f_covars, batch_size, sample_size)
             #    print("... {} vocab items".format(i))
             z_data.attach_grad()
             with mx.autograd.record():
-                yy = model.cov_decoder(z_data, covars)
+                yy = model._to_float32(mx.nd, model.cov_decoder(model._to_compute_dtype(mx.nd, z_data),
+                                                                model._to_compute_dtype(mx.nd, covars)))
                 yi = yy[:, i] ## for the ith term, over batch
             yi.backward(retain_graph=True)
             cv_is = [f_covar_mapping[covars[j].asscalar()] for j in range(batch_size)]
@@ -79,7 +84,7 @@ def _get_encoder_jacobians_at_data(model, dataloader, batch_size, sample_size):
         for i in range(model.n_latent):
             x_data.attach_grad()
             with mx.autograd.record():
-                emb_out = model.embedding(x_data)
+                emb_out = _embed(model, x_data)
                 co_emb = mx.nd.concat(emb_out, covars)
                 yi = co_emb[:, i] ## for the ith topic, over batch
             yi.backward()
@@ -103,7 +108,7 @@ def get_encoder_jacobians_at_data_nocovar(model, dataloader, batch_size, sample_
         for i in range(model.n_latent):
             x_data.attach_grad()
             with mx.autograd.record():
-                emb_out = model.embedding(x_data)
+                emb_out = _embed(model, x_data)
                 enc_out = model.latent_dist.mu_encoder(model.encoder(emb_out))
                 yi = enc_out[:, i] ## for the ith topic, over batch
             yi.backward()
@@ -0,0 +1,407 @@
+# coding: utf-8
+"""
+Copyright (c) 2020 The MITRE Corporation.
+
+Long-running inference service for trained topic models. The model stays resident and concurrent requests are
+collected into micro-batches (bounded by a number of documents and a latency) that are encoded together.
+The service speaks JSON over HTTP on a TCP port or a Unix domain socket:
+
+- ``POST /encode`` with ``{"texts": [...], "covars": [...], "top_k": 10}`` returns, for each text, its topic
+  vector, the highest scoring topic and that topic's top terms (``top_k`` is optional and may not exceed the
+  server's ``top_k``)
+- ``GET /topics`` returns the top terms of every topic
+- ``GET /metrics`` returns queue depth, request latency and batch size histograms
+- ``GET /health``
+
+Errors are returned as ``{"error": "..."}`` with status 400 for malformed requests, 404 for unknown paths,
+503 when the request queue is full and 504 when encodings are not ready within the request timeout.
+"""
+
+import bisect
+import http.client
+import http.server
+import json
+import logging
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+import numpy as np
+
+from tmnt.bow_vae.runtime import TextEncoder
+
+__all__ = ['Histogram', 'MicroBatcher', 'InferenceServer', 'InferenceClient']
+
+LATENCY_BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000]
+BATCH_SIZE_BUCKETS = [1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024]
+
+
+class Histogram(object):
+    """
+    Thread-safe histogram over fixed bucket upper bounds (the last bucket holds values above every bound).
+    """
+    def __init__(self, bounds):
+        self.bounds = list(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.total = 0.0
+        self.n = 0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, v):
+        with self._lock:
+            self.counts[bisect.bisect_left(self.bounds, v)] += 1
+            self.total += v
+            self.n += 1
+            self.max = max(self.max, v)
+
+    def snapshot(self):
+        with self._lock:
+            buckets = [{'le': b, 'count': c} for b, c in zip(self.bounds, self.counts)]
+            buckets.append({'le': 'inf', 'count': self.counts[-1]})
+            return {'buckets': buckets, 'count': self.n, 'sum': self.total,
+                    'mean': (self.total / self.n if self.n > 0 else 0.0), 'max': self.max}
+
+
+class _EncodeRequest(object):
+
+    def __init__(self, texts, covars):
+        self.texts = texts
+        self.covars = covars
+        self.future = Future()
+        self.enqueue_time = time.monotonic()
+
+
+class MicroBatcher(object):
+    """
+    Collects encoding requests from concurrent callers into batches for a `TextEncoder`. A batch is encoded
+    once it holds `max_batch_size` documents or `max_latency` seconds after its first request arrived, whichever
+    comes first (a single request larger than `max_batch_size` is encoded on its own). Encoding happens on one
+    background thread, so the model is never used concurrently.
+
+    Parameters
+    ----------
+    encoder : `TextEncoder`
+    max_batch_size : int (default 64) maximum number of documents per batch
+    max_latency : float (default 0.01) maximum time in seconds a request waits for other requests to batch with
+    max_queue_size : int (default 10000) maximum number of queued requests; `submit` raises `queue.Full` beyond it
+    """
+    def __init__(self, encoder, max_batch_size=64, max_latency=0.01, max_queue_size=10000):
+        self.encoder = encoder
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._pending_docs = 0
+        self._lock = threading.Lock()
+        self.latency_ms = Histogram(LATENCY_BUCKETS_MS)
+        self.queue_wait_ms = Histogram(LATENCY_BUCKETS_MS)
+        self.batch_sizes = Histogram(BATCH_SIZE_BUCKETS)
+        self.n_errors = 0
+        self._thread = threading.Thread(target=self._run, name='tmnt-micro-batcher', daemon=True)
+        self._thread.start()
+
+    def submit(self, texts, covars=None):
+        """
+        Queue `texts` (with optional covariate values `covars`) for encoding.
+
+        Returns
+        -------
+        `concurrent.futures.Future` whose result is a (len(texts), K) numpy array of encodings
+        """
+        req = _EncodeRequest(texts, covars)
+        with self._lock:
+            self._pending_docs += len(texts)
+        try:
+            self._queue.put_nowait(req)
+        except queue.Full:
+            with self._lock:
+                self._pending_docs -= len(texts)
+            raise
+        return req.future
+
+    def queue_depth(self):
+        """
+        Number of queued requests and documents not yet taken into a batch.
+        """
+        with self._lock:
+            return {'requests': self._queue.qsize(), 'documents': self._pending_docs}
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _take(self, req):
+        with self._lock:
+            self._pending_docs -= len(req.texts)
+        self.queue_wait_ms.record((time.monotonic() - req.enqueue_time) * 1000.0)
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            req = self._queue.get()
+            if req is None:
+                break
+            self._take(req)
+            batch = [req]
+            n_docs = len(req.texts)
+            deadline = time.monotonic() + self.max_latency
+            while n_docs < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    nxt = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if nxt is None:
+                    stopping = True
+                    break
+                self._take(nxt)
+                batch.append(nxt)
+                n_docs += len(nxt.texts)
+            self._encode(batch, n_docs)
+
+    def _encode(self, batch, n_docs):
+        texts = [t for req in batch for t in req.texts]
+        covars = [c for req in batch for c in req.covars] if batch[0].covars is not None else None
+        self.batch_sizes.record(n_docs)
+        try:
+            encodings = self.encoder.encode_batch(texts, covars).asnumpy()
+        except Exception as e:
+            logging.exception("Failed to encode batch of {} documents".format(n_docs))
+            self.n_errors += len(batch)
+            for req in batch:
+                req.future.set_exception(e)
+            return
+        offset = 0
+        now = time.monotonic()
+        for req in batch:
+            req.future.set_result(encodings[offset:offset + len(req.texts)])
+            offset += len(req.texts)
+            self.latency_ms.record((now - req.enqueue_time) * 1000.0)
+
+
+class _RequestError(Exception):
+
+    def __init__(self, status, message):
+        super(_RequestError, self).__init__(message)
+        self.status = status
+
+
+class _InferenceRequestHandler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def _send_json(self, status, obj):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        service = self.server.service
+        if self.path == '/health':
+            self._send_json(200, {'status': 'ok'})
+        elif self.path == '/metrics':
+            self._send_json(200, service.get_metrics())
+        elif self.path == '/topics':
+            self._send_json(200, {'topic_terms': service.topic_terms})
+        else:
+            self._send_json(404, {'error': 'Unknown path {}'.format(self.path)})
+
+    def do_POST(self):
+        if self.path != '/encode':
+            self._send_json(404, {'error': 'Unknown path {}'.format(self.path)})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            try:
+                request = json.loads(self.rfile.read(length).decode('utf-8'))
+            except ValueError:
+                raise _RequestError(400, 'Request body is not valid JSON')
+            self._send_json(200, self.server.service.encode(request))
+        except _RequestError as e:
+            self._send_json(e.status, {'error': str(e)})
+        except Exception as e:
+            logging.exception("Failed to handle encode request")
+            self._send_json(500, {'error': str(e)})
+
+    def log_message(self, format, *args):
+        logging.debug("Inference request: " + format % args)
+
+
+## listen backlog large enough for bursts of concurrent clients (connections beyond it are refused)
+LISTEN_BACKLOG = 128
+
+
+class _ThreadingTCPHTTPServer(http.server.ThreadingHTTPServer):
+
+    daemon_threads = True
+    request_queue_size = LISTEN_BACKLOG
+
+
+class _ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+
+    daemon_threads = True
+    request_queue_size = LISTEN_BACKLOG
+
+    def get_request(self):
+        request, _ = super(_ThreadingUnixHTTPServer, self).get_request()
+        ## BaseHTTPRequestHandler expects a (host, port) client address
+        return request, ('unix', 0)
+
+
+class InferenceServer(object):
+    """
+    HTTP inference service around a `BowNTMInference` object (see the module documentation for the endpoints).
+
+    Parameters
+    ----------
+    inference : `BowNTMInference`
+    host : str (default '127.0.0.1') address to listen on
+    port : int (default 8000) TCP port (0 picks a free port; see `address`)
+    unix_socket : str (default None) listen on this Unix domain socket path instead of a TCP port
+    max_batch_size : int (default 64) maximum number of documents encoded together
+    max_latency : float (default 0.01) maximum seconds a request waits to be batched with other requests
+    max_queue_size : int (default 10000) queued requests beyond this are rejected with status 503
+    request_timeout : float (default 60.0) seconds to wait for a request's encodings
+    top_k : int (default 10) number of top terms returned per topic (and the largest `top_k` a request may ask for)
+    pool_size : int (default 1) number of text pre-processing processes used by the `TextEncoder`
+    """
+    def __init__(self, inference, host='127.0.0.1', port=8000, unix_socket=None, max_batch_size=64,
+                 max_latency=0.01, max_queue_size=10000, request_timeout=60.0, top_k=10, pool_size=1):
+        self.inference = inference
+        self.request_timeout = request_timeout
+        self.top_k = top_k
+        self.topic_terms = inference.get_top_k_words_per_topic(top_k)
+        self.encoder = TextEncoder(inference, pool_size=pool_size, batch_size=max(max_batch_size, 1))
+        self.batcher = MicroBatcher(self.encoder, max_batch_size=max_batch_size, max_latency=max_latency,
+                                    max_queue_size=max_queue_size)
+        self.unix_socket = unix_socket
+        if unix_socket:
+            if os.path.exists(unix_socket):
+                os.remove(unix_socket)
+            self.httpd = _ThreadingUnixHTTPServer(unix_socket, _InferenceRequestHandler)
+            self.address = unix_socket
+        else:
+            self.httpd = _ThreadingTCPHTTPServer((host, port), _InferenceRequestHandler)
+            self.address = self.httpd.server_address
+        self.httpd.service = self
+        self._thread = None
+
+    def encode(self, request):
+        if not isinstance(request, dict):
+            raise _RequestError(400, 'Request body must be a JSON object')
+        texts = request.get('texts')
+        if not isinstance(texts, list) or not all(isinstance(t, str) for t in texts):
+            raise _RequestError(400, "'texts' must be a list of strings")
+        covars = request.get('covars')
+        if self.inference.covar_model:
+            if not isinstance(covars, list) or len(covars) != len(texts):
+                raise _RequestError(400, "'covars' must provide one co-variate value per text for this model")
+            unknown = [c for c in covars if c not in self.inference.model.label_map]
+            if unknown:
+                raise _RequestError(400, "Unknown co-variate values: {}".format(sorted(set(unknown))))
+        else:
+            covars = None
+        top_k = request.get('top_k', self.top_k)
+        if not isinstance(top_k, int) or isinstance(top_k, bool) or not 1 <= top_k <= self.top_k:
+            raise _RequestError(400, "'top_k' must be an integer between 1 and {}".format(self.top_k))
+        if len(texts) == 0:
+            return {'encodings': [], 'top_topics': [], 'top_terms': []}
+        try:
+            future = self.batcher.submit(texts, covars)
+        except queue.Full:
+            raise _RequestError(503, 'Request queue is full')
+        try:
+            encodings = future.result(timeout=self.request_timeout)
+        except FutureTimeoutError:
+            raise _RequestError(504, 'Encodings not ready within {} seconds'.format(self.request_timeout))
+        top_topics = [int(t) for t in np.argmax(encodings, axis=1)]
+        return {'encodings': encodings.tolist(), 'top_topics': top_topics,
+                'top_terms': [self.topic_terms[t][:top_k] for t in top_topics]}
+
+    def get_metrics(self):
+        return {'queue_depth': self.batcher.queue_depth(),
+                'latency_ms': self.batcher.latency_ms.snapshot(),
+                'queue_wait_ms': self.batcher.queue_wait_ms.snapshot(),
+                'batch_size': self.batcher.batch_sizes.snapshot(),
+                'failed_requests': self.batcher.n_errors}
+
+    def serve_forever(self):
+        logging.info("Serving topic model inference on {}".format(self.address))
+        self.httpd.serve_forever()
+
+    def start(self):
+        """
+        Serve requests on a background thread (e.g. to call the service from the same process).
+        """
+        self._thread = threading.Thread(target=self.serve_forever, name='tmnt-inference-server', daemon=True)
+        self._thread.start()
+        return self
+
+    def shutdown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self._thread is not None:
+            self._thread.join()
+        self.batcher.close()
+        self.encoder.close()
+        if self.unix_socket and os.path.exists(self.unix_socket):
+            os.remove(self.unix_socket)
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, path, timeout=60.0):
+        super(_UnixHTTPConnection, self).__init__('localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+class InferenceClient(object):
+    """
+    Client for an `InferenceServer` listening on `host`:`port` or on the Unix domain socket `unix_socket`.
+    """
+    def __init__(self, host='127.0.0.1', port=8000, unix_socket=None, timeout=60.0):
+        if unix_socket:
+            self.conn = _UnixHTTPConnection(unix_socket, timeout=timeout)
+        else:
+            self.conn = http.client.HTTPConnection(host, port, timeout=timeout)
+
+    def _request(self, method, path, obj=None):
+        body = json.dumps(obj).encode('utf-8') if obj is not None else None
+        headers = {'Content-Type': 'application/json'} if body is not None else {}
+        self.conn.request(method, path, body=body, headers=headers)
+        resp = self.conn.getresponse()
+        result = json.loads(resp.read().decode('utf-8'))
+        if resp.status != 200:
+            raise Exception("Inference request failed with status {}: {}".format(resp.status, result.get('error')))
+        return result
+
+    def encode(self, texts, covars=None, top_k=None):
+        request = {'texts': texts}
+        if covars is not None:
+            request['covars'] = covars
+        if top_k is not None:
+            request['top_k'] = top_k
+        return self._request('POST', '/encode', request)
+
+    def topics(self):
+        return self._request('GET', '/topics')['topic_terms']
+
+    def metrics(self):
+        return self._request('GET', '/metrics')
+
+    def close(self):
+        self.conn.close()
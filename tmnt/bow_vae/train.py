@@ -10,29 +10,38 @@ import datetime
 import time
 import io
 import os
+import shutil
 import json
+import hashlib
 import mxnet as mx
 import numpy as np
+import scipy.sparse as sp
 import pickle
+import multiprocessing
 import copy
+import contextlib
 import socket
 import statistics
 import random
+from concurrent.futures import ProcessPoolExecutor
 
 from mxnet import autograd
 from mxnet import gluon
 import gluonnlp as nlp
 from pathlib import Path
 
-from tmnt.bow_vae.bow_doc_loader import DataIterLoader, collect_sparse_test, collect_sparse_data, load_vocab
+from tmnt.bow_vae.bow_doc_loader import DataIterLoader, CSRBatchLoader, collect_sparse_test, collect_sparse_data, load_vocab
+from tmnt.bow_vae.bow_doc_loader import ShardedDataLoader, PrefetchingLoader, shard_sp_vec_file
 from tmnt.bow_vae.bow_models import BowNTM, MetaDataBowNTM, BasicAE
 from tmnt.bow_vae.topic_seeds import get_seed_matrix_from_file
 from tmnt.bow_vae.sensitivity_analysis import get_encoder_jacobians_at_data_nocovar
 
 from tmnt.utils.log_utils import logging_config
+from tmnt.common_params import get_worker_thread_env
 from tmnt.utils.mat_utils import export_sparse_matrix, export_vocab
 from tmnt.utils.random import seed_rng
-from tmnt.coherence.npmi import EvaluateNPMI
+from tmnt.utils.mixed_precision import MixedPrecisionTrainer, is_low_precision
+from tmnt.coherence.npmi import EvaluateNPMI, CooccurrenceIndex
 from tmnt.modsel.configuration import TMNTConfig
 
 import ConfigSpace as CS
@@ -45,10 +54,13 @@ from hpbandster.optimizers import BOHB as BOHB
 __all__ = ['model_select_bow_vae', 'train_bow_vae']
 
 MAX_DESIGN_MATRIX = 250000000 
+MAX_SHARD_SIZE = 1 << 40  ## shard size used to keep a corpus in a single shard
 
 def get_wd_freqs(data_csr, max_sample_size=1000000):
     sample_size = min(max_sample_size, data_csr.shape[0])
     data = data_csr[:sample_size] 
+    if sp.issparse(data):
+        return mx.nd.array(np.asarray(data.sum(axis=0)).ravel())
     sums = mx.nd.sum(data, axis=0)
     return sums
 
@@ -82,8 +94,15 @@ def evaluate(model, data_loader, last_batch_size, num_test_batches, total_words,
 
 
 
+def _evaluate_npmi(top_k_words_per_topic, test_data, cooccur_index=None):
+    npmi_eval = EvaluateNPMI(top_k_words_per_topic)
+    if cooccur_index is not None:
+        return npmi_eval.evaluate_cooccurrence_index(cooccur_index)
+    return npmi_eval.evaluate_csr_mat(test_data)
+
+
 def compute_coherence(model, k, test_data, log_terms=False, covariate_interactions=False,
-                      test_dataloader=None, ctx=mx.cpu()):
+                      test_dataloader=None, cooccur_index=None, ctx=mx.cpu()):
     if covariate_interactions:
         logging.info("Rendering interactions not supported yet")
     num_topics = model.n_latent
@@ -94,16 +113,14 @@ def compute_coherence(model, k, test_data, log_terms=False, covariate_interactio
         sorted_j = (-js).argsort(axis=1)
         sorted_topk = sorted_j[:, :k]
         enc_top_k_words_per_topic = [ [int(i) for i in list(sorted_topk[t, :]) ] for t in range(num_topics)]
-        enc_npmi_eval = EvaluateNPMI(enc_top_k_words_per_topic)
-        enc_npmi = enc_npmi_eval.evaluate_csr_mat(test_data)
+        enc_npmi = _evaluate_npmi(enc_top_k_words_per_topic, test_data, cooccur_index)
     else:
         enc_npmi = None
         
     sorted_ids = model.get_top_k_terms(k)
     num_topics = min(num_topics, sorted_ids.shape[-1])
     top_k_words_per_topic = [[int(i) for i in list(sorted_ids[:k, t].asnumpy())] for t in range(num_topics)]
-    npmi_eval = EvaluateNPMI(top_k_words_per_topic)
-    npmi = npmi_eval.evaluate_csr_mat(test_data)
+    npmi = _evaluate_npmi(top_k_words_per_topic, test_data, cooccur_index)
     
     unique_term_ids = set()
     unique_limit = 5  ## only consider the top 5 terms for each topic when looking at degree of redundancy
@@ -122,7 +139,7 @@ def compute_coherence(model, k, test_data, log_terms=False, covariate_interactio
 
 
 def analyze_seed_matrix(model, seed_matrix):
-    w = model.decoder.collect_params().get('weight').data()
+    w = model.decoder.collect_params().get('weight').data().astype('float32', copy=False)
     ts = mx.nd.take(w, seed_matrix)   ## should have shape (T', S', T)
     ts_sums = mx.nd.sum(ts, axis=1)
     ts_probs = mx.nd.softmax(ts_sums)
@@ -139,7 +156,7 @@ def analyze_seed_matrix(model, seed_matrix):
     
 
 def log_top_k_words_per_topic(model, vocab, num_topics, k):
-    w = model.decoder.collect_params().get('weight').data()
+    w = model.decoder.collect_params().get('weight').data().astype('float32', copy=False)
     sorted_ids = w.argsort(axis=0, is_ascend=False)
     for t in range(num_topics):
         top_k = [ vocab.idx_to_token[int(i)] for i in list(sorted_ids[:k, t].asnumpy()) ]
@@ -151,7 +168,7 @@ def log_top_k_words_per_topic(model, vocab, num_topics, k):
 class BowVAEWorker(Worker):
     def __init__(self, model_out_dir, c_args, vocabulary, data_train_csr, total_tr_words,
                  data_test_csr, total_tst_words, train_labels=None, test_labels=None, label_map=None, ctx=mx.cpu(),
-                 max_budget=27, **kwargs):
+                 max_budget=27, train_shards=None, **kwargs):
         super().__init__(**kwargs)
         self.model_out_dir = model_out_dir
         self.c_args = c_args
@@ -163,12 +180,16 @@ class BowVAEWorker(Worker):
         self.train_labels = train_labels
         self.test_labels = test_labels
         self.data_train_csr   = data_train_csr
+        self.train_shards     = train_shards
+        self.train_shape      = train_shards.shape if train_shards is not None else data_train_csr.shape
         self.data_test_csr    = data_test_csr
         self.data_heldout_csr = None
+        self.test_vec_file    = c_args.val_vec_file
+        self.test_cooccur_index = None
         self.label_map = label_map
         self.search_mode = False
         
-        self.wd_freqs = get_wd_freqs(data_train_csr)
+        self.wd_freqs = mx.nd.array(train_shards.wd_freqs) if train_shards is not None else get_wd_freqs(data_train_csr)
         self.vocab_cache = {}
         
         self.seed_matrix = None
@@ -184,6 +205,33 @@ class BowVAEWorker(Worker):
         self.data_test_csr = tst_mat
         self.test_labels   = tst_labels
         self.total_tst_words = total_tst_words
+        self.test_vec_file = self.c_args.tst_vec_file
+        self.test_cooccur_index = None
+
+    def _get_cooccur_cache_file(self):
+        if getattr(self.c_args, 'cooccur_cache', False) and self.test_vec_file:
+            return self.test_vec_file + '.cooccur.npz'
+        return None
+
+    def _get_test_cooccur_index(self):
+        """Get the document co-occurrence index over the test/validation data, building it on first use
+        and loading pair frequencies memoized by earlier runs when a cache file is available
+        """
+        if self.test_cooccur_index is None:
+            self.test_cooccur_index = CooccurrenceIndex(self.data_test_csr)
+            cache_file = self._get_cooccur_cache_file()
+            if cache_file and os.path.exists(cache_file):
+                if self.test_cooccur_index.load(cache_file):
+                    logging.info("Loaded {} cached term pair frequencies from {}"
+                                 .format(len(self.test_cooccur_index.pair_cache), cache_file))
+                else:
+                    logging.info("Co-occurrence cache {} does not match test data or is unreadable; ignoring".format(cache_file))
+        return self.test_cooccur_index
+
+    def _save_test_cooccur_index(self):
+        cache_file = self._get_cooccur_cache_file()
+        if cache_file and self.test_cooccur_index is not None:
+            self.test_cooccur_index.save(cache_file)
         
 
     def _initialize_embedding_layer(self, embedding_source, config):
@@ -231,18 +279,26 @@ class BowVAEWorker(Worker):
 
 
     def _update_details(self, details, elbo, kl_loss, rec_loss, l1_pen, entropies, coherence_loss, redundancy_loss):
-        """Update loss details during training for logging and analysis
+        """Update loss details during training for logging and analysis.
+        Sums are accumulated as NDArrays (on the training device) so no host synchronization happens here;
+        see `_sync_details`.
         """
-        details['kl_loss']  += kl_loss.sum().asscalar()
-        details['l1_pen']   += l1_pen.sum().asscalar()
-        details['rec_loss'] += rec_loss.sum().asscalar()
+        details['kl_loss']  += kl_loss.sum()
+        details['l1_pen']   += l1_pen.sum()
+        details['rec_loss'] += rec_loss.sum()
         if coherence_loss is not None:
-            details['coherence_loss'] += coherence_loss.sum().asscalar()
+            details['coherence_loss'] += coherence_loss.sum()
         if entropies is not None:
-            details['entropies_loss'] += entropies.sum().asscalar()
+            details['entropies_loss'] += entropies.sum()
         if redundancy_loss is not None:
-            details['redundancy_loss'] += redundancy_loss.sum().asscalar()
-        details['epoch_loss'] += elbo.sum().asscalar()
+            details['redundancy_loss'] += redundancy_loss.sum()
+        details['epoch_loss'] += elbo.sum()
+
+    def _sync_details(self, details):
+        """Copy accumulated loss details to the host (blocking until the pending training steps finish)
+        and return them as a dictionary of floats.
+        """
+        return dict((k, v.asscalar() if isinstance(v, mx.nd.NDArray) else v) for (k, v) in details.items())
 
     def _log_details(self, details, epoch):
         """Log accumulated details (e.g. loss values) for a given epoch
@@ -252,6 +308,7 @@ class BowVAEWorker(Worker):
         details: dictionary - with various details (loss values) to keep track of
         epoch: int - current epoch number
         """
+        details = self._sync_details(details)
         tr_size = details['tr_size']
         if tr_size > 0:
             nd = {}
@@ -291,16 +348,20 @@ class BowVAEWorker(Worker):
         covar_net_layers = config.get('covar_net_layers')
         n_encoding_layers = config.get('num_enc_layers', 1)
         enc_dr = config.get('enc_dr', 0.0)
+        sparse_input = self._use_sparse_input(config)
+        recon_loss = config.get('recon_loss', 'full')
+        n_neg_samples = int(config.get('recon_neg_samples', 1024))
+        dtype = self._get_dtype(config)
 
-        if self.c_args.use_labels_as_covars and self.train_labels is not None:
+        if self.c_args.use_labels_as_covars and (self.train_labels is not None or self.train_shards is not None):
             n_covars = len(self.label_map) if self.label_map else 1
             model = \
                 MetaDataBowNTM(self.label_map, n_covars, vocab, enc_hidden_dim, n_latent, emb_size,
                                fixed_embedding=fixed_embedding, latent_distrib=latent_distrib, kappa=kappa, alpha=alpha,
                                init_l1=l1_coef, coherence_reg_penalty=coherence_reg_penalty, redundancy_reg_penalty=redundancy_reg_penalty,
                                batch_size=batch_size, n_encoding_layers=n_encoding_layers, enc_dr=enc_dr,
-                               wd_freqs=self.wd_freqs, covar_net_layers=covar_net_layers,
-                               ctx=self.ctx)
+                               wd_freqs=self.wd_freqs, covar_net_layers=covar_net_layers, sparse_input=sparse_input,
+                               recon_loss=recon_loss, n_neg_samples=n_neg_samples, dtype=dtype, ctx=self.ctx)
         else:
             logging.info("shape freqs = {}".format(self.wd_freqs.shape))
             model = \
@@ -309,8 +370,12 @@ class BowVAEWorker(Worker):
                        init_l1=l1_coef, coherence_reg_penalty=coherence_reg_penalty, redundancy_reg_penalty=redundancy_reg_penalty,
                        target_sparsity=target_sparsity, kappa=kappa, alpha=alpha,
                        batch_size=batch_size, n_encoding_layers=n_encoding_layers, enc_dr=enc_dr,
-                       wd_freqs=self.wd_freqs, seed_mat=self.seed_matrix, ctx=self.ctx)
-        trainer = gluon.Trainer(model.collect_params(), optimizer, {'learning_rate': lr})
+                       wd_freqs=self.wd_freqs, seed_mat=self.seed_matrix, sparse_input=sparse_input,
+                       recon_loss=recon_loss, n_neg_samples=n_neg_samples, dtype=dtype, ctx=self.ctx)
+        if is_low_precision(dtype):
+            trainer = MixedPrecisionTrainer(model.collect_params(), optimizer, {'learning_rate': lr})
+        else:
+            trainer = gluon.Trainer(model.collect_params(), optimizer, {'learning_rate': lr})
         if self.c_args.hybridize:
             model.hybridize()
         return model, trainer
@@ -322,18 +387,121 @@ class BowVAEWorker(Worker):
         ----------
         model: VAE model
         epoch: int - the current epoch
+
+        Returns
+        -------
+        (perplexity, npmi) if the model was evaluated at this epoch, otherwise None
         """
         if test_dataloader is not None and (epoch + 1) % self.c_args.eval_freq == 0:
             perplexity = evaluate(model, test_dataloader, last_batch_size, num_test_batches, self.total_tst_words,
                                   self.c_args, self.ctx)
             tst_ld = test_dataloader if self.c_args.encoder_coherence else None
-            npmi, _, _ = compute_coherence(model, 10, self.data_test_csr, log_terms=True, test_dataloader=tst_ld, ctx=model.model_ctx)
+            npmi, _, _ = compute_coherence(model, 10, self.data_test_csr, log_terms=True, test_dataloader=tst_ld,
+                                           cooccur_index=self._get_test_cooccur_index(), ctx=model.model_ctx)
             if self.c_args.trace_file:
                 otype = 'a+' if epoch >= self.c_args.eval_freq else 'w+'
                 with io.open(self.c_args.trace_file, otype) as fp:
                     if otype == 'w+':
                         fp.write("Epoch,PPL,NPMI\n")
                     fp.write("{:3d},{:10.2f},{:8.4f}\n".format(epoch, perplexity, npmi))
+            return perplexity, npmi
+        return None
+
+    def _validation_score(self, model, epoch, test_dataloader, last_batch_size, num_test_batches):
+        """Score (lower is better) used for early stopping: validation perplexity or negated NPMI,
+        computed every `eval_freq` epochs. Returns None at epochs where the model is not evaluated.
+        """
+        if not self.search_mode:
+            scores = self._eval_trace(model, epoch, test_dataloader, last_batch_size, num_test_batches)
+        elif (epoch + 1) % getattr(self.c_args, 'eval_freq', 1) == 0:
+            perplexity = evaluate(model, test_dataloader, last_batch_size, num_test_batches, self.total_tst_words,
+                                  self.c_args, self.ctx)
+            npmi = 0.0
+            if self.c_args.early_stop_metric == 'npmi':
+                npmi, _, _ = compute_coherence(model, 10, self.data_test_csr, cooccur_index=self._get_test_cooccur_index(),
+                                               ctx=model.model_ctx)
+            scores = (perplexity, npmi)
+        else:
+            scores = None
+        if scores is None:
+            return None
+        return -scores[1] if self.c_args.early_stop_metric == 'npmi' else scores[0]
+
+    def _get_checkpoint_dir(self, config):
+        """Directory holding the per-budget checkpoints for a configuration (None when checkpointing is off).
+        """
+        if not getattr(self.c_args, 'budget_checkpoints', False):
+            return None
+        config_str = json.dumps(dict(config), sort_keys=True, default=str)
+        config_id = hashlib.sha1(config_str.encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.model_out_dir, 'checkpoints', config_id)
+
+    def _load_checkpoint(self, ckpt_dir, budget, n_epochs, model, trainer):
+        """Restore model and trainer state from the checkpoint with the largest budget below `budget` that
+        was trained for at most `n_epochs` epochs.
+
+        Returns
+        -------
+        Checkpoint details (budget, epochs, l1_coef, stopped) or None if there is no usable checkpoint
+        """
+        if ckpt_dir is None or not os.path.exists(ckpt_dir):
+            return None
+        candidates = []
+        for f in os.listdir(ckpt_dir):
+            if f.endswith('.json'):
+                with io.open(os.path.join(ckpt_dir, f), 'r') as fp:
+                    info = json.loads(fp.read())
+                if info['budget'] < budget and info['epochs'] <= n_epochs:
+                    candidates.append(info)
+        for info in sorted(candidates, key=lambda c: c['budget'], reverse=True):
+            prefix = os.path.join(ckpt_dir, 'budget_{}'.format(info['budget']))
+            try:
+                model.load_parameters(prefix + '.params', ctx=self.ctx)
+                trainer.load_states(prefix + '.states')
+                if isinstance(trainer, MixedPrecisionTrainer):
+                    trainer.load_master_parameters(prefix + '.master')
+            except Exception as e:
+                logging.info("Unable to load checkpoint {}: {}".format(prefix, e))
+                continue
+            logging.info("Resuming from checkpoint at budget {} ({} epochs)".format(info['budget'], info['epochs']))
+            return info
+        return None
+
+    def _save_checkpoint(self, ckpt_dir, budget, n_epochs, l1_coef, stopped, model, trainer):
+        """Save model and trainer state after training a configuration with a given budget.
+        The details file is written last so that readers only see complete checkpoints.
+        """
+        if ckpt_dir is None:
+            return
+        os.makedirs(ckpt_dir, exist_ok=True)
+        prefix = os.path.join(ckpt_dir, 'budget_{}'.format(budget))
+        model.save_parameters(prefix + '.params.tmp')
+        os.replace(prefix + '.params.tmp', prefix + '.params')
+        trainer.save_states(prefix + '.states.tmp')
+        os.replace(prefix + '.states.tmp', prefix + '.states')
+        if isinstance(trainer, MixedPrecisionTrainer):
+            trainer.save_master_parameters(prefix + '.master.tmp')
+            os.replace(prefix + '.master.tmp', prefix + '.master')
+        info = {'budget': budget, 'epochs': n_epochs, 'l1_coef': l1_coef, 'stopped': stopped}
+        with io.open(prefix + '.json.tmp', 'w') as fp:
+            fp.write(json.dumps(info))
+        os.replace(prefix + '.json.tmp', prefix + '.json')
+        self._remove_checkpoints_below(ckpt_dir, budget)
+
+    def _remove_checkpoints_below(self, ckpt_dir, budget):
+        """Delete the checkpoints for budgets below `budget`: higher budgets resume from the largest lower-budget
+        checkpoint, so only the latest one for a configuration is kept. The details file is removed first.
+        """
+        for f in os.listdir(ckpt_dir):
+            if not f.endswith('.json'):
+                continue
+            with io.open(os.path.join(ckpt_dir, f), 'r') as fp:
+                info = json.loads(fp.read())
+            if info['budget'] < budget:
+                prefix = os.path.join(ckpt_dir, 'budget_{}'.format(info['budget']))
+                for ext in ('.json', '.params', '.states', '.master'):
+                    if os.path.exists(prefix + ext):
+                        os.remove(prefix + ext)
 
     def _l1_regularize(self, model, cur_l1_coef):
         """Apply a regularization term based on magnitudes of the decoder (topic-term) weights.
@@ -343,14 +511,48 @@ class BowVAEWorker(Worker):
         ----------
         model: VAE model
         """
-        dec_weights = model.decoder.collect_params().get('weight').data().abs()
+        dec_weights = model.decoder.collect_params().get('weight').data().astype('float32', copy=False).abs()
         ratio_small_weights = (dec_weights < self.c_args.sparsity_threshold).sum().asscalar() / dec_weights.size
         l1_coef = cur_l1_coef * math.pow(2.0, model.target_sparsity - ratio_small_weights)
         logging.info("Setting L1 coeffficient to {} [sparsity ratio = {}]".format(l1_coef, ratio_small_weights))
         model.l1_pen_const.set_data(mx.nd.array([l1_coef]))
         return l1_coef
 
-    def _train_model(self, config, budget, data_sensitive_budget=True):
+    def _use_sparse_input(self, config):
+        """True if the model consumes CSR batches directly (see `SparseInputEmbedding`).
+        """
+        return getattr(self.c_args, 'sparse_input', False) or str(config.get('sparse_input', False)) == 'True'
+
+    def _get_dtype(self, config):
+        """Data type of the model's vocabulary-sized layers: from the configuration if present, otherwise
+        from the `dtype` argument.
+        """
+        return config.get('dtype', getattr(self.c_args, 'dtype', 'float32'))
+
+    def _get_train_dataloader(self, batch_size, densify=True):
+        """Shuffled training batches: streamed from on-disk shards when the training data is sharded,
+        otherwise sliced from the in-memory training CSR matrix. Batches are prepared (label expansion,
+        densification and copying to the training context) ahead of time on a background thread.
+        With `densify` False, batches stay in CSR form (for models with a sparse first layer).
+        """
+        if self.train_shards is not None:
+            loader = ShardedDataLoader(self.train_shards, batch_size, label_map=self.label_map,
+                                       scalar_labels=self.c_args.scalar_covars,
+                                       use_labels=self.c_args.use_labels_as_covars,
+                                       shuffle_buffer=self.c_args.shuffle_buffer,
+                                       max_resident_shards=self.c_args.max_resident_shards)
+        elif not densify or sp.issparse(self.data_train_csr):
+            ## a memory-mapped (scipy) matrix is sliced per batch rather than copied into an NDArrayIter
+            loader = CSRBatchLoader(self.data_train_csr, self.train_labels, batch_size, shuffle=True, last_batch='discard')
+        else:
+            loader = DataIterLoader(mx.io.NDArrayIter(self.data_train_csr, self.train_labels, batch_size,
+                                                      last_batch_handle='discard', shuffle=True))
+        n_covars = len(self.label_map) if self.label_map and not self.c_args.scalar_covars else None
+        ## a dense first layer falls back to dense inputs, so densify off the training thread
+        return PrefetchingLoader(loader, prefetch=self.c_args.prefetch_batches, ctx=self.ctx, n_covars=n_covars,
+                                 densify=densify)
+
+    def _train_model(self, config, budget, data_sensitive_budget=True, use_checkpoints=False):
         """Main training function which takes a single model configuration and a budget (i.e. number of epochs) and
         fits the model to the training data.
         
@@ -358,6 +560,7 @@ class BowVAEWorker(Worker):
         ----------
         config: `Configuration` object within the specified `ConfigSpace`
         budget: int - Number of iterations to use when building the model
+        use_checkpoints: bool - Resume from/save per-budget checkpoints when `budget_checkpoints` is set
 
         Returns
         -------
@@ -371,12 +574,19 @@ class BowVAEWorker(Worker):
         l1_coef = self.c_args.init_sparsity_pen
         num_test_batches = 0
 
-        train_dataloader = \
-            DataIterLoader(mx.io.NDArrayIter(self.data_train_csr, self.train_labels, batch_size,
-                                             last_batch_handle='discard', shuffle=True))
+        sparse_input = self._use_sparse_input(config)
+        train_dataloader = self._get_train_dataloader(batch_size, densify=(not sparse_input))
         if self.data_test_csr is not None:
             test_size = self.data_test_csr.shape[0] * self.data_test_csr.shape[1]
-            if test_size < MAX_DESIGN_MATRIX:
+            if sp.issparse(self.data_test_csr):
+                ## memory-mapped validation data shared between processes: batches are sliced from the mapping
+                test_dataloader = CSRBatchLoader(self.data_test_csr, self.test_labels, batch_size, densify=(not sparse_input))
+            elif sparse_input:
+                ## the sparse first layer consumes CSR batches, including a (padded) last partial batch
+                if self.data_test_csr.stype != 'csr':
+                    self.data_test_csr = self.data_test_csr.tostype('csr')
+                test_dataloader = CSRBatchLoader(self.data_test_csr, self.test_labels, batch_size)
+            elif test_size < MAX_DESIGN_MATRIX:
                 self.data_test_csr = self.data_test_csr.tostype('default')
                 test_dataloader = \
                     DataIterLoader(mx.io.NDArrayIter(self.data_test_csr, self.test_labels, batch_size,
@@ -402,37 +612,77 @@ class BowVAEWorker(Worker):
         training_epochs = budget
         if data_sensitive_budget:
             training_epochs = \
-                (min(self.data_train_csr.shape[1] * 100, self.data_train_csr.shape[0]) * float(budget)) / self.data_train_csr.shape[0]
+                (min(self.train_shape[1] * 100, self.train_shape[0]) * float(budget)) / self.train_shape[0]
 
         visualized_first_batch = False
 
-        for epoch in range(math.ceil(training_epochs)):
+        n_epochs = math.ceil(training_epochs)
+        ckpt_dir = self._get_checkpoint_dir(config) if use_checkpoints else None
+        ckpt = self._load_checkpoint(ckpt_dir, budget, n_epochs, model, trainer)
+        start_epoch = 0
+        stopped = False
+        if ckpt is not None:
+            l1_coef = ckpt['l1_coef']
+            ## a configuration that stopped early at a lower budget is not trained further
+            start_epoch = n_epochs if ckpt['stopped'] else ckpt['epochs']
+            stopped = ckpt['stopped']
+        early_stop = self.c_args.early_stop_patience > 0 and test_dataloader is not None
+        best_score, n_bad_evals = None, 0
+
+        mixed_precision = isinstance(trainer, MixedPrecisionTrainer)
+        for epoch in range(start_epoch, n_epochs):
             details = {'epoch_loss': 0.0, 'rec_loss': 0.0, 'l1_pen': 0.0, 'kl_loss': 0.0,
                        'entropies_loss': 0.0, 'coherence_loss': 0.0, 'redundancy_loss': 0.0, 'tr_size': 0.0}
+            epoch_start = time.time()
             for i, (data, labels) in enumerate(train_dataloader):
                 details['tr_size'] += data.shape[0]
-                if labels is None or labels.size == 0:
-                    labels = mx.nd.expand_dims(mx.nd.zeros(data.shape[0]), 1)
-                labels = labels.as_in_context(self.ctx)
-                data = data.as_in_context(self.ctx)
                 with autograd.record():
                     elbo, kl_loss, rec_loss, l1_pen, entropies, coherence_loss, redundancy_loss, _ = \
                         model(data, labels) if self.c_args.use_labels_as_covars else model(data)
                     elbo_mean = elbo.mean()
+                    if mixed_precision:
+                        elbo_mean = trainer.scale_loss(elbo_mean)
                 elbo_mean.backward()
                 trainer.step(data.shape[0]) 
                 self._update_details(details, elbo, kl_loss, rec_loss, l1_pen, entropies, coherence_loss, redundancy_loss)
+                if self.c_args.log_batch_details:
+                    ## debugging: synchronize every batch and log its losses
+                    logging.info("Epoch {} batch {}: Loss = {:8.4f} [Rec loss = {:8.4f}] [KL loss = {:8.4f}]"
+                                 .format(epoch, i, elbo.mean().asscalar(), rec_loss.mean().asscalar(),
+                                         kl_loss.mean().asscalar()))
+                elif self.c_args.log_interval > 0 and (i + 1) % self.c_args.log_interval == 0:
+                    self._log_details(details, epoch)
             self._log_details(details, epoch)
-            if not self.search_mode and (test_dataloader is not None):
+            epoch_time = time.time() - epoch_start
+            logging.info("Epoch {}: {:.1f} documents/second; waited {:.2f} seconds for input batches ({:.1f}% of {:.2f} seconds)"
+                         .format(epoch, details['tr_size'] / epoch_time, train_dataloader.stall_time,
+                                 100.0 * train_dataloader.stall_time / epoch_time, epoch_time))
+            if early_stop:
+                score = self._validation_score(model, epoch, test_dataloader, last_batch_size, num_test_batches)
+                if score is not None:
+                    if best_score is None or score < best_score - self.c_args.early_stop_min_delta:
+                        best_score, n_bad_evals = score, 0
+                    else:
+                        n_bad_evals += 1
+            elif not self.search_mode and (test_dataloader is not None):
                 self._eval_trace(model, epoch, test_dataloader, last_batch_size, num_test_batches)
             if model.target_sparsity > 0.0:
                 l1_coef = self._l1_regularize(model, l1_coef)
+            if early_stop and n_bad_evals >= self.c_args.early_stop_patience:
+                logging.info("Stopping early after epoch {}: validation {} has not improved in {} evaluations"
+                             .format(epoch, self.c_args.early_stop_metric, n_bad_evals))
+                stopped = True
+                n_epochs = epoch + 1
+                break
         mx.nd.waitall()
+        self._save_checkpoint(ckpt_dir, budget, n_epochs, l1_coef, stopped, model, trainer)
         if test_dataloader is not None:
             perplexity = evaluate(model, test_dataloader, last_batch_size, num_test_batches, self.total_tst_words, self.c_args, self.ctx)
             tst_ld = test_dataloader if self.c_args.encoder_coherence else None
             npmi, enc_npmi, redundancy = compute_coherence(model, 10, self.data_test_csr, log_terms=True, test_dataloader=tst_ld,
+                                                           cooccur_index=self._get_test_cooccur_index(),
                                                            ctx=model.model_ctx)
+            self._save_test_cooccur_index()
             npmi_to_optimize = enc_npmi if enc_npmi and self.c_args.optimize_encoder_coherence else npmi
             try:
                 coherence_coefficient = self.c_args.coherence_coefficient
@@ -467,7 +717,7 @@ class BowVAEWorker(Worker):
         -------
         Result dictionary for use in model selection
         """
-        _, res = self._train_model(config, budget)
+        _, res = self._train_model(config, budget, use_checkpoints=True)
         return res
 
     def retrain_best_config(self, config, budget, rng_seed, ntimes=1, data_sensitive_budget=True):
@@ -487,9 +737,12 @@ class BowVAEWorker(Worker):
         if self.c_args.tst_vec_file:
             self.set_heldout_data_as_test()
         if self.c_args.val_vec_file:
-            for i in range(ntimes):
-                seed_rng(rng_seed+i)
-                model, results = self._train_model(config, budget, data_sensitive_budget=data_sensitive_budget)
+            n_procs = self._get_num_retrain_procs(ntimes)
+            if n_procs > 1:
+                all_results = self._retrain_seeds_parallel(config, budget, rng_seed, ntimes, data_sensitive_budget, n_procs)
+            else:
+                all_results = self._retrain_seeds(config, budget, rng_seed, ntimes, data_sensitive_budget)
+            for model, results in all_results:
                 loss = results['loss']
                 npmis.append(results['info']['test_npmi'])
                 enc_npmis.append(results['info']['test_enc_npmi'])
@@ -498,6 +751,13 @@ class BowVAEWorker(Worker):
                 if loss < best_loss:
                     best_loss = loss
                     best_model = model
+            if isinstance(best_model, str):
+                ## parallel runs return parameter files; only the best one is loaded
+                params_file = best_model
+                best_model, _ = self._get_model(config)
+                best_model.load_parameters(params_file, ctx=self.ctx)
+                for seed_params_file, _ in all_results:
+                    os.remove(seed_params_file)
             logging.info("******************************************")
             test_type = "HELDOUT" if self.c_args.tst_vec_file else "VALIDATATION"
             if ntimes > 1:
@@ -518,9 +778,50 @@ class BowVAEWorker(Worker):
             ## in this case, no validation test data supplied
             best_model, _ = self._train_model(config, budget)
         write_model(best_model, self.model_out_dir, config, budget, self.c_args)
+
+    def _retrain_seeds(self, config, budget, rng_seed, ntimes, data_sensitive_budget):
+        """Train the configuration once per seed `rng_seed + i` in this process, yielding (model, results).
+        """
+        for i in range(ntimes):
+            seed_rng(rng_seed+i)
+            yield self._train_model(config, budget, data_sensitive_budget=data_sensitive_budget)
+
+    def _get_num_retrain_procs(self, ntimes):
+        """Number of processes for retraining with multiple seeds, bounded by `retrain_workers`, the number of cores
+        and the memory available for additional copies of the data.
+        """
+        n_procs = min(ntimes, max(1, getattr(self.c_args, 'retrain_workers', 1)), os.cpu_count() or 1)
+        if n_procs > 1:
+            mem_per_proc = _estimate_data_memory(self.data_train_csr, self.data_test_csr)
+            try:
+                avail_mem = os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+            except (ValueError, OSError, AttributeError):
+                avail_mem = None
+            if avail_mem is not None and mem_per_proc > 0:
+                n_procs = max(1, min(n_procs, int(avail_mem // mem_per_proc)))
+        return n_procs
+
+    def _retrain_seeds_parallel(self, config, budget, rng_seed, ntimes, data_sensitive_budget, n_procs):
+        """Train the configuration once per seed in a pool of `n_procs` processes. Each process loads the data and
+        trains exactly as `_retrain_seeds` would for its seed, writing the model parameters to a file.
+
+        Returns
+        -------
+        List of (parameter file, results) in seed order
+        """
+        logging.info("Retraining with {} seeds in {} processes".format(ntimes, n_procs))
+        train_out_dir = getattr(self, 'train_out_dir', self.model_out_dir)
+        threads = max(1, (os.cpu_count() or 1) // n_procs)
+        mp_ctx = multiprocessing.get_context('spawn')
+        with _worker_thread_env(threads):
+            with ProcessPoolExecutor(n_procs, mp_context=mp_ctx) as executor:
+                futures = [executor.submit(_retrain_seed, self.c_args, dict(config), budget, rng_seed + i,
+                                           data_sensitive_budget, train_out_dir, i, i == ntimes - 1)
+                           for i in range(ntimes)]
+                return [f.result() for f in futures]
         
 
-def select_model(worker, tmnt_config_space, total_iterations, result_logger, id_str, ns_port):
+def select_model(worker, tmnt_config_space, total_iterations, result_logger, id_str, ns_port, min_n_workers=1):
     """
     Top level call to model selection. 
     """
@@ -533,23 +834,36 @@ def select_model(worker, tmnt_config_space, total_iterations, result_logger, id_
                   run_id = id_str, nameserver='127.0.0.1', result_logger=result_logger, nameserver_port=ns_port,
                   min_budget=2, max_budget=worker.max_budget
            )
-    res = bohb.run(n_iterations=total_iterations)
+    res = bohb.run(n_iterations=total_iterations, min_n_workers=min_n_workers)
     bohb.shutdown(shutdown_workers=True)
     return res
 
+def _save_float32_parameters(model, pfile):
+    """Save the parameters of a model with low-precision layers as float32 (in the format of `save_parameters`).
+    """
+    params = model._collect_params_with_prefix()
+    mx.nd.save(pfile, {k: v.data().astype('float32', copy=False) for k, v in params.items()})
+
+
 def write_model(m, model_dir, config, budget, args):
     if model_dir:
         pfile = os.path.join(model_dir, 'model.params')
         sp_file = os.path.join(model_dir, 'model.config')
         vocab_file = os.path.join(model_dir, 'vocab.json')
         logging.info("Model parameters, configuration and vocabulary written to {}".format(model_dir))
-        m.save_parameters(pfile)
+        if is_low_precision(m.dtype):
+            ## saved weights are float32 so that inference models (which are float32) can load them
+            _save_float32_parameters(m, pfile)
+        else:
+            m.save_parameters(pfile)
         ## if the embedding_size wasn't set explicitly (e.g. determined via pre-trained embedding), then set it here
         if m.vocabulary.embedding:
             config['embedding_size'] = len(m.vocabulary.embedding.idx_to_vec[0])
         config['training_epochs'] = int(budget)
         if 'num_enc_layers' not in config.keys():
             config['num_enc_layers'] = m.num_enc_layers
+        if m.sparse_input:
+            config['sparse_input'] = True
         if isinstance(m, MetaDataBowNTM):
             config['n_covars'] = int(m.n_covars)
             config['l_map'] = m.label_map
@@ -561,12 +875,60 @@ def write_model(m, model_dir, config, budget, args):
             f.write(m.vocabulary.to_json())
 
 
-def get_worker(args, budget, id_str, ns_port):
+def _estimate_data_memory(train_csr, test_csr):
+    """Rough number of bytes held by a worker's copy of the training and validation data.
+    """
+    n_bytes = 0
+    for mat in (train_csr, test_csr):
+        if mat is None or sp.issparse(mat):
+            ## memory-mapped matrices are shared between processes
+            continue
+        if mat.stype == 'csr':
+            n_bytes += mat.data.size * 4 + mat.indices.size * 8 + mat.indptr.size * 8
+        else:
+            n_bytes += mat.size * 4
+    return n_bytes
+
+
+def _retrain_seed(args, config, budget, seed, data_sensitive_budget, train_out_dir, seed_id, keep_trace):
+    """Entry point of a retraining process: load the data, train the configuration with `seed` and save the
+    model parameters. Only the process for the last seed writes the trace file (as in sequential retraining).
+    """
+    os.environ["MXNET_STORAGE_FALLBACK_LOG_VERBOSE"] = "0"
+    if not keep_trace and getattr(args, 'trace_file', None):
+        args.trace_file = None
+    worker, _ = get_worker(args, budget, 'retrain', 0, train_out_dir=train_out_dir, log_name='tmnt_seed_{}'.format(seed_id))
+    if args.tst_vec_file:
+        worker.set_heldout_data_as_test()
+    seed_rng(seed)
+    model, results = worker._train_model(config, budget, data_sensitive_budget=data_sensitive_budget)
+    params_file = os.path.join(worker.model_out_dir, 'seed_{}.params'.format(seed_id))
+    model.save_parameters(params_file)
+    return params_file, results
+
+
+@contextlib.contextmanager
+def _worker_thread_env(num_threads):
+    """Cap the thread pools of processes spawned within this context to `num_threads` threads.
+    """
+    saved_env = dict(os.environ)
+    os.environ.update(get_worker_thread_env(num_threads))
+    try:
+        yield
+    finally:
+        os.environ.clear()
+        os.environ.update(saved_env)
+
+
+def get_worker(args, budget, id_str, ns_port, train_out_dir=None, worker_id=None, log_name=None):
     i_dt = datetime.datetime.now()
-    train_out_dir = \
-        os.path.join(args.save_dir,
-                     "train_{}_{}_{}_{}_{}_{}_{}".format(i_dt.year,i_dt.month,i_dt.day,i_dt.hour,i_dt.minute,i_dt.second,i_dt.microsecond))
-    logging_config(folder=train_out_dir, name='tmnt', level=logging.INFO)
+    if train_out_dir is None:
+        train_out_dir = \
+            os.path.join(args.save_dir,
+                         "train_{}_{}_{}_{}_{}_{}_{}".format(i_dt.year,i_dt.month,i_dt.day,i_dt.hour,i_dt.minute,i_dt.second,i_dt.microsecond))
+    if log_name is None:
+        log_name = 'tmnt' if worker_id is None else 'tmnt_worker_{}'.format(worker_id)
+    logging_config(folder=train_out_dir, name=log_name, level=logging.INFO)
     logging.info(args)
     seed_rng(args.seed)
     if args.vocab_file and args.tr_vec_file:
@@ -575,30 +937,86 @@ def get_worker(args, budget, id_str, ns_port):
         if not (vpath.is_file() and tpath.is_file()):
             raise Exception("Vocab file {} and/or training vector file {} do not exist".format(args.vocab_file, args.tr_vec_file))
     logging.info("Loading data via pre-computed vocabulary and sparse vector format document representation")
-    vocab, tr_csr_mat, total_tr_words, tr_labels, label_map = \
-        collect_sparse_data(args.tr_vec_file, args.vocab_file, scalar_labels=args.scalar_covars, encoding=args.str_encoding)
+    train_shards = None
+    shared_dir = getattr(args, 'shared_corpus_dir', None)
+    if args.shard_size > 0 or shared_dir:
+        ## out-of-core training: stream batches from on-disk shards rather than loading the training data
+        ## with a shared corpus directory, the shards are written once and memory-mapped by every process
+        vocab = load_vocab(args.vocab_file, encoding=args.str_encoding)
+        if shared_dir:
+            shard_dir = os.path.join(shared_dir, 'train')
+        else:
+            shard_dir = args.shard_dir if args.shard_dir else args.tr_vec_file + '.shards'
+        shard_size = args.shard_size if args.shard_size > 0 else MAX_SHARD_SIZE
+        train_shards = shard_sp_vec_file(args.tr_vec_file, shard_dir, vocab, shard_size, encoding=args.str_encoding,
+                                         mmap=bool(shared_dir))
+        if shared_dir and len(train_shards.shard_files) == 1:
+            ## a single shared shard is used directly as a memory-mapped matrix (batches sliced without a shuffle buffer)
+            logging.info("Using memory-mapped training data from {}".format(train_shards.shard_files[0]))
+            vocab, tr_csr_mat, total_tr_words, tr_labels, label_map = \
+                collect_sparse_data(train_shards.shard_files[0], args.vocab_file, scalar_labels=args.scalar_covars,
+                                    encoding=args.str_encoding, mmap=True)
+            train_shards = None
+        else:
+            tr_csr_mat, tr_labels = None, None
+            total_tr_words = train_shards.total_words
+            label_map = None if args.scalar_covars else train_shards.get_label_map()
+    else:
+        vocab, tr_csr_mat, total_tr_words, tr_labels, label_map = \
+            collect_sparse_data(args.tr_vec_file, args.vocab_file, scalar_labels=args.scalar_covars, encoding=args.str_encoding)
     if args.val_vec_file:
+        val_vec_file = args.val_vec_file
+        if shared_dir:
+            ## read validation data from a binary CSR file memory-mapped by all processes (no text parsing or copy)
+            val_vec_file = shard_sp_vec_file(args.val_vec_file, os.path.join(shared_dir, 'val'), vocab, MAX_SHARD_SIZE,
+                                             encoding=args.str_encoding, mmap=True).shard_files[0]
         tst_csr_mat, total_tst_words, tst_labels = \
-            collect_sparse_test(args.val_vec_file, vocab, scalar_labels=args.scalar_covars, encoding=args.str_encoding)
+            collect_sparse_test(val_vec_file, vocab, scalar_labels=args.scalar_covars, encoding=args.str_encoding,
+                                mmap=bool(shared_dir))
     else:
         tst_csr_mat, total_tst_words, tst_labels = None, None, None
     ctx = mx.cpu() if args.gpu is None or args.gpu == '' or int(args.gpu) < 0 else mx.gpu(int(args.gpu))
     model_out_dir = args.model_dir if args.model_dir else os.path.join(train_out_dir, 'MODEL')
     if not os.path.exists(model_out_dir):
-        os.mkdir(model_out_dir)
-    if args.use_labels_as_covars and tr_labels is not None:
+        os.makedirs(model_out_dir, exist_ok=True)
+    if args.use_labels_as_covars and (tr_labels is not None or train_shards is not None):
+        ## training labels are expanded per batch by the training data loader
         if label_map is not None:
             n_covars = len(label_map)
-            tr_labels = mx.nd.one_hot(tr_labels, n_covars)
             tst_labels = mx.nd.one_hot(tst_labels, n_covars) if tst_labels is not None else None
         else:
-            tr_labels = mx.nd.expand_dims(tr_labels, 1)
             tst_labels = mx.nd.expand_dims(tst_labels, 1) if tst_labels is not None else None
     worker = BowVAEWorker(model_out_dir, args, vocab, tr_csr_mat, total_tr_words, tst_csr_mat, total_tst_words, tr_labels, tst_labels,
-                          label_map, ctx=ctx, max_budget=budget, nameserver='127.0.0.1', run_id=id_str, nameserver_port=ns_port)
+                          label_map, ctx=ctx, max_budget=budget, train_shards=train_shards,
+                          nameserver='127.0.0.1', run_id=id_str, nameserver_port=ns_port, id=worker_id)
+    worker.train_out_dir = train_out_dir
     return worker, train_out_dir
 
 
+def _run_local_worker(args, id_str, ns_port, train_out_dir, worker_id):
+    """Entry point of a local worker process: load the data and evaluate configurations sent by the
+    BOHB master until it shuts the workers down.
+    """
+    os.environ["MXNET_STORAGE_FALLBACK_LOG_VERBOSE"] = "0"
+    worker, _ = get_worker(args, args.budget, id_str, ns_port, train_out_dir=train_out_dir, worker_id=worker_id)
+    worker.search_mode = True
+    worker.run(background=False)
+
+
+def start_local_workers(args, id_str, ns_port, train_out_dir, num_workers, threads_per_worker):
+    """Launch `num_workers` worker processes on this machine, registered with the nameserver on `ns_port`.
+    Processes are spawned (rather than forked) so each starts MXNet with its own capped thread pools.
+    """
+    mp_ctx = multiprocessing.get_context('spawn')
+    with _worker_thread_env(threads_per_worker):
+        procs = [mp_ctx.Process(target=_run_local_worker, args=(args, id_str, ns_port, train_out_dir, i), daemon=True)
+                 for i in range(1, num_workers + 1)]
+        for p in procs:
+            p.start()
+    logging.info("Started {} local worker processes with {} threads each".format(num_workers, threads_per_worker))
+    return procs
+
+
 def usedPort(port):
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     result = True
@@ -635,12 +1053,21 @@ def model_select_bow_vae(args):
     dd = datetime.datetime.now()
     id_str = dd.strftime("%Y-%m-%d_%H-%M-%S")
     NS, ns_port = robust_start(id_str)
-    worker, log_dir = get_worker(args, args.budget, id_str, ns_port)
+    num_workers = max(1, getattr(args, 'num_workers', 1))
+    worker, log_dir = get_worker(args, args.budget, id_str, ns_port, worker_id=(0 if num_workers > 1 else None))
     worker.search_mode = True
     result_logger = hpres.json_result_logger(directory=log_dir, overwrite=True)
     #NS = hpns.NameServer(run_id=id_str, host='127.0.0.1', port=ns_port)
     #NS.start()
-    res = select_model(worker, args.config_space, args.iterations, result_logger, id_str, ns_port)
+    ## this process runs one worker alongside the BOHB master; the others run in separate processes
+    procs = start_local_workers(args, id_str, ns_port, log_dir, num_workers - 1, args.worker_threads) \
+        if num_workers > 1 else []
+    res = select_model(worker, args.config_space, args.iterations, result_logger, id_str, ns_port,
+                       min_n_workers=num_workers)
+    for p in procs:
+        p.join(timeout=60)
+    ## per-budget checkpoints are only used during the search
+    shutil.rmtree(os.path.join(worker.model_out_dir, 'checkpoints'), ignore_errors=True)
     id2config = res.get_id2config_mapping()
     incumbent = res.get_incumbent_id()
     logging.info('Best found configuration:', id2config[incumbent]['config'])
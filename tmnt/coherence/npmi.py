@@ -3,16 +3,20 @@
 Copyright (c) 2019 The MITRE Corporation.
 """
 
+import io
+import os
+import tempfile
+import zipfile
 from math import log10
-from collections import Counter
+from collections import Counter, OrderedDict
 
 import numpy as np
+import scipy.sparse as sp
 import mxnet as mx
 
 from tmnt.utils.ngram_helpers import BigramReader
-from itertools import combinations
 
-__all__ = ['NPMI', 'EvaluateNPMI']
+__all__ = ['NPMI', 'EvaluateNPMI', 'CooccurrenceIndex']
 
 class NPMI(object):
 
@@ -20,12 +24,19 @@ class NPMI(object):
         self.unigram_cnts = unigram_cnts
         self.bigram_cnts = bigram_cnts
         self.n_docs = n_docs
-        
+
+    @classmethod
+    def from_bigram_reader(cls, reader: BigramReader):
+        """
+        NPMI over the document frequencies counted by a `BigramReader`.
+        """
+        return cls(reader.unigrams, reader.bigrams, reader.n_docs)
 
     def wd_id_pair_npmi(self, w1: int, w2: int):
         cw1 = self.unigram_cnts.get(w1, 0.0)
         cw2 = self.unigram_cnts.get(w2, 0.0)
-        c12 = self.bigram_cnts.get((w1, w2), 0.0)
+        ## co-occurrence is symmetric; `BigramReader` keys pairs by (lower, higher) term id
+        c12 = self.bigram_cnts.get((w1, w2), self.bigram_cnts.get((w2, w1), 0.0))
         if cw1 == 0.0 or cw2 == 0.0 or c12 == 0.0:
             return 0.0
         else:
@@ -37,49 +48,170 @@ class EvaluateNPMI(object):
     def __init__(self, top_k_words_per_topic):
         self.top_k_words_per_topic = top_k_words_per_topic
 
-    def evaluate_sp_vec(self, test_sparse_vec):
-        reader = BigramReader(test_sparse_vec)
-        npmi = NPMI(reader.unigrams, reader.bigrams, reader.n_docs)
-        total_npmi = 0
-        for i, words_per_topic in enumerate(self.top_k_words_per_topic):
-            total_topic_npmi = 0
-            N = len(words_per_topic)
-            for (w1, w2) in combinations(sorted(words_per_topic), 2):
-                wp_npmi = npmi.wd_id_pair_npmi(w1, w2)
-                total_topic_npmi += wp_npmi
-            total_topic_npmi *= (2 / (N * (N-1)))
-            total_npmi += total_topic_npmi
-        return total_npmi / len(self.top_k_words_per_topic)
+    def evaluate_sp_vec(self, test_sparse_vec, n_workers=1):
+        """
+        Average NPMI over topics using document co-occurrence counts streamed from a file in sparse vector format.
+        Only pairs among the topics' terms are counted.
+        """
+        term_ids = np.concatenate([np.array(t, dtype='int64') for t in self.top_k_words_per_topic])
+        reader = BigramReader(test_sparse_vec, term_ids=term_ids, n_workers=n_workers)
+        pair_counts = []
+        for w1, w2 in self._topic_pairs():
+            pair_counts.append((reader.pair_doc_freqs(w1, w2), reader.doc_freqs(w1), reader.doc_freqs(w2)))
+        return self._average_npmi(reader.n_docs, pair_counts, eps=0.0)
 
     def evaluate_csr_mat(self, csr_mat):
-        is_sparse = isinstance(csr_mat, mx.nd.sparse.CSRNDArray)
-        if is_sparse:
+        """
+        Average NPMI over topics using document co-occurrence counts from `csr_mat` (documents x vocabulary).
+        Only the columns for the union of all topics' terms are extracted and binarized; all pairwise
+        document frequencies are then obtained with a single (sparse) matrix product.
+        """
+        if sp.issparse(csr_mat):
+            mat = csr_mat
+        elif isinstance(csr_mat, mx.nd.sparse.CSRNDArray):
             mat = csr_mat.asscipy()
         else:
             mat = csr_mat.asnumpy()
+        is_sparse = sp.issparse(mat)
         n_docs = mat.shape[0]
+        term_ids = np.unique(np.concatenate([np.array(t, dtype='int64') for t in self.top_k_words_per_topic]))
+        occur = (mat[:, term_ids] > 0).astype('float64')
+        co_occur = occur.T.dot(occur)
+        if is_sparse:
+            co_occur = co_occur.toarray()
+        pair_counts = []
+        for w1, w2 in self._topic_pairs():
+            p1 = np.searchsorted(term_ids, w1)
+            p2 = np.searchsorted(term_ids, w2)
+            pair_counts.append((co_occur[p1, p2], co_occur[p1, p1], co_occur[p2, p2]))
+        return self._average_npmi(n_docs, pair_counts)
+
+    def evaluate_cooccurrence_index(self, index):
+        """
+        Average NPMI over topics using the document frequencies held by a `CooccurrenceIndex`.
+        """
+        topic_pairs = list(self._topic_pairs())
+        w1s = np.concatenate([w1 for w1, _ in topic_pairs])
+        w2s = np.concatenate([w2 for _, w2 in topic_pairs])
+        bigram_cnts = index.pair_doc_freqs(w1s, w2s)
+        pair_counts = []
+        offset = 0
+        for w1, w2 in topic_pairs:
+            n_pairs = len(w1)
+            pair_counts.append((bigram_cnts[offset:offset+n_pairs], index.doc_freqs[w1], index.doc_freqs[w2]))
+            offset += n_pairs
+        return self._average_npmi(index.n_docs, pair_counts)
+
+    def _topic_pairs(self):
+        for words_per_topic in self.top_k_words_per_topic:
+            words = np.array(sorted(words_per_topic), dtype='int64')
+            i1, i2 = np.triu_indices(len(words), k=1)
+            yield words[i1], words[i2]
+
+    def _average_npmi(self, n_docs, pair_counts, eps=1e-4):
+        """
+        Average NPMI over topics where `pair_counts` provides, for each topic, arrays of document
+        frequencies for its word pairs: (pair frequencies, first word frequencies, second word frequencies)
+        """
+        log_n = log10(n_docs)
         total_npmi = 0
-        for i, words_per_topic in enumerate(self.top_k_words_per_topic):
-            total_topic_npmi = 0
-            n_topics = len(words_per_topic)
-            for (w1, w2) in combinations(sorted(words_per_topic), 2):
-                o_1 = mat[:, w1] > 0
-                o_2 = mat[:, w2] > 0
-                if is_sparse:
-                    o_1 = o_1.toarray().squeeze()
-                    o_2 = o_2.toarray().squeeze()
-                occur_1 = np.array(o_1, dtype='int')
-                occur_2 = np.array(o_2, dtype='int')
-                unigram_1 = occur_1.sum()
-                unigram_2 = occur_2.sum()
-                bigram_cnt = np.sum(occur_1 * occur_2)
-                if bigram_cnt < 1:
-                    npmi = 0.0
-                else:
-                    npmi = (log10(n_docs) + log10(bigram_cnt) - log10(unigram_1) - log10(unigram_2)) / (log10(n_docs) - log10(bigram_cnt) + 1e-4)
-                total_topic_npmi += npmi
-            total_topic_npmi *= (2 / (n_topics * (n_topics-1)))
-            total_npmi += total_topic_npmi
-        return total_npmi / len(self.top_k_words_per_topic)
-        
+        for bigram_cnts, unigram_1, unigram_2 in pair_counts:
+            found = bigram_cnts >= 1
+            bigram_log = np.log10(np.where(found, bigram_cnts, 1.0))
+            unigram_logs = np.log10(np.maximum(unigram_1, 1.0)) + np.log10(np.maximum(unigram_2, 1.0))
+            npmis = np.where(found, (log_n + bigram_log - unigram_logs) / (log_n - bigram_log + eps), 0.0)
+            total_npmi += npmis.mean()
+        return float(total_npmi / len(self.top_k_words_per_topic))
+
+
+class CooccurrenceIndex(object):
+    """
+    Document frequencies over a fixed document collection for repeated coherence evaluation.
+    Unigram document frequencies are computed once; pairwise document frequencies are computed
+    on demand and memoized in a bounded LRU cache keyed by term pair.
+
+    Parameters
+    ----------
+    csr_mat : CSRNDArray, NDArray or `scipy.sparse.csr_matrix` with shape (documents x vocabulary)
+    max_pairs : int (default 200000) maximum number of memoized term pairs
+    """
+    def __init__(self, csr_mat, max_pairs=200000):
+        if sp.issparse(csr_mat):
+            mat = csr_mat
+        elif isinstance(csr_mat, mx.nd.sparse.CSRNDArray):
+            mat = csr_mat.asscipy()
+        else:
+            mat = sp.csr_matrix(csr_mat.asnumpy())
+        occur = (mat > 0).astype('int32')
+        self.n_docs, self.vocab_size = occur.shape
+        self.occurrences = occur.tocsc()
+        self.doc_freqs = np.asarray(occur.sum(axis=0), dtype='float64').ravel()
+        self.max_pairs = max_pairs
+        self.pair_cache = OrderedDict()
+
+    def _memoize(self, key, cnt):
+        self.pair_cache[key] = cnt
+        if len(self.pair_cache) > self.max_pairs:
+            self.pair_cache.popitem(last=False)
+
+    def pair_doc_freqs(self, w1s, w2s):
+        """
+        Number of documents containing both terms for each pair (w1s[i], w2s[i]).
+        Pairs not already memoized are computed together with a single sparse matrix product.
+        """
+        keys = list(zip(np.minimum(w1s, w2s).tolist(), np.maximum(w1s, w2s).tolist()))
+        cnts = np.zeros(len(keys))
+        missing = []
+        for i, key in enumerate(keys):
+            cnt = self.pair_cache.get(key)
+            if cnt is None:
+                missing.append(i)
+            else:
+                self.pair_cache.move_to_end(key)
+                cnts[i] = cnt
+        if missing:
+            missing_keys = np.array([keys[i] for i in missing], dtype='int64')
+            term_ids = np.unique(missing_keys)
+            cols = self.occurrences[:, term_ids]
+            co_occur = cols.T.dot(cols).toarray()
+            pos = np.searchsorted(term_ids, missing_keys)
+            missing_cnts = co_occur[pos[:, 0], pos[:, 1]]
+            cnts[missing] = missing_cnts
+            for key, cnt in zip(map(tuple, missing_keys.tolist()), missing_cnts.tolist()):
+                self._memoize(key, cnt)
+        return cnts
+
+    def save(self, path):
+        """
+        Write memoized pair frequencies (along with the unigram frequencies used to validate them) to `path`.
+        The file is written to a temporary file unique to this call and then renamed, so concurrent processes
+        saving to the same `path` never interleave their writes.
+        """
+        pairs = np.array(list(self.pair_cache.keys()), dtype='int64').reshape(-1, 2)
+        pair_cnts = np.array(list(self.pair_cache.values()), dtype='int64')
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+                                        prefix=os.path.basename(path) + '.', suffix='.tmp')
+        try:
+            with io.open(fd, 'wb') as fp:
+                np.savez(fp, n_docs=self.n_docs, doc_freqs=self.doc_freqs, pairs=pairs, pair_doc_freqs=pair_cnts)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
 
+    def load(self, path):
+        """
+        Load memoized pair frequencies written by `save`. Returns False (and loads nothing) if they
+        were computed over a different document collection or the file cannot be read (e.g. is corrupt).
+        """
+        try:
+            with np.load(path) as d:
+                if int(d['n_docs']) != self.n_docs or not np.array_equal(d['doc_freqs'], self.doc_freqs):
+                    return False
+                pairs, pair_cnts = d['pairs'].tolist(), d['pair_doc_freqs'].tolist()
+        except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+            return False
+        for key, cnt in zip(map(tuple, pairs), pair_cnts):
+            self._memoize(key, cnt)
+        return True
@@ -19,10 +19,48 @@ def get_base_argparser():
     parser.add_argument('--encoder_coherence', action='store_true', help='Get top K terms for coherence via encoder Jacobian')
     parser.add_argument('--optimize_encoder_coherence', action='store_true', help='Optimize encoder-derived coherence')
     parser.add_argument('--num_final_evals', type=int, help='Number of times to evaluate selected configuration (with random initializations)', default=1)
+    parser.add_argument('--retrain_workers', type=int, default=1,
+                        help='Number of processes training the final evaluations in parallel (bounded by cores and available memory)')
     parser.add_argument('--init_sparsity_pen', type=float, default = 0.00001)
     parser.add_argument('--sparsity_threshold', type=float, default = 0.001)
     parser.add_argument('--str_encoding', type=str, default='utf-8')
+    parser.add_argument('--cooccur_cache', action='store_true',
+                        help='Save/reuse term co-occurrence counts for coherence in a file next to the validation/test vector file')
+    parser.add_argument('--shard_size', type=int, default=0,
+                        help='Stream training data from on-disk shards of this many documents (default 0 = load into memory)')
+    parser.add_argument('--shard_dir', type=str, default=None,
+                        help='Directory for training data shards (default is the training vector file path + .shards)')
+    parser.add_argument('--shared_corpus_dir', type=str, default=None,
+                        help='Write training/validation data once to this directory and memory-map it (shared by concurrent processes)')
+    parser.add_argument('--shuffle_buffer', type=int, default=10000, help='Number of documents in the shuffle buffer when using shards')
+    parser.add_argument('--max_resident_shards', type=int, default=2, help='Maximum number of training shards held in memory')
+    parser.add_argument('--prefetch_batches', type=int, default=4,
+                        help='Number of training batches prepared ahead on a background thread (0 = prepare synchronously)')
+    parser.add_argument('--log_interval', type=int, default=0,
+                        help='Log running training losses every N batches (default 0 = only at the end of each epoch)')
+    parser.add_argument('--log_batch_details', action='store_true',
+                        help='Synchronize and log losses after every training batch (for debugging; slows training)')
+    parser.add_argument('--budget_checkpoints', action='store_true',
+                        help='Checkpoint each (configuration, budget) and resume training at higher budgets from the largest lower-budget checkpoint')
+    parser.add_argument('--early_stop_patience', type=int, default=0,
+                        help='Stop training when the validation metric has not improved for this many evaluations (default 0 = off)')
+    parser.add_argument('--early_stop_metric', type=str, default='perplexity', choices=['perplexity', 'npmi'],
+                        help='Validation metric monitored for early stopping')
+    parser.add_argument('--early_stop_min_delta', type=float, default=0.0,
+                        help='Minimum decrease in perplexity (or increase in NPMI) counted as an improvement')
+    parser.add_argument('--sparse_input', action='store_true',
+                        help='Use a first layer that multiplies sparse (CSR) document batches directly rather than densifying them')
+    parser.add_argument('--dtype', type=str, choices=['float32', 'bfloat16', 'float16'], default='float32',
+                        help='Data type of the vocabulary-sized (embedding and decoder) layers; float16 requires a GPU')
     parser.add_argument('--hybridize', action='store_true', help='Use Symbolic computation graph (i.e. MXNet hybridize)')
     parser.add_argument('--gpu', type=int, help='GPU device ID (-1 default = CPU)', default=-1)
     return parser
 
+
+
+def get_worker_thread_env(num_threads):
+    """Environment variables capping the number of threads used by OpenMP/MKL and the MXNet CPU engine
+    in a worker process. These must be set before MXNet is loaded.
+    """
+    n = str(max(1, int(num_threads)))
+    return {'OMP_NUM_THREADS': n, 'MKL_NUM_THREADS': n, 'OPENBLAS_NUM_THREADS': n, 'MXNET_CPU_WORKER_NTHREADS': n}
@@ -9,12 +9,17 @@ import numpy as np
 from scipy import special as sp
 from mxnet import gluon
 from tmnt.distributions.latent_distrib import LatentDistribution
+from tmnt.utils.mixed_precision import get_compute_dtype, is_low_precision
 
 __all__ = ['HyperSphericalLatentDistribution']
 
 class HyperSphericalLatentDistribution(LatentDistribution):
+    """
+    von Mises-Fisher latent distribution. Sample weights are drawn from a pre-generated cache of `num_samples`
+    values, stored in `dtype` (computation is in float32).
+    """
 
-    def __init__(self, n_latent, kappa=100.0, dr=0.2, ctx=mx.cpu()):
+    def __init__(self, n_latent, kappa=100.0, dr=0.2, dtype='float32', ctx=mx.cpu()):
         super(HyperSphericalLatentDistribution, self).__init__(n_latent, ctx)
         self.ctx = ctx
         self.kappa = kappa
@@ -37,6 +42,9 @@ class HyperSphericalLatentDistribution(LatentDistribution):
         self.mu_bn.collect_params().setattr('grad_req', 'null')
         self.vmf_samples.initialize(ctx=self.ctx)
         self.vmf_samples.set_data(self.w_samples)
+        self.low_precision_cache = is_low_precision(dtype)
+        if self.low_precision_cache:
+            self.vmf_samples.cast(get_compute_dtype(dtype, ctx))
         
 
     def hybrid_forward(self, F, data, batch_size, kld_const, vmf_samples):
@@ -95,7 +103,8 @@ class HyperSphericalLatentDistribution(LatentDistribution):
 
     def _get_weight_from_cache(self, F, batch_size, vmf_samples):
         to_select = F.random.randint(low=0, high=self.num_samples, shape=(batch_size,))
-        return F.take(vmf_samples, to_select)
+        sw = F.take(vmf_samples, to_select)
+        return F.amp_cast(sw, dtype='float32') if self.low_precision_cache else sw
 
     def _get_weight_batch(self, F, batch_size):
         dim = self.n_latent
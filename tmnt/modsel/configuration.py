@@ -104,6 +104,15 @@ class TMNTConfig(object):
         if num_enc_layers_c:
             cs.add_hyperparameters([num_enc_layers_c])
 
+        recon_loss_c = self._get_categorical('recon_loss', cd)
+        if recon_loss_c:
+            cs.add_hyperparameters([recon_loss_c])
+            recon_neg_samples_c = self._get_range_integer('recon_neg_samples', cd)
+            if recon_neg_samples_c and recon_loss_c.is_legal('sampled'):
+                cs.add_hyperparameters([recon_neg_samples_c])
+                if len(recon_loss_c.choices) > 1:
+                    cs.add_condition(CS.EqualsCondition(recon_neg_samples_c, recon_loss_c, 'sampled'))
+
         if enc_dr_c:
             cs.add_hyperparameters([enc_dr_c])
 
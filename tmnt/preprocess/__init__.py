@@ -6,5 +6,6 @@ Copyright (c) 2019 The MITRE Corporation.
 
 from .tokenizer import *
 from .vectorizer import *
+from .scheduler import *
 
-__all__ = tokenizer.__all__ + vectorizer.__all__ 
+__all__ = tokenizer.__all__ + vectorizer.__all__ + scheduler.__all__
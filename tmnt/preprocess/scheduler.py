@@ -0,0 +1,124 @@
+# coding: utf-8
+"""
+Copyright (c) 2020 The MITRE Corporation.
+
+Dynamic scheduling of file processing across worker processes. Files are divided into work units (line-aligned
+byte ranges of large files or groups of small files) that idle workers take from a shared queue, largest first.
+"""
+
+import io
+import os
+import time
+import logging
+import multiprocessing
+from collections import namedtuple
+
+__all__ = ['WorkUnit', 'get_line_aligned_ranges', 'make_work_units', 'run_work_units']
+
+WorkUnit = namedtuple('WorkUnit', ['index', 'pieces', 'size'])
+WorkUnit.__doc__ = """
+Unit of work: `pieces` is a list of (file, start, end) byte ranges (with `end` None for a whole file), `size` the
+number of bytes covered and `index` the position of the unit in file order.
+"""
+
+
+def get_line_aligned_ranges(path, n_ranges):
+    """
+    Split a file into `n_ranges` byte ranges (start, end) whose boundaries fall on line starts.
+    """
+    size = os.path.getsize(path)
+    bounds = [0]
+    with io.open(path, 'rb') as fp:
+        for i in range(1, n_ranges):
+            fp.seek(max(bounds[-1], size * i // n_ranges))
+            if fp.tell() > 0:
+                fp.seek(fp.tell() - 1)
+                fp.readline()  ## advance to the start of the next line
+            bounds.append(fp.tell())
+    bounds.append(size)
+    return [(s, e) for s, e in zip(bounds[:-1], bounds[1:]) if e > s]
+
+
+def make_work_units(files, split_size=(1 << 26), group_size=(1 << 22), splittable=True):
+    """
+    Divide `files` into work units. With `splittable` (i.e. one record per line) files larger than `split_size`
+    bytes are split into line-aligned ranges of about `split_size` bytes; consecutive smaller files are grouped
+    into units of up to `group_size` bytes. Units are indexed in file order so results can be reassembled in
+    that order.
+    """
+    units = []
+    group, group_bytes = [], 0
+    for f in files:
+        size = os.path.getsize(f)
+        if group and group_bytes + size > group_size:
+            units.append(WorkUnit(len(units), group, group_bytes))
+            group, group_bytes = [], 0
+        if splittable and size > split_size:
+            for s, e in get_line_aligned_ranges(f, -(-size // split_size)):
+                units.append(WorkUnit(len(units), [(f, s, e)], e - s))
+        else:
+            group.append((f, 0, None))
+            group_bytes += size
+    if group:
+        units.append(WorkUnit(len(units), group, group_bytes))
+    return units
+
+
+_worker_fn = None
+
+def _init_worker(fn):
+    global _worker_fn
+    _worker_fn = fn
+
+def _run_unit(unit):
+    start = time.time()
+    result = _worker_fn(unit)
+    return unit.index, result, os.getpid(), time.time() - start
+
+
+def run_work_units(fn, units, n_workers=None, name='Processing'):
+    """
+    Apply `fn` to each work unit in a pool of `n_workers` processes (default: number of CPUs). Units are queued
+    largest first and each worker takes the next unit as soon as it finishes one, so no worker is left with a
+    fixed share of the work. Progress is logged as units complete, followed by a summary for each worker.
+    Workers are spawned rather than forked (the calling process may already have started MXNet), so `fn` must be
+    picklable, e.g. a module-level function or a `functools.partial` of a method of a picklable object; it is sent
+    to each worker once.
+
+    Returns
+    -------
+    list of the results of `fn` in unit (file) order
+    """
+    n_workers = min(n_workers or multiprocessing.cpu_count(), max(1, len(units)))
+    order = sorted(units, key=lambda u: -u.size)
+    total_bytes = sum(u.size for u in units)
+    results = [None] * len(units)
+    worker_stats = {}
+    done_bytes = 0
+    if n_workers > 1:
+        pool = multiprocessing.get_context('spawn').Pool(n_workers, initializer=_init_worker, initargs=(fn,))
+        completed = pool.imap_unordered(_run_unit, order)
+    else:
+        pool = None
+        _init_worker(fn)
+        completed = map(_run_unit, order)
+    try:
+        for k, (i, result, pid, elapsed) in enumerate(completed):
+            results[i] = result
+            n_units, n_bytes, secs = worker_stats.get(pid, (0, 0, 0.0))
+            worker_stats[pid] = (n_units + 1, n_bytes + units[i].size, secs + elapsed)
+            done_bytes += units[i].size
+            logging.info("{}: {}/{} units, {:.1f}/{:.1f} MB [worker {} finished unit {} ({:.1f} MB) in {:.1f}s]"
+                         .format(name, k + 1, len(units), done_bytes / 1e6, total_bytes / 1e6, pid, i,
+                                 units[i].size / 1e6, elapsed))
+    except BaseException:
+        if pool is not None:
+            pool.terminate()
+        raise
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    for pid, (n_units, n_bytes, secs) in sorted(worker_stats.items()):
+        logging.info("{}: worker {} processed {} units ({:.1f} MB) in {:.1f}s".format(name, pid, n_units, n_bytes / 1e6, secs))
+    return results
@@ -7,20 +7,25 @@ Copyright (c) 2019 The MITRE Corporation.
 import unicodedata
 import re
 import io
+import sys
+from collections import OrderedDict
 
-__all__ = ['BasicTokenizer']
+__all__ = ['BasicTokenizer', 'FastBasicTokenizer']
 
 class BasicTokenizer(object):
     """Runs basic tokenization (punctuation splitting, lower casing, etc.)."""
 
-    def __init__(self, do_lower_case=True, use_stop_words=True, custom_stop_word_file=None, encoding='utf-8'):
+    def __init__(self, do_lower_case=True, use_stop_words=True, custom_stop_word_file=None, encoding='utf-8',
+                 cache_size=100000):
         self.encoding = encoding
         self.do_lower_case = do_lower_case
         self.use_stop_words = use_stop_words
         self.stop_word_set = \
             self.get_stop_word_set(custom_stop_word_file) if custom_stop_word_file is not None else default_stop_words
         self.num_re = re.compile('[-+]?[.\d]*[\d]+[:,.\d]*$') ## matches straight number
-        
+        self.cache_size = cache_size
+        self._word_cache = OrderedDict() ## LRU map: raw word -> tuple of output tokens (empty if filtered)
+
     def get_stop_word_set(self, f):
         wds = []
         with io.open(f, 'r', encoding=self.encoding) as fp:
@@ -56,6 +61,44 @@ class BasicTokenizer(object):
         output_tokens = self.whitespace_tokenize(' '.join(final_tokens))
         return output_tokens
 
+    def tokenize_batch(self, texts):
+        """
+        Tokenizes a list of texts, returning a list of token lists identical to calling `tokenize` on each.
+        Each whitespace-delimited word is normalized (lower casing, accent stripping, punctuation splitting and
+        filtering) once and the result kept in a bounded LRU cache of `cache_size` words, so frequent surface
+        forms are not re-normalized across documents or calls.
+        """
+        cache = self._word_cache
+        batch_tokens = []
+        for text in texts:
+            tokens = []
+            for word in self._clean_for_batch(self.to_unicode(text)).split():
+                word_tokens = cache.get(word)
+                if word_tokens is None:
+                    word_tokens = self._normalize_word(word)
+                    cache[word] = word_tokens
+                    if len(cache) > self.cache_size:
+                        cache.popitem(last=False)
+                else:
+                    cache.move_to_end(word)
+                tokens.extend(word_tokens)
+            batch_tokens.append(tokens)
+        return batch_tokens
+
+    def _clean_for_batch(self, text):
+        return self._clean_text(text)
+
+    def _normalize_word(self, word):
+        """Output tokens for a single whitespace-delimited word of cleaned text."""
+        ## lower casing and NFD normalization never cross whitespace, so words can be normalized independently
+        if self.do_lower_case:
+            word = self._run_strip_accents(word.lower())
+        split_tokens = self._run_split_on_punc(word, keep_punct=False)
+        if self.use_stop_words:
+            return tuple(t for t in split_tokens if len(t) > 1 and not t in self.stop_word_set and not self.num_re.match(t))
+        else:
+            return tuple(t for t in split_tokens if len(t) > 1 and not self.num_re.match(t))
+
     def whitespace_tokenize(self, text):
         """Runs basic whitespace cleaning and splitting on a piece of text."""
         text = text.strip()
@@ -143,6 +186,138 @@ class BasicTokenizer(object):
             return True
         return False
 
+def _char_class(cps):
+    """Regular expression character class body matching the (sorted) code points `cps`."""
+    ranges = []
+    for cp in cps:
+        if ranges and ranges[-1][1] == cp - 1:
+            ranges[-1][1] = cp
+        else:
+            ranges.append([cp, cp])
+    return ''.join('\\U{:08x}'.format(s) if s == e else '\\U{:08x}-\\U{:08x}'.format(s, e) for s, e in ranges)
+
+
+_fast_patterns = None
+
+def _get_fast_patterns():
+    """
+    Compiled patterns used by `FastBasicTokenizer`, built once per process by classifying every code point
+    exactly as `BasicTokenizer` does. Character classes limited to the Basic Multilingual Plane compile to
+    constant-time lookup tables, while classes with astral code points are matched range by range; so
+    each pattern has a BMP version ('bmp') and a full version ('full') used only for text with astral characters.
+    """
+    global _fast_patterns
+    if _fast_patterns is None:
+        ## same classification as BasicTokenizer._is_control and BasicTokenizer._is_punctuation
+        removed, marks, punct = [0, 0xfffd], [], []
+        for cp in range(sys.maxunicode + 1):
+            cat = unicodedata.category(chr(cp))
+            if cat[0] == 'C' and cp not in (9, 10, 13):
+                removed.append(cp)
+            if cat == 'Mn':
+                marks.append(cp)
+            if cat[0] in 'PSCM' or 33 <= cp <= 47 or 58 <= cp <= 64 or 91 <= cp <= 96 or 123 <= cp <= 126:
+                punct.append(cp)
+        removed = sorted(set(removed))
+        def compile_patterns(max_cp):
+            return {
+                'remove': re.compile('[' + _char_class([c for c in removed if c <= max_cp]) + ']+'),
+                'marks': re.compile('[' + _char_class([c for c in marks if c <= max_cp]) + ']+'),
+                ## tokens are maximal runs of characters that are neither whitespace (as for str.split) nor punctuation
+                'token': re.compile('[^\\s' + _char_class([c for c in punct if c <= max_cp]) + ']+')
+            }
+        _fast_patterns = {
+            'bmp': compile_patterns(0xffff),
+            'full': compile_patterns(sys.maxunicode),
+            'astral': re.compile('[\\U00010000-\\U{:08x}]'.format(sys.maxunicode)),
+            'ascii_remove': str.maketrans('', '', ''.join(chr(c) for c in removed if c < 128)),
+            'ascii_token': re.compile('[A-Za-z0-9]+')
+        }
+    return _fast_patterns
+
+
+class FastBasicTokenizer(BasicTokenizer):
+    """
+    Produces the same tokens as `BasicTokenizer` using precompiled regular expressions and translation tables
+    instead of per-character Python code. Pure ASCII text skips Unicode normalization entirely.
+    The patterns are built on first use (taking about a second) and shared by all instances in a process.
+    """
+
+    def __init__(self, do_lower_case=True, use_stop_words=True, custom_stop_word_file=None, encoding='utf-8',
+                 cache_size=100000):
+        super(FastBasicTokenizer, self).__init__(do_lower_case=do_lower_case, use_stop_words=use_stop_words,
+                                                 custom_stop_word_file=custom_stop_word_file, encoding=encoding,
+                                                 cache_size=cache_size)
+        self._set_patterns()
+
+    def _set_patterns(self):
+        pats = _get_fast_patterns()
+        self._bmp_patterns = pats['bmp']
+        self._full_patterns = pats['full']
+        self._astral_re = pats['astral']
+        self._ascii_remove = pats['ascii_remove']
+        self._ascii_token_re = pats['ascii_token']
+
+    def __getstate__(self):
+        ## compiled patterns are shared per process (and rebuilt on unpickling); the word cache is not copied
+        state = dict(self.__dict__)
+        for k in ['_bmp_patterns', '_full_patterns', '_astral_re', '_ascii_remove', '_ascii_token_re']:
+            del state[k]
+        state['_word_cache'] = OrderedDict()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._set_patterns()
+
+    def _patterns(self, text):
+        return self._full_patterns if self._astral_re.search(text) else self._bmp_patterns
+
+    def tokenize(self, text):
+        """Tokenizes a piece of text."""
+        text = self.to_unicode(text)
+        if text.isascii():
+            ## ASCII has no decompositions or combining marks and its only word characters are letters and digits
+            text = text.translate(self._ascii_remove)
+            if self.do_lower_case:
+                text = text.lower()
+            return self._filter_tokens(self._ascii_token_re.findall(text))
+        text = self._patterns(text)['remove'].sub('', text)
+        return self._filter_tokens(self._split_non_ascii(text))
+
+    def _split_non_ascii(self, text):
+        ## normalization and punctuation splitting of cleaned, non-ASCII text
+        if self.do_lower_case:
+            text = unicodedata.normalize('NFD', text.lower())
+            pats = self._patterns(text)
+            text = pats['marks'].sub('', text)
+        else:
+            pats = self._patterns(text)
+        return pats['token'].findall(text)
+
+    def _filter_tokens(self, split_tokens):
+        ## tokens contain no punctuation, so the number pattern only matches tokens made entirely of digits
+        if self.use_stop_words:
+            stop_words = self.stop_word_set
+            return [t for t in split_tokens if len(t) > 1 and not t in stop_words and not t.isdecimal()]
+        else:
+            return [t for t in split_tokens if len(t) > 1 and not t.isdecimal()]
+
+    def _clean_for_batch(self, text):
+        if text.isascii():
+            return text.translate(self._ascii_remove)
+        return self._patterns(text)['remove'].sub('', text)
+
+    def _normalize_word(self, word):
+        if word.isascii():
+            if self.do_lower_case:
+                word = word.lower()
+            split_tokens = self._ascii_token_re.findall(word)
+        else:
+            split_tokens = self._split_non_ascii(word)
+        return tuple(self._filter_tokens(split_tokens))
+
+
 default_stop_words = \
     set([
         'able',
@@ -9,93 +9,208 @@ import os
 import json
 import gluonnlp as nlp
 import glob
+import itertools
+import functools
+import shutil
+import array
+import numpy as np
 from gluonnlp.data import Counter
 from multiprocessing import Pool, cpu_count
-from mantichora import mantichora
-from atpbar import atpbar
 import threading
 import logging
 import threading
 from queue import Queue
 from tmnt.utils.log_utils import logging_config
+from tmnt.utils.csr_file import CSRFileWriter, vocab_hash, merge_csr_files
 
-from tmnt.preprocess import BasicTokenizer
+from tmnt.preprocess import FastBasicTokenizer
+from tmnt.preprocess.scheduler import make_work_units, run_work_units
 
 __all__ = ['JsonVectorizer', 'TextVectorizer']
 
 class Vectorizer(object):
 
-    def __init__(self, custom_stop_word_file=None, encoding='utf-8'):
+    def __init__(self, custom_stop_word_file=None, encoding='utf-8', n_workers=None):
         self.encoding = encoding
-        self.tokenizer = BasicTokenizer(use_stop_words=True, custom_stop_word_file=custom_stop_word_file,
-                                        encoding=encoding)
+        self.tokenizer = FastBasicTokenizer(use_stop_words=True, custom_stop_word_file=custom_stop_word_file,
+                                            encoding=encoding)
         self.json_rewrite = False
+        self.n_workers = n_workers or cpu_count()
+        self.splittable = False ## whether input files may be split on line boundaries across workers
 
 
+    def get_work_units(self, files):
+        return make_work_units(files, splittable=self.splittable)
+
+    def open_range(self, path, start=0, end=None):
+        """Open a text file, or only the byte range [start, end) of it (starting on a line boundary)."""
+        if end is None:
+            return io.open(path, 'r', encoding=self.encoding)
+        with io.open(path, 'rb') as fp:
+            fp.seek(start)
+            data = fp.read(end - start)
+        return io.TextIOWrapper(io.BytesIO(data), encoding=self.encoding)
+
+    def iter_unit_docs(self, unit):
+        """Yield (tokens, label_str) for each document in a work unit."""
+        for path, start, end in unit.pieces:
+            for doc in self.iter_file_docs(path, start, end):
+                yield doc
+
+    def count_unit(self, unit):
+        counter = Counter()
+        for toks, _ in self.iter_unit_docs(unit):
+            counter = nlp.data.count_tokens(toks, counter = counter)
+        return counter
+
     def get_counter_dir_parallel(self, data_dir, pat):
-        raise NotImplementedError('Vectorizer must be instantiated as TextVectorizer or JsonVectorizer')
+        files = glob.glob(data_dir + '/' + pat)
+        units = self.get_work_units(files)
+        logging.info("Counting vocabulary over {} files with {} work units".format(len(files), len(units)))
+        counters = run_work_units(self.count_unit, units, self.n_workers, name="Counting Vocab Items")
+        return sum(counters, Counter())
 
-    def vectorize_fn(self, file_and_vocab):
-        raise NotImplementedError('Vectorizer fn must be specified by concrete subclass')
-    
     def get_vocab(self, counter, size):
         vocab = nlp.Vocab(counter, unknown_token=None, padding_token=None,
                           bos_token=None, eos_token=None, min_freq=5, max_size=size)
         return vocab
 
-    def chunks(self, l, n):
-        """Yield successive n-sized chunks from l."""
-        for i in range(0, len(l), n):
-            yield l[i:i + n]
-
-    def task_vec_fn(self, name, files):
-        sp_vecs = []
-        for i in atpbar(range(len(files)), name=name):
-            sp_vecs.extend(self.vectorize_fn(files[i]))
-        return sp_vecs
+    def line_batches(self, fp, n=1000):
+        """Yield successive lists of up to n lines from file object fp."""
+        while True:
+            lines = list(itertools.islice(fp, n))
+            if not lines:
+                return
+            yield lines
+
+    def vectorize_unit(self, unit, vocab, sp_out_file, binary):
+        """
+        Vectorize the documents of a work unit writing them to its shard of `sp_out_file` (or rewrite its files
+        as JSON with vectors added).
+        """
+        if self.json_rewrite:
+            for path, _, _ in unit.pieces:
+                self.vectorize_fn_to_json((path, vocab))
+            return None
+        shard_file = self.shard_file(sp_out_file, unit.index)
+        with _SparseVecShardWriter(shard_file, len(vocab), binary, encoding=self.encoding) as writer:
+            for toks, label_str in self.iter_unit_docs(unit):
+                tok_ids = [vocab[token] for token in toks if token in vocab]
+                if (len(tok_ids) >= self.min_doc_size):
+                    ids, cnts = zip(*sorted(nlp.data.count_tokens(tok_ids).items()))
+                    writer.write_doc(ids, cnts, label_str)
+        return shard_file
 
-    def no_return_task_vec_fn(self, name, files):
-        for i in atpbar(range(len(files)), name=name):
-            self.vectorize_fn(files[i])
-        return None
 
+    def merge_shards(self, shard_files, sp_out_file, vocab, binary):
+        """Concatenate the vector shards written by the workers into `sp_out_file` and remove them."""
+        if binary:
+            merge_csr_files(shard_files, sp_out_file, v_hash=vocab_hash(vocab.idx_to_token))
+        else:
+            with io.open(sp_out_file, 'wb') as out:
+                for shard_file in shard_files:
+                    with io.open(shard_file, 'rb') as fp:
+                        shutil.copyfileobj(fp, out, 1 << 24)
+        for shard_file in shard_files:
+            os.remove(shard_file)
+
+    def shard_file(self, sp_out_file, i):
+        return "{}.shard-{:05d}".format(sp_out_file, i)
+
+    def iter_file_docs(self, path, start=0, end=None):
+        """Yield (tokens, label_str) for each document in a file (or the byte range [start, end) of it)."""
+        raise NotImplementedError('Document iteration must be specified by concrete subclass')
+
+    def tokenize_unit(self, unit, sp_out_file):
+        """
+        Tokenize each document in a work unit once, mapping tokens to ids in a provisional dictionary local to
+        the unit. The concatenated token ids of all documents, document offsets into the ids and document labels
+        are saved to a temporary file next to the unit's shard; the dictionary's tokens (in id order) and their
+        counts are returned.
+        """
+        token_ids = {}
+        label_ids = {}
+        ids = array.array('q')
+        offsets = array.array('q', [0])
+        doc_labels = array.array('l')
+        for toks, label in self.iter_unit_docs(unit):
+            ids.extend([token_ids.setdefault(t, len(token_ids)) for t in toks])
+            offsets.append(len(ids))
+            doc_labels.append(label_ids.setdefault(str(label), len(label_ids)))
+        ids = np.array(ids, dtype='int64')
+        np.savez(self.shard_file(sp_out_file, unit.index) + '.tmp.npz', ids=ids, offsets=np.array(offsets, dtype='int64'),
+                 label_ids=np.array(doc_labels, dtype='int64'), label_strs=np.array(list(label_ids), dtype='str'))
+        return list(token_ids), np.bincount(ids, minlength=len(token_ids))
+
+    def remap_unit(self, unit, remaps, sp_out_file, n_cols, binary):
+        """
+        Map the provisional token ids saved by `tokenize_unit` to vocabulary ids with `remaps[unit.index]`,
+        dropping out-of-vocabulary tokens and documents that are then shorter than `min_doc_size`, and write
+        the vectors to the unit's shard of `sp_out_file`.
+        """
+        shard_file = self.shard_file(sp_out_file, unit.index)
+        with np.load(shard_file + '.tmp.npz') as docs:
+            offsets, label_ids, label_strs = docs['offsets'], docs['label_ids'], docs['label_strs'].tolist()
+            vocab_ids = remaps[unit.index][docs['ids']]
+        with _SparseVecShardWriter(shard_file, n_cols, binary, encoding=self.encoding) as writer:
+            for j in range(len(label_ids)):
+                doc_ids = vocab_ids[offsets[j]:offsets[j+1]]
+                doc_ids = doc_ids[doc_ids >= 0]
+                if len(doc_ids) >= self.min_doc_size:
+                    u_ids, cnts = np.unique(doc_ids, return_counts=True)
+                    writer.write_doc(u_ids, cnts, label_strs[label_ids[j]])
+        os.remove(shard_file + '.tmp.npz')
+        return shard_file
+
+    def get_sparse_vecs_single_pass(self, files, vocab_size, sp_out_file, binary):
+        """
+        Build the vocabulary and vector shards for `files` tokenizing each document only once.
+        Returns the shard files, the vocabulary and the token counter.
+        """
+        units = self.get_work_units(files)
+        logging.info("Counting vocabulary and vectorizing {} files with {} work units".format(len(files), len(units)))
+        unit_results = run_work_units(functools.partial(self.tokenize_unit, sp_out_file=sp_out_file), units,
+                                      self.n_workers, name="Tokenizing")
+        counter = Counter()
+        for tokens, counts in unit_results:
+            counter.update(dict(zip(tokens, counts.tolist())))
+        vocab = self.get_vocab(counter, vocab_size)
+        remaps = [np.array([vocab.token_to_idx.get(t, -1) for t in tokens], dtype='int64') for tokens, _ in unit_results]
+        shard_files = run_work_units(functools.partial(self.remap_unit, remaps=remaps, sp_out_file=sp_out_file,
+                                                       n_cols=len(vocab), binary=binary),
+                                     units, self.n_workers, name="Vectorizing")
+        return shard_files, vocab, counter
+
+    def vectorize_files(self, files, vocab, sp_out_file=None, binary=False):
+        """
+        Vectorize `files` against a given vocabulary into shards of `sp_out_file` and return the shard files
+        (or rewrite the files as JSON with vectors added).
+        """
+        units = self.get_work_units(files)
+        return run_work_units(functools.partial(self.vectorize_unit, vocab=vocab, sp_out_file=sp_out_file, binary=binary),
+                              units, self.n_workers, name="Vectorizing")
 
     def get_sparse_vecs(self, sp_out_file, vocab_out_file, data_dir, vocab_size=2000, i_vocab=None,
-                        full_histogram_file=None, pat='*.json'):
+                        full_histogram_file=None, pat='*.json', binary=False, single_pass=True):
+        """
+        Vectorize the files matching `pat` in `data_dir`, building a vocabulary of at most `vocab_size` terms if
+        `i_vocab` is not provided. With `single_pass` (and without JSON rewriting) the vocabulary is built
+        from the same tokenization pass that produces the vectors; otherwise the files are tokenized
+        once to count terms and again to vectorize them. Each worker writes its vectors to a shard
+        next to `sp_out_file` and the shards are then concatenated.
+        """
         files = glob.glob(data_dir + '/' + pat)
-        if i_vocab is None:
-            counter = self.get_counter_dir_parallel(data_dir, pat)
-            vocab = self.get_vocab(counter, vocab_size)
-        else:
-            vocab = i_vocab
-        files_and_vocab = [(f,vocab) for f in files]
-        
-        if self.json_rewrite:
-            vec_fn = self.no_return_task_vec_fn
-        else:
-            vec_fn = self.task_vec_fn
-        if True:
-            file_batches = list(self.chunks(files_and_vocab, max(1, len(files_and_vocab) // cpu_count())))
-            with mantichora() as mcore:
-                for i in range(len(file_batches)):
-                    mcore.run(vec_fn,"Vectorizing Batch {}".format(i), file_batches[i])
-                sp_vecs = mcore.returns()
-            ## flatten
-            if not self.json_rewrite:
-                sp_vecs = [ item for sl in sp_vecs for item in sl ]
+        if i_vocab is None and single_pass and not self.json_rewrite:
+            shard_files, vocab, counter = self.get_sparse_vecs_single_pass(files, vocab_size, sp_out_file, binary)
         else:
-            sp_vecs = map(self.vectorize_fn, files_and_vocab)
-        ## if we're not outputing json and we used non-concurrent processing, need to print out vecs here
+            if i_vocab is None:
+                counter = self.get_counter_dir_parallel(data_dir, pat)
+                vocab = self.get_vocab(counter, vocab_size)
+            else:
+                vocab = i_vocab
+            shard_files = self.vectorize_files(files, vocab, sp_out_file, binary)
         if not self.json_rewrite:
-            with io.open(sp_out_file, 'w', encoding=self.encoding) as fp:
-                for (v,l) in sp_vecs:
-                    fp.write(str(l))  
-                    for (i,c) in v:
-                        fp.write(' ')
-                        fp.write(str(i))
-                        fp.write(':')
-                        fp.write(str(c))
-                    fp.write('\n')
+            self.merge_shards(shard_files, sp_out_file, vocab, binary)
         if i_vocab is None: ## print out vocab if we had to create it
             with io.open(vocab_out_file, 'w', encoding=self.encoding) as fp:
                 for i in range(len(vocab.idx_to_token)):
@@ -113,11 +228,63 @@ class Vectorizer(object):
         return vocab
 
 
+class _SparseVecShardWriter(object):
+    """
+    Writes sparse vectors one document at a time to a text vector file (one `label id:count ...` line per document,
+    written in buffered blocks) or, with `binary`, to a binary CSR file written when the writer is closed.
+    """
+    def __init__(self, path, n_cols, binary, encoding='utf-8', buffer_docs=1000):
+        self.path = path
+        self.n_cols = n_cols
+        self.binary = binary
+        self.buffer_docs = buffer_docs
+        if binary:
+            self.ids, self.cnts, self.indptr = array.array('q'), array.array('f'), array.array('q', [0])
+            self.label_ids, self.doc_labels = {}, array.array('l')
+        else:
+            self.fp = io.open(path, 'w', encoding=encoding)
+            self.lines = []
+
+    def write_doc(self, ids, cnts, label):
+        """Append a document given its (sorted) term `ids`, associated counts `cnts` and `label`."""
+        if self.binary:
+            self.ids.extend(ids)
+            self.cnts.extend(cnts)
+            self.indptr.append(len(self.ids))
+            self.doc_labels.append(self.label_ids.setdefault(str(label), len(self.label_ids)))
+        else:
+            self.lines.append(str(label) + ''.join([' {}:{}'.format(i, c) for i, c in zip(ids, cnts)]) + '\n')
+            if len(self.lines) >= self.buffer_docs:
+                self.flush()
+
+    def flush(self):
+        if not self.binary:
+            self.fp.write(''.join(self.lines))
+            self.lines = []
+
+    def close(self):
+        if self.binary:
+            n_docs = len(self.indptr) - 1
+            with CSRFileWriter(self.path, n_docs, len(self.ids), self.n_cols) as writer:
+                writer.write_docs(np.array(self.indptr, dtype='int64'), np.array(self.ids, dtype='int64'),
+                                  np.array(self.cnts, dtype='float32'), list(self.label_ids),
+                                  np.array(self.doc_labels, dtype='int64'))
+        else:
+            self.flush()
+            self.fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
 class JsonVectorizer(Vectorizer):
 
     def __init__(self, custom_stop_word_file=None, text_key='body', label_key=None, min_doc_size=6, label_prefix=-1,
-                 json_out_dir=None, encoding='utf-8'):
-        super(JsonVectorizer, self).__init__(custom_stop_word_file, encoding=encoding)
+                 json_out_dir=None, encoding='utf-8', n_workers=None):
+        super(JsonVectorizer, self).__init__(custom_stop_word_file, encoding=encoding, n_workers=n_workers)
         self.encoding = encoding
         self.text_key = text_key
         self.label_key = label_key
@@ -125,31 +292,8 @@ class JsonVectorizer(Vectorizer):
         self.min_doc_size = min_doc_size
         self.json_rewrite = json_out_dir is not None
         self.json_out_dir = json_out_dir
-
-    def get_counter_file(self, json_file, counter):
-        with io.open(json_file, 'r', encoding=self.encoding) as fp:
-            for l in fp:
-                js = json.loads(l)
-                txt = js.get(self.text_key) ## text field
-                if txt:
-                    counter = nlp.data.count_tokens(self.tokenizer.tokenize(txt), counter = counter)
-        return counter
-
-    def task(self, name, files):
-        counter = nlp.data.Counter()
-        for i in atpbar(range(len(files)), name=name):
-            self.get_counter_file(files[i], counter)
-        return counter
-
-    def get_counter_dir_parallel(self, data_dir, pat):
-        files = glob.glob(data_dir + '/' + pat)
-        file_batches = list(self.chunks(files, max(1, len(files) // cpu_count())))
-        logging.info("Counting vocabulary over {} text files with {} batches".format(len(files), len(file_batches)))
-        with mantichora() as mcore:
-            for i in range(len(file_batches)):
-                mcore.run(self.task,"Counting Vocab Items - Batch {}".format(i), file_batches[i])
-            counters = mcore.returns()
-        return sum(counters, Counter())
+        ## rewritten JSON is written per input file, so files are only split when producing vectors
+        self.splittable = not self.json_rewrite
 
     def vectorize_fn_to_json(self, file_and_vocab):
         json_file, vocab = file_and_vocab
@@ -159,106 +303,49 @@ class JsonVectorizer(Vectorizer):
             os.mkdir(self.json_out_dir)
         with io.open(json_file, 'r', encoding=self.encoding) as fp:
             with io.open(n_json_file, 'w', encoding=self.encoding) as op:
-                for l in fp:
-                    js = json.loads(l)
-                    txt = js.get(self.text_key)
-                    toks = self.tokenizer.tokenize(txt) if txt else []
-                    try:
-                        lstr = js[self.label_key]
-                        if self.label_prefix > 0:
-                            label_str = lstr[:self.label_prefix]
-                        else:
-                            label_str = lstr
-                    except KeyError:
-                        label_str = "<unk>"
-                    tok_ids = [vocab[token] for token in toks if token in vocab]
-                    if (len(tok_ids) >= self.min_doc_size):
-                        cnts_items = nlp.data.count_tokens(tok_ids).items()
-                        js['sp_vec'] = [[k,v] for k,v in cnts_items]
-                        op.write(json.dumps(js))
-                        op.write('\n')
-                        
-
-    def vectorize_fn_std(self, file_and_vocab):
-        json_file, vocab = file_and_vocab
-        sp_vecs = []
-        with io.open(json_file, 'r', encoding=self.encoding) as fp:
-            for l in fp:
-                js = json.loads(l)
-                txt = js.get(self.text_key)
-                toks = self.tokenizer.tokenize(txt) if txt else []
-                try:
-                    lstr = js[self.label_key]
-                    if self.label_prefix > 0:
-                        label_str = lstr[:self.label_prefix]
-                    else:
-                        label_str = lstr
-                except KeyError:
-                    label_str = "<unk>"
-                tok_ids = [vocab[token] for token in toks if token in vocab]
-                if (len(tok_ids) >= self.min_doc_size):
-                    cnts = nlp.data.count_tokens(tok_ids)
-                    sp_vecs.append((sorted(cnts.items()), label_str))
-        return sp_vecs
-
-    def vectorize_fn(self, file_and_vocab):
-        if self.json_rewrite:
-            return self.vectorize_fn_to_json(file_and_vocab)
-        else:
-            return self.vectorize_fn_std(file_and_vocab)
+                for lines in self.line_batches(fp):
+                    jss = [json.loads(l) for l in lines]
+                    for js, toks in zip(jss, self.tokenizer.tokenize_batch([js.get(self.text_key) or '' for js in jss])):
+                        tok_ids = [vocab[token] for token in toks if token in vocab]
+                        if (len(tok_ids) >= self.min_doc_size):
+                            cnts_items = nlp.data.count_tokens(tok_ids).items()
+                            js['sp_vec'] = [[k,v] for k,v in cnts_items]
+                            op.write(json.dumps(js))
+                            op.write('\n')
+
+    def get_label_str(self, js):
+        try:
+            lstr = js[self.label_key]
+            if self.label_prefix > 0:
+                label_str = lstr[:self.label_prefix]
+            else:
+                label_str = lstr
+        except KeyError:
+            label_str = "<unk>"
+        return label_str
+
+    def iter_file_docs(self, json_file, start=0, end=None):
+        with self.open_range(json_file, start, end) as fp:
+            for lines in self.line_batches(fp):
+                jss = [json.loads(l) for l in lines]
+                for js, toks in zip(jss, self.tokenizer.tokenize_batch([js.get(self.text_key) or '' for js in jss])):
+                    yield toks, self.get_label_str(js)
 
 
 class TextVectorizer(Vectorizer):
 
-    def __init__(self, custom_stop_word_file=None, min_doc_size=6, encoding='utf-8'):
-        super(TextVectorizer, self).__init__(custom_stop_word_file, encoding=encoding)
+    def __init__(self, custom_stop_word_file=None, min_doc_size=6, encoding='utf-8', n_workers=None):
+        super(TextVectorizer, self).__init__(custom_stop_word_file, encoding=encoding, n_workers=n_workers)
         self.min_doc_size = min_doc_size
 
-        
-    def task(self, name, files):
-        counters = []
-        for i in atpbar(range(len(files)), name=name):
-            counters.append(self.get_counter_file_batch(files[i]))
-        return counters
-
-
-    def get_counter_dir_parallel(self, txt_dir, pat='*.txt'):
-        def batches(l, n):
-            for i in range(0, len(l), n):
-                yield l[i:i+n]
-        files = glob.glob(txt_dir + '/' + pat)
-        batch_size = max(1, int(len(files) / 20))
-        file_batches = list(batches(files, batch_size))
-        file_batch_batches = list(self.chunks(file_batches, max(1, len(files) // cpu_count())))
-        with mantichora() as mcore:
-            for i in range(len(file_batch_batches)):
-                mcore.run(self.task,"Counting Vocab Items - Batch {}".format(i), file_batch_batches[i])
-            counter_cs = mcore.returns()
-        counters = [ item for sl in counter_cs for item in sl ]
-        return sum(counters, Counter())
-
-
-    def get_counter_file_batch(self, txt_file_batch):
-        counter = Counter()
-        for txt_file in txt_file_batch:
-            with io.open(txt_file, 'r', encoding=self.encoding) as fp:
-                for txt in fp:
-                    counter = nlp.data.count_tokens(self.tokenizer.tokenize(txt), counter = counter)
-        return counter
-
 
-    def vectorize_fn(self, txt_file_and_vocab):
-        txt_file, vocab = txt_file_and_vocab
-        sp_vecs = []
+    def iter_file_docs(self, txt_file, start=0, end=None):
+        ## each file is a single document (so files are never split)
+        doc_toks = []
         with io.open(txt_file, 'r', encoding=self.encoding) as fp:
-            doc_tok_ids = []
-            for txt in fp:
-                toks = self.tokenizer.tokenize(txt)
-                tok_ids = [vocab[token] for token in toks if token in vocab]
-                doc_tok_ids.extend(tok_ids)
-            if (len(doc_tok_ids) >= self.min_doc_size):
-                cnts = nlp.data.count_tokens(doc_tok_ids)
-                sp_vecs.append((sorted(cnts.items()), "<unk>"))
-        return sp_vecs
+            for lines in self.line_batches(fp):
+                for toks in self.tokenizer.tokenize_batch(lines):
+                    doc_toks.extend(toks)
+        yield doc_toks, "<unk>"
 
     
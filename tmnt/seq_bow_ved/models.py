@@ -18,6 +18,7 @@ from mxnet.gluon.block import HybridBlock, Block
 from tmnt.distributions import LogisticGaussianLatentDistribution, GaussianLatentDistribution
 from tmnt.distributions import GaussianUnitVarLatentDistribution, HyperSphericalLatentDistribution
 from tmnt.seq_vae.trans_seq_models import TransformerEncoder
+from tmnt.bow_vae.bow_models import get_decoder_jacobian
 
 class TransformerBowVED(Block):
 
@@ -74,22 +75,15 @@ class TransformerBowVED(Block):
             bias_param.grad_req = 'null'
             self.out_bias = bias_param.data()
 
-    def get_top_k_terms(self, k):
+    def get_top_k_terms(self, k, method='auto'):
         """
         Returns the top K terms for each topic based on sensitivity analysis. Terms whose 
         probability increases the most for a unit increase in a given topic score/probability
         are those most associated with the topic. This is just the topic-term weights for a 
         linear decoder - but code here will work with arbitrary decoder.
         """
-        z = mx.nd.ones(shape=(1, self.n_latent), ctx=self.model_ctx)
-        jacobian = mx.nd.zeros(shape=(self.bow_vocab_size, self.n_latent), ctx=self.model_ctx)
-        z.attach_grad()        
-        for i in range(self.bow_vocab_size):
-            with mx.autograd.record():
-                y = self.decoder(z)
-                yi = y[0][i]
-            yi.backward()
-            jacobian[i] = z.grad
+        jacobian = get_decoder_jacobian(self.decoder, self.n_latent, self.bow_vocab_size, ctx=self.model_ctx,
+                                        method=method)
         sorted_j = jacobian.argsort(axis=0, is_ascend=False)
         return sorted_j
 
@@ -165,22 +159,15 @@ class BertBowVED(Block):
             bias_param.grad_req = 'null'
             self.out_bias = bias_param.data()
 
-    def get_top_k_terms(self, k):
+    def get_top_k_terms(self, k, method='auto'):
         """
         Returns the top K terms for each topic based on sensitivity analysis. Terms whose 
         probability increases the most for a unit increase in a given topic score/probability
         are those most associated with the topic. This is just the topic-term weights for a 
         linear decoder - but code here will work with arbitrary decoder.
         """
-        z = mx.nd.ones(shape=(1, self.n_latent), ctx=self.model_ctx)
-        jacobian = mx.nd.zeros(shape=(self.bow_vocab_size, self.n_latent), ctx=self.model_ctx)
-        z.attach_grad()        
-        for i in range(self.bow_vocab_size):
-            with mx.autograd.record():
-                y = self.decoder(z)
-                yi = y[0][i]
-            yi.backward()
-            jacobian[i] = z.grad
+        jacobian = get_decoder_jacobian(self.decoder, self.n_latent, self.bow_vocab_size, ctx=self.model_ctx,
+                                        method=method)
         sorted_j = jacobian.argsort(axis=0, is_ascend=False)
         return sorted_j
 
@@ -7,6 +7,8 @@ Copyright (c) 2019 The MITRE Corporation.
 from .log_utils import *
 from .mat_utils import *
 from .random import *
+from .csr_file import *
+from .mixed_precision import *
 ##from .pubmed_utils import *
 
-__all__ = log_utils.__all__ + mat_utils.__all__ + random.__all__ 
+__all__ = log_utils.__all__ + mat_utils.__all__ + random.__all__ + csr_file.__all__ + mixed_precision.__all__
@@ -0,0 +1,218 @@
+# coding: utf-8
+"""
+Copyright (c) 2020 The MITRE Corporation.
+
+Binary container for document-term matrices in CSR form. The file holds a short preamble, the `indptr`, `indices`,
+`data` and `labels` arrays at 64-byte aligned offsets and a trailing JSON header (shape, label strings, total word
+count and a hash of the vocabulary). Arrays are memory-mapped on load so no text parsing is required.
+"""
+
+import hashlib
+import io
+import json
+import struct
+
+import numpy as np
+
+__all__ = ['CSRFileWriter', 'is_csr_file', 'load_csr_file', 'vocab_hash', 'convert_vec_to_csr_file', 'write_csr_file',
+           'merge_csr_files']
+
+MAGIC = b'TMNTCSR1'
+PREAMBLE = struct.Struct('<8sQQ')  # magic, header offset, header length
+ALIGN = 64
+ARRAY_DTYPES = [('indptr', 'int64'), ('indices', 'int64'), ('data', 'float32'), ('labels', 'int32')]
+
+
+def _align(offset):
+    return (offset + ALIGN - 1) // ALIGN * ALIGN
+
+
+def vocab_hash(tokens):
+    """
+    Hash of an ordered list of vocabulary tokens, used to check that a CSR file matches a vocabulary.
+    """
+    return hashlib.sha1('\n'.join(tokens).encode('utf-8')).hexdigest()
+
+
+def is_csr_file(path):
+    """
+    True if `path` is a binary CSR file (rather than a text sparse vector file).
+    """
+    with io.open(path, 'rb') as fp:
+        return fp.read(len(MAGIC)) == MAGIC
+
+
+class CSRFileWriter(object):
+    """
+    Writes documents one at a time into a binary CSR file. The number of documents and non-zero entries must be
+    known up front so that the arrays can be laid out and written in place.
+
+    Parameters
+    ----------
+    path : str output file
+    n_docs : int number of documents (rows)
+    nnz : int total number of non-zero entries
+    n_cols : int number of columns (i.e. vocabulary size)
+    v_hash : str (default None) hash of the vocabulary as computed by `vocab_hash`
+    """
+    def __init__(self, path, n_docs, nnz, n_cols, v_hash=None):
+        self.path = path
+        self.n_docs = n_docs
+        self.nnz = nnz
+        self.n_cols = n_cols
+        self.v_hash = v_hash
+        sizes = {'indptr': n_docs + 1, 'indices': nnz, 'data': nnz, 'labels': n_docs}
+        self.offsets = {}
+        offset = _align(PREAMBLE.size)
+        for name, dt in ARRAY_DTYPES:
+            self.offsets[name] = offset
+            offset = _align(offset + sizes[name] * np.dtype(dt).itemsize)
+        self.header_offset = offset
+        with io.open(path, 'wb') as fp:
+            fp.truncate(offset)
+        self.arrays = {}
+        for name, dt in ARRAY_DTYPES:
+            self.arrays[name] = np.memmap(path, dtype=dt, mode='r+', offset=self.offsets[name], shape=(sizes[name],)) \
+                if sizes[name] > 0 else np.zeros(0, dtype=dt)
+        self.arrays['indptr'][0] = 0
+        self.label_ids = {}
+        self.row = 0
+        self.pos = 0
+        self.total_words = 0.0
+
+    def write_doc(self, ids, cnts, label):
+        """
+        Append a document given its term `ids`, associated counts `cnts` and `label` string.
+        """
+        ids = np.asarray(ids, dtype='int64')
+        cnts = np.asarray(cnts, dtype='float32')
+        if len(ids) > 1 and (np.diff(ids) < 0).any():
+            order = np.argsort(ids, kind='stable')
+            ids, cnts = ids[order], cnts[order]
+        end = self.pos + len(ids)
+        self.arrays['indices'][self.pos:end] = ids
+        self.arrays['data'][self.pos:end] = cnts
+        self.arrays['labels'][self.row] = self.label_ids.setdefault(str(label), len(self.label_ids))
+        self.row += 1
+        self.pos = end
+        self.arrays['indptr'][self.row] = end
+        self.total_words += float(cnts.sum())
+
+    def write_docs(self, indptr, ids, cnts, label_strs, label_ids):
+        """
+        Append a block of documents given in CSR form (`indptr`, `ids`, `cnts`) with labels `label_strs[label_ids]`.
+        Term ids must already be sorted within each document.
+        """
+        n_rows = len(indptr) - 1
+        end = self.pos + len(ids)
+        self.arrays['indices'][self.pos:end] = ids
+        self.arrays['data'][self.pos:end] = cnts
+        block_ids = np.array([self.label_ids.setdefault(str(l), len(self.label_ids)) for l in label_strs], dtype='int32')
+        self.arrays['labels'][self.row:self.row + n_rows] = block_ids[label_ids] if n_rows > 0 else []
+        self.arrays['indptr'][self.row + 1:self.row + n_rows + 1] = np.asarray(indptr[1:]) - indptr[0] + self.pos
+        self.row += n_rows
+        self.pos = end
+        self.total_words += float(np.sum(cnts))
+
+    def close(self):
+        if self.row != self.n_docs or self.pos != self.nnz:
+            raise Exception("CSR file {} expected {} documents/{} entries but {}/{} were written"
+                            .format(self.path, self.n_docs, self.nnz, self.row, self.pos))
+        for arr in self.arrays.values():
+            if isinstance(arr, np.memmap):
+                arr.flush()
+        self.arrays = {}
+        header = {'shape': [self.n_docs, self.n_cols], 'nnz': self.nnz, 'offsets': self.offsets,
+                  'dtypes': dict(ARRAY_DTYPES), 'label_strs': list(self.label_ids.keys()),
+                  'total_words': self.total_words, 'vocab_hash': self.v_hash}
+        header_bytes = json.dumps(header).encode('utf-8')
+        with io.open(self.path, 'r+b') as fp:
+            fp.seek(self.header_offset)
+            fp.write(header_bytes)
+            fp.seek(0)
+            fp.write(PREAMBLE.pack(MAGIC, self.header_offset, len(header_bytes)))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+
+def load_csr_file(path):
+    """
+    Memory-map a binary CSR file.
+
+    Returns
+    -------
+    arrays: dictionary with read-only `indptr`, `indices`, `data` and `labels` arrays (labels index `label_strs`)
+    header: dictionary with `shape`, `nnz`, `label_strs`, `total_words` and `vocab_hash`
+    """
+    with io.open(path, 'rb') as fp:
+        magic, header_offset, header_len = PREAMBLE.unpack(fp.read(PREAMBLE.size))
+        if magic != MAGIC:
+            raise Exception("File {} is not a binary CSR file".format(path))
+        fp.seek(header_offset)
+        header = json.loads(fp.read(header_len).decode('utf-8'))
+    n_docs = header['shape'][0]
+    sizes = {'indptr': n_docs + 1, 'indices': header['nnz'], 'data': header['nnz'], 'labels': n_docs}
+    arrays = {}
+    for name, dt in header['dtypes'].items():
+        arrays[name] = np.memmap(path, dtype=dt, mode='r', offset=header['offsets'][name], shape=(sizes[name],)) \
+            if sizes[name] > 0 else np.zeros(0, dtype=dt)
+    return arrays, header
+
+
+def convert_vec_to_csr_file(vec_file, out_file, vocab_tokens, encoding='utf-8'):
+    """
+    Convert a text sparse vector file (`label idx:count ...` per line) into a binary CSR file.
+    The text file is read twice (once to size the arrays) so memory use does not grow with the corpus.
+    Blank lines are skipped, as when parsing the text file directly.
+    """
+    n_docs = 0
+    nnz = 0
+    with io.open(vec_file, 'r', encoding=encoding) as fp:
+        for line in fp:
+            els = line.split()
+            if els:
+                n_docs += 1
+                nnz += len(els) - 1
+    with CSRFileWriter(out_file, n_docs, nnz, len(vocab_tokens), v_hash=vocab_hash(vocab_tokens)) as writer:
+        with io.open(vec_file, 'r', encoding=encoding) as fp:
+            for line in fp:
+                els = line.split()
+                if els:
+                    pairs = [e.split(':') for e in els[1:]]
+                    writer.write_doc([int(p[0]) for p in pairs], [float(p[1]) for p in pairs], els[0])
+
+
+def write_csr_file(path, sp_mat, label_strs, label_ids, v_hash=None):
+    """
+    Write a `scipy.sparse.csr_matrix` (with sorted indices) and its labels (`label_strs[label_ids]`) to a binary CSR file.
+    """
+    with CSRFileWriter(path, sp_mat.shape[0], sp_mat.nnz, sp_mat.shape[1], v_hash=v_hash) as writer:
+        writer.write_docs(sp_mat.indptr, sp_mat.indices, sp_mat.data, label_strs, label_ids)
+
+
+def merge_csr_files(paths, out_file, v_hash=None, block_docs=100000):
+    """
+    Concatenate the rows of binary CSR files (with the same number of columns) into a single binary CSR file.
+    The inputs are memory-mapped and copied in blocks of `block_docs` rows, so memory use does not grow with
+    the size of the inputs.
+    """
+    headers = [load_csr_file(path)[1] for path in paths]
+    n_cols = headers[0]['shape'][1] if headers else 0
+    if any(h['shape'][1] != n_cols for h in headers):
+        raise Exception("Cannot merge CSR files with different numbers of columns: {}".format(paths))
+    n_docs = sum(h['shape'][0] for h in headers)
+    nnz = sum(h['nnz'] for h in headers)
+    with CSRFileWriter(out_file, n_docs, nnz, n_cols, v_hash=v_hash) as writer:
+        for path in paths:
+            arrays, header = load_csr_file(path)
+            indptr = arrays['indptr']
+            for s in range(0, header['shape'][0], block_docs):
+                e = min(s + block_docs, header['shape'][0])
+                a, b = int(indptr[s]), int(indptr[e])
+                writer.write_docs(indptr[s:e+1], arrays['indices'][a:b], arrays['data'][a:b], header['label_strs'],
+                                  arrays['labels'][s:e])
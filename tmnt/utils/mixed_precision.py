@@ -0,0 +1,142 @@
+# coding: utf-8
+"""
+Copyright (c) 2020 The MITRE Corporation.
+
+Support for training with low-precision (float16/bfloat16) parameters: the optimizer updates float32 master
+copies of those parameters and the loss is scaled to keep small gradients representable.
+"""
+
+import logging
+
+import mxnet as mx
+import numpy as np
+from mxnet import gluon
+from mxnet.contrib.amp.amp import bfloat16
+from mxnet.contrib.amp.loss_scaler import LossScaler
+
+__all__ = ['get_compute_dtype', 'is_low_precision', 'MixedPrecisionTrainer']
+
+def get_compute_dtype(dtype, ctx=mx.cpu()):
+    """
+    MXNet data type for a data type name ('float32', 'bfloat16' or 'float16') on context `ctx`.
+    Matrix products in float16 are only available on GPUs; bfloat16 is supported on CPUs.
+    """
+    if dtype == 'float32':
+        return np.float32
+    elif dtype == 'bfloat16':
+        return bfloat16
+    elif dtype == 'float16':
+        if ctx.device_type != 'gpu':
+            raise Exception("float16 training requires a GPU context; use bfloat16 on CPU")
+        return np.float16
+    else:
+        raise Exception("Invalid data type ==> {}".format(dtype))
+
+
+def is_low_precision(dtype):
+    """
+    True if `dtype` (a name or an MXNet/numpy data type) is narrower than float32.
+    """
+    if isinstance(dtype, str):
+        return dtype in ('bfloat16', 'float16')
+    return np.dtype(dtype) != np.float32
+
+
+class MixedPrecisionTrainer(object):
+    """
+    Trainer for models that hold some of their parameters in low precision. Each low-precision parameter has a
+    float32 master copy that the optimizer updates; after each update the master weights are cast back into the
+    model. Losses are scaled by a dynamically adjusted factor before the backward pass (see `scale_loss`); steps
+    whose gradients overflow are skipped and the factor is reduced. float32 parameters are updated directly.
+    Parameters are assumed to be on a single context.
+
+    Parameters
+    ----------
+    params : ParameterDict model parameters
+    optimizer : str optimizer name
+    optimizer_params : dict optimizer parameters (e.g. learning rate)
+    """
+    def __init__(self, params, optimizer, optimizer_params):
+        self._params = [p for p in params.values() if p.grad_req != 'null']
+        self._masters = []
+        self._opt_params = []
+        for p in self._params:
+            if is_low_precision(p.dtype):
+                master = gluon.Parameter(p.name + '_master', shape=p.shape, dtype='float32')
+                master.initialize(ctx=p.list_ctx())
+                master.set_data(p.data().astype('float32'))
+                self._masters.append((p, master))
+                self._opt_params.append(master)
+            else:
+                self._opt_params.append(p)
+        ## the optimizer is applied directly (rather than through a gluon.Trainer) as master gradients are
+        ## written by copying rather than by a backward pass
+        self._optimizer = mx.optimizer.create(optimizer, **optimizer_params)
+        self._optimizer.param_dict = {i: p for i, p in enumerate(self._opt_params)}
+        self._updater = mx.optimizer.get_updater(self._optimizer)
+        self._scaler = LossScaler()
+        self._cur_scale = self._scaler.loss_scale
+
+    @property
+    def learning_rate(self):
+        return self._optimizer.learning_rate
+
+    def set_learning_rate(self, lr):
+        self._optimizer.set_learning_rate(lr)
+
+    def scale_loss(self, loss):
+        """
+        Multiply `loss` by the current loss scale; call within `autograd.record()` and backpropagate the result.
+        """
+        self._cur_scale = self._scaler.loss_scale
+        return loss * self._cur_scale
+
+    def step(self, batch_size):
+        """
+        Update the parameters from gradients of a scaled loss, normalizing by `batch_size` as `gluon.Trainer.step`.
+        """
+        for p, master in self._masters:
+            p.grad().astype('float32').copyto(master.grad())
+        ## checked on the float32 gradients (the finiteness check has no 16-bit implementation on CPU)
+        if self._scaler.has_overflow(self._opt_params):
+            logging.info("Skipping update with non-finite gradients (loss scale = {})".format(self._cur_scale))
+            return
+        self._optimizer.rescale_grad = 1.0 / (batch_size * self._cur_scale)
+        for i, p in enumerate(self._opt_params):
+            self._updater(i, p.grad(), p.data())
+        self._copy_masters_to_model()
+
+    def _copy_masters_to_model(self):
+        for p, master in self._masters:
+            mx.nd.amp_cast(master.data(), dtype=p.dtype).copyto(p.data())
+
+    def save_states(self, fname):
+        """
+        Save the optimizer states (e.g. momentum), as `gluon.Trainer.save_states`.
+        """
+        with open(fname, 'wb') as fout:
+            fout.write(self._updater.get_states(dump_optimizer=True))
+
+    def load_states(self, fname):
+        with open(fname, 'rb') as fin:
+            self._updater.set_states(fin.read())
+        self._optimizer = self._updater.optimizer
+        self._optimizer.param_dict = {i: p for i, p in enumerate(self._opt_params)}
+
+    def save_master_parameters(self, fname):
+        """
+        Save the float32 master weights. Weights are keyed by position (parameter names depend on how many
+        models were created in the process) so they can only be loaded into a trainer for the same model.
+        """
+        mx.nd.save(fname, {'master_{}'.format(i): master.data() for i, (_, master) in enumerate(self._masters)})
+
+    def load_master_parameters(self, fname):
+        """
+        Load float32 master weights saved with `save_master_parameters` and cast them into the model.
+        """
+        loaded = mx.nd.load(fname)
+        if len(loaded) != len(self._masters):
+            raise Exception("Expected {} master weights in {} but found {}".format(len(self._masters), fname, len(loaded)))
+        for i, (_, master) in enumerate(self._masters):
+            master.set_data(loaded['master_{}'.format(i)])
+        self._copy_masters_to_model()
@@ -2,9 +2,12 @@
 Copyright (c) 2019 The MITRE Corporation.
 """
 
+import collections
 from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 
-from itertools import combinations as C
+import numpy as np
+import scipy.sparse as sp
 
 class UnigramReader(object):
     def __init__(self, vocab_file):
@@ -14,26 +17,134 @@ class UnigramReader(object):
                 _, count = line.strip().split()
                 self.unigrams[i] = int(count)
 
-                
+
+def _count_block(csr, term_ids):
+    """
+    Document frequencies over a block of documents (rows of `csr`). Returns the number of documents,
+    a vector of unigram document frequencies indexed by term id and a sparse (upper triangular) matrix of
+    pair document frequencies over positions in `term_ids` (or over term ids when `term_ids` is None).
+    """
+    occur = sp.csr_matrix((np.ones(csr.nnz, dtype='int32'), csr.indices, csr.indptr), shape=csr.shape)
+    occur.sum_duplicates()
+    occur.data[:] = 1
+    unigrams = np.asarray(occur.sum(axis=0)).ravel()
+    if term_ids is not None:
+        term_ids = term_ids[term_ids < occur.shape[1]]
+        occur = occur[:, term_ids]
+    bigrams = sp.triu(occur.T.dot(occur), k=1, format='csr')
+    return occur.shape[0], unigrams, bigrams
+
+
+def _pad_vector(v, n):
+    return v if len(v) >= n else np.concatenate([v, np.zeros(n - len(v), dtype=v.dtype)])
+
+
 class BigramReader(object):
-    def __init__(self, training_file):
-        self.bigrams = Counter()
-        self.unigrams = Counter()
+    """
+    Document frequencies of terms and term pairs over a file in sparse vector format (text or binary CSR).
+    The file is streamed in blocks (see `tmnt.bow_vae.bow_doc_loader.iter_sp_vec_blocks`); each block is
+    binarized and its pair frequencies obtained with a sparse matrix product, so memory is bounded by the number
+    of distinct pairs rather than the size of the corpus. Frequencies are held in `unigram_doc_freqs` (array
+    indexed by term id) and `bigram_doc_freqs` (sparse upper triangular matrix); `unigrams` and `bigrams`
+    provide them as `Counter` objects keyed by term id and by (lower, higher) term id pair.
+
+    Parameters
+    ----------
+    training_file : str path to a file in sparse vector format
+    term_ids : list of int (default None) only count pairs among these term ids (all pairs when None)
+    chunk_size : int (default 10000) number of documents per block of a binary CSR file
+    n_workers : int (default 1) number of processes counting blocks (blocks are counted in this process when 1)
+    encoding : str (default 'utf-8')
+    block_size : int (default 1 << 24) number of bytes per block of a text file
+    """
+    def __init__(self, training_file, term_ids=None, chunk_size=10000, n_workers=1, encoding='utf-8',
+                 block_size=(1 << 24)):
+        ## imported here as tmnt.bow_vae itself imports this module (through tmnt.coherence)
+        from tmnt.bow_vae.bow_doc_loader import iter_sp_vec_blocks
+        self.term_ids = None if term_ids is None else np.unique(np.array(term_ids, dtype='int64'))
+        n_terms = 0 if self.term_ids is None else len(self.term_ids)
+        self.unigram_doc_freqs = np.zeros(0, dtype='int64')
+        self.bigram_doc_freqs = sp.csr_matrix((n_terms, n_terms), dtype='int64')
         self.n_docs = 0
-        with open(training_file) as f:
-            for line in f:
-                self.n_docs += 1
-                label, *word_occurrences = line.strip().split()
-                counts = sorted(map(lambda s: int(s.split(":")[0]), word_occurrences))
-                for w in counts:
-                    self.unigrams[w] += 1
-                for (w_i, w_j) in C(counts, 2):
-                    # If we've previously stored this in a different order, keep storing it that way
-                    ## BRW - leaving this here, but it shouldn't happen as we've sorted these
-                    if self.bigrams[(w_j, w_i)] != 0:
-                        self.bigrams[(w_j, w_i)] += 1
-                    else:
-                        self.bigrams[(w_i, w_j)] += 1
+        blocks = (csr for _, _, csr in iter_sp_vec_blocks(training_file, None, encoding=encoding,
+                                                          block_size=block_size, block_docs=chunk_size))
+        if n_workers > 1:
+            with ProcessPoolExecutor(n_workers) as executor:
+                pending = collections.deque()
+                for csr in blocks:
+                    pending.append(executor.submit(_count_block, csr, self.term_ids))
+                    ## bound the number of blocks held in memory
+                    if len(pending) > 2 * n_workers:
+                        self._add_counts(*pending.popleft().result())
+                while pending:
+                    self._add_counts(*pending.popleft().result())
+        else:
+            for csr in blocks:
+                self._add_counts(*_count_block(csr, self.term_ids))
+
+    @property
+    def unigrams(self):
+        """
+        `Counter` of document frequencies keyed by term id.
+        """
+        ids = np.flatnonzero(self.unigram_doc_freqs)
+        return Counter(dict(zip(ids.tolist(), self.unigram_doc_freqs[ids].tolist())))
+
+    @property
+    def bigrams(self):
+        """
+        `Counter` of pair document frequencies keyed by (lower, higher) term id.
+        """
+        pairs = self.bigram_doc_freqs.tocoo()
+        w1s, w2s = pairs.row, pairs.col
+        if self.term_ids is not None:
+            w1s, w2s = self.term_ids[w1s], self.term_ids[w2s]
+        return Counter(dict(zip(zip(w1s.tolist(), w2s.tolist()), pairs.data.tolist())))
+
+    def _add_counts(self, n_docs, unigrams, bigrams):
+        self.n_docs += n_docs
+        n = max(len(self.unigram_doc_freqs), len(unigrams))
+        self.unigram_doc_freqs = _pad_vector(self.unigram_doc_freqs, n) + _pad_vector(unigrams, n)
+        if self.term_ids is None:
+            n = max(self.bigram_doc_freqs.shape[0], bigrams.shape[0])
+            self.bigram_doc_freqs.resize((n, n))
+            bigrams.resize((n, n))
+        else:
+            n = len(self.term_ids)
+            bigrams.resize((n, n))
+        self.bigram_doc_freqs = self.bigram_doc_freqs + bigrams
+
+    def doc_freqs(self, ws):
+        """
+        Number of documents containing each term in `ws`.
+        """
+        ws = np.asarray(ws, dtype='int64')
+        return _pad_vector(self.unigram_doc_freqs, int(ws.max()) + 1 if len(ws) > 0 else 0)[ws]
+
+    def pair_doc_freqs(self, w1s, w2s):
+        """
+        Number of documents containing both terms for each pair (w1s[i], w2s[i]); pairs involving a term
+        outside of `term_ids` have a count of zero.
+        """
+        w1s = np.asarray(w1s, dtype='int64')
+        w2s = np.asarray(w2s, dtype='int64')
+        lo = np.minimum(w1s, w2s)
+        hi = np.maximum(w1s, w2s)
+        if self.term_ids is None:
+            valid = hi < self.bigram_doc_freqs.shape[0]
+            p1, p2 = lo, hi
+        else:
+            p1 = np.minimum(np.searchsorted(self.term_ids, lo), len(self.term_ids) - 1)
+            p2 = np.minimum(np.searchsorted(self.term_ids, hi), len(self.term_ids) - 1)
+            valid = (self.term_ids[p1] == lo) & (self.term_ids[p2] == hi)
+        cnts = np.zeros(len(lo))
+        if valid.any():
+            cnts[valid] = np.asarray(self.bigram_doc_freqs[p1[valid], p2[valid]]).ravel()
+        ## a term paired with itself co-occurs in every document it appears in
+        same = lo == hi
+        cnts[same] = self.doc_freqs(lo[same])
+        return cnts
+
 
 if __name__ == "__main__":
     import sys